@@ -4,12 +4,19 @@
 # Create Dockerfile
 #
 cp ../../requirements.txt requirements.txt
+cp -r ../../training .
 cat  > Dockerfile <<EOF
 FROM python:3.10
 
 COPY ./requirements.txt .
 RUN pip3 install -r requirements.txt
 
+#
+# The shared training package, importable from everywhere
+#
+COPY training /opt/lib/training
+ENV PYTHONPATH=/opt/lib
+
 ENTRYPOINT ["/bin/sh", "-c"]
 CMD ["/bin/bash"]
 
@@ -22,3 +29,4 @@ docker build -t $GOOGLE_REGION-docker.pkg.dev/$GOOGLE_PROJECT_ID/vertex-ai-docke
 # Clean up
 #
 rm -f requirements.txt
+rm -rf training
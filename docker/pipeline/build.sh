@@ -3,13 +3,25 @@
 #
 # Create Dockerfile
 #
-cp ../../pipelines/model.py .
 cp ../../pipelines/tb_utils.py .
+cp ../../pipelines/dataset_io.py .
+cp ../../pipelines/data_loader.py .
+cp ../../pipelines/checkpoint.py .
+cp ../../pipelines/convergence.py .
+cp ../../pipelines/ensemble.py .
+cp ../../pipelines/profiling.py .
+cp -r ../../training .
 cat  > Dockerfile <<EOF
 FROM $GOOGLE_REGION-docker.pkg.dev/$GOOGLE_PROJECT_ID/vertex-ai-docker-repo/base:latest
 
-COPY model.py .
 COPY tb_utils.py .
+COPY dataset_io.py .
+COPY data_loader.py .
+COPY checkpoint.py .
+COPY convergence.py .
+COPY ensemble.py .
+COPY profiling.py .
+COPY training /opt/lib/training
 
 ENTRYPOINT ["/bin/bash", "-c"]
 
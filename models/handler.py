@@ -1,13 +1,49 @@
 
+import os
 import torch 
 from ts.torch_handler.base_handler import BaseHandler
 
+#
+# Name of the TorchScript version of the model in the model archive, which
+# we use instead of the eager model if it is present
+#
+TORCHSCRIPT_FILE = "model.pt"
+
+#
+# Precision in which we serve, set PRECISION=bfloat16 in the serving container
+# to convert weights and inputs to bfloat16
+#
+PRECISIONS = {
+    "float32" : torch.float32,
+    "bfloat16" : torch.bfloat16
+}
+
 
 class Handler(BaseHandler):
 
     def __init__(self):
         super().__init__()
         self.model = None
+        self.scripted = False
+        self.dtype = PRECISIONS[os.environ.get("PRECISION", "float32")]
+
+    #
+    # Let the base handler load the eager model from the state dict. If the archive
+    # contains a TorchScript version as extra file, we replace the model by that, as
+    # it avoids the Python overhead per call which dominates for our small model. The
+    # TorchScript version has float32 weights, so in bfloat16 we convert the eager model
+    #
+    def initialize(self, context):
+        super().initialize(context)
+        model_dir = context.system_properties.get("model_dir")
+        path = os.path.join(model_dir, TORCHSCRIPT_FILE)
+        if self.dtype != torch.float32:
+            print(f"Serving in {self.dtype}")
+            self.model = self.model.to(self.dtype)
+        elif os.path.exists(path):
+            print(f"Using TorchScript model {path}")
+            self.model = torch.jit.load(path, map_location = "cpu")
+            self.scripted = True
 
     #
     # This will be called by the base handler. We assume that there is
@@ -16,7 +52,7 @@ class Handler(BaseHandler):
     def preprocess(self, data):
         print(f"Preprocess: {data}")
         data = data[0]
-        input = torch.tensor(data, dtype = torch.float32)
+        input = torch.tensor(data, dtype = self.dtype)
         print(f"Preprocess: returning {input}")
         return input
     
@@ -25,7 +61,15 @@ class Handler(BaseHandler):
     # simply calls forward on the model, but we need predict
     #
     def inference(self, data):
-        return self.model.predict(data)
+        if not self.scripted:
+            return self.model.predict(data)
+        #
+        # The compiled model only has forward, and sigmoid(logit) < 0.5
+        # is the same as logit < 0
+        #
+        with torch.inference_mode():
+            logit = self.model(data)
+        return 0 if logit < 0 else 1
 
     #
     # Make sure that the output also matches the Google expectations
@@ -3,70 +3,14 @@
 # with two features, data consists of two blobs below and above the diagonal
 #
 
+import os
+import sys
 import torch
-import numpy as np
-from model import Model
-
-
 #
-# Create training data. Output is X, Y where
-# X has dimension N x D (with D = 2 being the dimension of our feature space)
-# and Y is the labels
+# When we run this locally, make the training package in the root of the repository importable
 #
-def create_data(N = 100):
-    X = []
-    Y = []
-    for i in range(N):
-        #
-        # First do the label, then choose a point in a corresponding cluster
-        #
-        label = np.random.randint(0, 2)
-        if label == 0:
-            #
-            # below diagonal
-            #
-            x = np.array([ 0.5, 0.25 ])
-        else:
-            x = np.array([ 0.5, 0.75 ])
-        #
-        # Add some noise
-        #
-        x = x + 0.05 * np.random.random(2)
-        X.append(x)
-        Y.append(label)
-    #
-    # X is now a list of arrays - converting this to a single array 
-    # before turning this into a tensor is more efficient
-    #
-    X = np.array(X)
-    X = torch.tensor(X, dtype = torch.float32)
-    Y = torch.tensor(Y, dtype = torch.float32)
-    assert X.shape == torch.Size([N, 2])
-    assert Y.shape == torch.Size([N])
-    return X, Y
-
-
-
-
-#
-# Train. Our data is very small, so we do not use
-# a dataset of shuffling but do everything in one batch
-#
-def train_model(model, X, Y, epochs = 5000):
-    model.train()
-    optimizer = torch.optim.SGD(model.parameters(), lr = 0.1)
-    loss_fn = torch.nn.functional.binary_cross_entropy_with_logits
-    for e in range(epochs):
-        logits = model(X).squeeze(dim = 1)
-        #
-        # Yes, the targets are expected to be floats
-        #
-        loss = loss_fn(input = logits, target = Y)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-    print(f"Final loss: {loss.detach()}")
-
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from training import Model, create_data, train_model, accuracy, export_torchscript, PrintHook
 
 
 #
@@ -74,22 +18,26 @@ def train_model(model, X, Y, epochs = 5000):
 #
 N = 1000
 epochs = 5000
-X, Y = create_data(N = N)
+X, Y = create_data(N)
 model = Model()
-train_model(model, X, Y, epochs = epochs)
+#
+# Set SOLVER=lbfgs to use the second-order solver instead of SGD
+#
+optimizer = os.environ.get("SOLVER", "sgd")
+train_model(model, X, Y, epochs = 100 if optimizer == "lbfgs" else epochs, optimizer = optimizer,
+            hooks = [PrintHook()])
 #
 # Calculate accuracy
 #
-hits = 0
-X, Y = create_data(N = N)
-for _x, x in enumerate(X):
-    prediction = model.predict(x)
-    true_label = int(Y[_x])
-    if true_label == prediction:
-        hits = hits + 1
-print(f"Accuracy on test data: {1.0 * hits / N}")
+X, Y = create_data(N)
+print(f"Accuracy on test data: {accuracy(model, X, Y)}")
 
 #
 # Export model
 #
-torch.save(model.state_dict(), "model.bin")
\ No newline at end of file
+torch.save(model.state_dict(), "model.bin")
+#
+# and a compiled version which the handler will use if we add it to
+# the archive as extra file
+#
+export_torchscript(model, "model.pt")
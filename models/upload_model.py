@@ -17,6 +17,13 @@ repository = f"{google_project_id}/vertex-ai-docker-repo"
 image = f"{registry}/{repository}/prediction:latest"
 bucket = f"gs://vertex-ai-{google_project_id}"
 #
+# Precision in which the handler serves the model, set PRECISION=bfloat16
+# to use bfloat16 on machines that support it
+#
+environment = {
+    "PRECISION" : os.environ.get("PRECISION", "float32")
+}
+#
 # Do we already have the model?
 #
 try:
@@ -28,6 +35,7 @@ try:
         parent_model = "vertexaimodel",
         serving_container_predict_route = "/predictions/model",
         serving_container_health_route = "/ping",
+        serving_container_environment_variables = environment,
         project = google_project_id,
         location = google_region
     )
@@ -39,6 +47,7 @@ except NotFound:
         model_id = "vertexaimodel",
         serving_container_predict_route = "/predictions/model",
         serving_container_health_route = "/ping",
+        serving_container_environment_variables = environment,
         display_name = "my-model",
         project = google_project_id,
         location = google_region    
@@ -0,0 +1,347 @@
+#
+# A deduplicating, content addressed store for local artifacts
+#
+import fcntl
+import hashlib
+import numpy as np
+import os
+import shutil
+import threading
+import uuid
+
+#
+# ioctl to clone a file on file systems that support reflinks (btrfs, XFS)
+#
+FICLONE = 0x40049409
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ContentDefinedChunker:
+    """
+    Split data into chunks whose boundaries depend on the content only, so that an insertion or a change
+    in one part of a large file only changes the chunks around this part. We use a rolling hash over a window of
+    bytes, where each byte is mapped to a random 64 bit value and the hash at a position is the sum of these values
+    over the window. Computing this via a cumulative sum is fully vectorised. A position is a boundary candidate if the
+    lowest bits of the hash are zero, the number of bits determines the average chunk size.
+
+    """
+    def __init__(self, avg_size = 1024**2, min_size = 256 * 1024, max_size = 4 * 1024**2, window = 64, block_size = 16 * 1024**2):
+        """
+        Initialize a chunker
+
+        Args:
+            avg_size : the average chunk size, needs to be a power of two
+            min_size : the minimum chunk size
+            max_size : the maximum chunk size
+            window : the size of the window for the rolling hash
+            block_size : the number of bytes that we process at a time
+        """
+        self._mask = np.uint64(avg_size - 1)
+        self._min_size = min_size
+        self._max_size = max_size
+        self._window = window
+        self._block_size = block_size
+        self._table = np.random.default_rng(seed = 4711).integers(0, 2**63, size = 256, dtype = np.uint64)
+
+    def _candidates(self, data, offset):
+        #
+        # Return the positions (relative to the start of the file) at which the
+        # rolling hash matches. Overflows in the cumulative sum are intended
+        #
+        values = self._table[np.frombuffer(data, dtype = np.uint8)]
+        with np.errstate(over = "ignore"):
+            sums = np.cumsum(values, dtype = np.uint64)
+            hashes = sums[self._window:] - sums[:-self._window]
+        return offset + self._window + 1 + np.flatnonzero((hashes & self._mask) == 0)
+
+    def chunks(self, path):
+        """
+        Yield the chunks of a file as bytes
+
+        Args:
+            path : the file to split
+        """
+        with open(path, "rb") as file:
+            #
+            # The unprocessed data starts at start in the buffer. We append to the buffer and only
+            # drop the processed data once it exceeds a block, so that we do not copy the whole
+            # buffer for each block that we read and each chunk that we hand out
+            #
+            buffer = bytearray()
+            start = 0
+            buffer_offset = 0
+            eof = False
+            while not eof or len(buffer) > start:
+                if not eof and len(buffer) - start < self._max_size + self._block_size:
+                    if start >= self._block_size:
+                        del buffer[:start]
+                        start = 0
+                    data = file.read(self._block_size)
+                    eof = len(data) == 0
+                    buffer.extend(data)
+                    continue
+                #
+                # Views need to be released before the buffer is resized again
+                #
+                with memoryview(buffer) as view:
+                    with view[start:start + self._max_size + self._window] as window:
+                        candidates = self._candidates(window, buffer_offset)
+                    candidates = candidates[candidates - buffer_offset >= self._min_size]
+                    if len(candidates) > 0:
+                        cut = int(candidates[0]) - buffer_offset
+                    else:
+                        cut = min(self._max_size, len(buffer) - start)
+                    chunk = bytes(view[start:start + cut])
+                yield chunk
+                start = start + cut
+                buffer_offset = buffer_offset + cut
+
+
+class ArtifactStore:
+    """
+    A content addressed store for local artifacts. Each distinct file content is stored once as a blob, named by
+    its SHA-256 hash, and exposed at the paths where components expect it through reflinks (where the file system
+    supports it) or hardlinks. Blobs are read-only so that a component cannot modify a blob through a link.
+
+    In addition, large files can be stored as a list of content defined chunks, which the step cache uses for
+    files that could not be stored as blobs, so that entries for similar files share most of their storage.
+
+    The store needs to be on the same file system as the local directory, we therefore place it under ./gcs
+    by default.
+
+    """
+    def __init__(self, store_dir = "./gcs/.store", use_reflinks = True, chunker = None):
+        """
+        Initialize the store
+
+        Args:
+            store_dir : the directory in which blobs and chunks are kept
+            use_reflinks : try reflinks first and fall back to hardlinks
+            chunker : the ContentDefinedChunker used to split large files
+        """
+        self._store_dir = store_dir
+        self._use_reflinks = use_reflinks
+        self._chunker = chunker or ContentDefinedChunker()
+        self._lock = threading.Lock()
+        os.makedirs(f"{store_dir}/blobs", exist_ok = True)
+        os.makedirs(f"{store_dir}/chunks", exist_ok = True)
+        self._logical_bytes = 0
+        self._stored_bytes = 0
+
+    def _blob_path(self, sha):
+        return f"{self._store_dir}/blobs/{sha[:2]}/{sha}"
+
+    def _chunk_path(self, sha):
+        return f"{self._store_dir}/chunks/{sha[:2]}/{sha}"
+
+    def _reflink(self, source, target):
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+    def _expose(self, blob, path):
+        #
+        # Make a blob available at path, replacing whatever is there. We create the
+        # link under a temporary name first and then rename it to be atomic
+        #
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        linked = False
+        if self._use_reflinks:
+            try:
+                self._reflink(blob, tmp_path)
+                linked = True
+            except OSError:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        if not linked:
+            try:
+                os.link(blob, tmp_path)
+            except OSError:
+                shutil.copyfile(blob, tmp_path)
+        os.replace(tmp_path, path)
+
+    def add_file(self, path):
+        """
+        Add a file to the store and replace it by a link to the blob
+
+        Args:
+            path : the file to add
+
+        Returns:
+            the SHA-256 hash of the file
+        """
+        sha = _hash_file(path)
+        blob = self._blob_path(sha)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._logical_bytes = self._logical_bytes + size
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok = True)
+                tmp_blob = f"{blob}.{uuid.uuid4().hex}.tmp"
+                #
+                # Files written by a container are owned by root and we might not be
+                # allowed to link them, in this case we need to copy the data once
+                #
+                try:
+                    os.link(path, tmp_blob)
+                except OSError:
+                    shutil.copyfile(path, tmp_blob)
+                try:
+                    os.chmod(tmp_blob, 0o444)
+                except PermissionError:
+                    pass
+                os.replace(tmp_blob, blob)
+                self._stored_bytes = self._stored_bytes + size
+        if not os.path.samefile(blob, path):
+            self._expose(blob, path)
+        return sha
+
+    def add_tree(self, directory):
+        """
+        Add all files in a directory to the store
+
+        Args:
+            directory : the directory
+
+        Returns:
+            a dictionary mapping paths relative to the directory to hashes
+        """
+        files = {}
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    #
+                    # Directories created by a container are owned by root, so we
+                    # might not be able to replace files in there by links
+                    #
+                    try:
+                        files[os.path.relpath(path, directory)] = self.add_file(path)
+                    except PermissionError:
+                        print(f"Could not add {path} to artifact store, leaving it in place")
+        return files
+
+    def unlink_tree(self, directory):
+        """
+        Remove all files in a directory which are hardlinks, i.e. most likely links to blobs, so that a step which
+        writes to the directory does not change the blobs. Other files, like checkpoints of an earlier attempt
+        which has failed, are kept
+
+        Args:
+            directory : the directory
+        """
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path) and os.stat(path).st_nlink > 1:
+                    os.remove(path)
+
+    def import_file(self, source, path):
+        """
+        Make the content of a file outside of the local directory available at path, for instance
+        a service account key which we would otherwise copy once for every run
+
+        Args:
+            source : the file to import
+            path : the path at which the content is exposed
+        """
+        shutil.copyfile(source, f"{path}.import.tmp")
+        os.replace(f"{path}.import.tmp", path)
+        return self.add_file(path)
+
+    def link(self, sha, path):
+        """
+        Expose a blob at a path
+
+        Args:
+            sha : the hash of the blob
+            path : the path
+        """
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._expose(self._blob_path(sha), path)
+
+    def has_blob(self, sha):
+        return os.path.exists(self._blob_path(sha))
+
+    def put_chunked(self, path):
+        """
+        Store a file as a list of content defined chunks
+
+        Args:
+            path : the file
+
+        Returns:
+            the list of chunk hashes
+        """
+        manifest = []
+        for chunk in self._chunker.chunks(path):
+            sha = hashlib.sha256(chunk).hexdigest()
+            chunk_path = self._chunk_path(sha)
+            with self._lock:
+                self._logical_bytes = self._logical_bytes + len(chunk)
+                if not os.path.exists(chunk_path):
+                    os.makedirs(os.path.dirname(chunk_path), exist_ok = True)
+                    with open(f"{chunk_path}.tmp", "wb") as file:
+                        file.write(chunk)
+                    os.replace(f"{chunk_path}.tmp", chunk_path)
+                    self._stored_bytes = self._stored_bytes + len(chunk)
+            manifest.append(sha)
+        return manifest
+
+    def restore_chunked(self, manifest, path):
+        """
+        Reassemble a file from its chunks and add the result to the store
+
+        Args:
+            manifest : the list of chunk hashes
+            path : the path of the file
+        """
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(f"{path}.tmp", "wb") as file:
+            for sha in manifest:
+                with open(self._chunk_path(sha), "rb") as chunk:
+                    shutil.copyfileobj(chunk, file)
+        os.replace(f"{path}.tmp", path)
+        return self.add_file(path)
+
+    def gc(self, live_chunks = None):
+        """
+        Remove blobs which are not linked from anywhere else anymore and, if a set of chunks still
+        in use is given, all other chunks. Blobs exposed through reflinks do not count as links, removing
+        the blob does not affect the reflinked copies
+
+        Args:
+            live_chunks : optional - the hashes of all chunks that are still referenced
+        """
+        removed = 0
+        with self._lock:
+            for root, _, names in os.walk(f"{self._store_dir}/blobs"):
+                for name in names:
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    if stat.st_nlink == 1:
+                        os.remove(path)
+                        removed = removed + stat.st_size
+            if live_chunks is not None:
+                for root, _, names in os.walk(f"{self._store_dir}/chunks"):
+                    for name in names:
+                        if name not in live_chunks:
+                            path = os.path.join(root, name)
+                            removed = removed + os.path.getsize(path)
+                            os.remove(path)
+        return removed
+
+    def report(self):
+        """
+        Return a summary of the space saved since the store has been created
+        """
+        saved = self._logical_bytes - self._stored_bytes
+        ratio = 100.0 * saved / self._logical_bytes if self._logical_bytes > 0 else 0.0
+        return (f"Artifact store: {self._logical_bytes / 1024**2:.1f} MB written by this run, "
+                f"{self._stored_bytes / 1024**2:.1f} MB stored, {saved / 1024**2:.1f} MB ({ratio:.1f}%) saved by deduplication")
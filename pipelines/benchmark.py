@@ -0,0 +1,273 @@
+#
+# Benchmark the pipeline locally across a grid of dataset sizes and epochs
+#
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+#
+# Steps that run outside of a container import the training package from the root
+# of the repository, in the images it is on the PYTHONPATH
+#
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import pipeline_definition
+from component_runner import ComponentRunner
+from step_trace import StepTracer, get_size
+
+STEPS = ["create_data", "train", "evaluate"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes",
+                        type = str,
+                        default = "1e3,1e4,1e5,1e6,1e7",
+                        help = "Comma separated list of dataset sizes")
+    parser.add_argument("--epochs",
+                        type = str,
+                        default = "100,1000",
+                        help = "Comma separated list of epochs")
+    parser.add_argument("--modes",
+                        type = str,
+                        default = "container,no_container",
+                        help = "Comma separated list of modes to run (container, no_container)")
+    parser.add_argument("--precisions",
+                        type = str,
+                        default = "float32",
+                        help = "Comma separated list of precisions for training and evaluation (float32, bfloat16)")
+    parser.add_argument("--repeat",
+                        type = int,
+                        default = 1,
+                        help = "Number of times each configuration is run, we report the median")
+    parser.add_argument("--output",
+                        type = str,
+                        default = "benchmark.json",
+                        help = "File to which we write the results")
+    parser.add_argument("--baseline",
+                        type = str,
+                        default = None,
+                        help = "Results of an earlier run to compare against")
+    parser.add_argument("--tolerance",
+                        type = float,
+                        default = 0.1,
+                        help = "Relative slowdown compared to the baseline that we report as regression")
+    return parser.parse_args()
+
+
+def run_configuration(runner, tracer, mode, size, epochs, run, precision = "float32"):
+    """
+    Run create_data, train and evaluate once for a configuration and return the results
+
+    Args:
+        runner : the ComponentRunner to use
+        tracer : the StepTracer attached to the runner
+        mode : container or no_container, used as part of the step names
+        size : the dataset size
+        epochs : the number of epochs
+        run : the index of the repetition, used as part of the step names
+        precision : the precision for training and evaluation
+    """
+    prefix = f"bench-{mode}-{precision}-{size}-{epochs}-{run}"
+    _create_data = runner.run_step(comp = pipeline_definition.create_data,
+                                   step_name = f"{prefix}-create_data",
+                                   use_cache = False,
+                                   size = size)
+    _train = runner.run_step(comp = pipeline_definition.train,
+                             step_name = f"{prefix}-train",
+                             use_cache = False,
+                             data = _create_data.outputs['training_data'],
+                             epochs = epochs,
+                             lr = 0.05,
+                             job_name = prefix,
+                             google_project_id = google_project_id,
+                             google_region = google_region,
+                             experiment_name = None,
+                             precision = precision,
+                             #
+                             # Throughput is only comparable if all runs train for the same number of epochs
+                             #
+                             patience = 0)
+    _evaluate = runner.run_step(comp = pipeline_definition.evaluate,
+                                step_name = f"{prefix}-evaluate",
+                                use_cache = False,
+                                trained_model = _train.outputs['trained_model'],
+                                validation_data = _create_data.outputs['validation_data'])
+    steps = {}
+    for step in STEPS:
+        profile = tracer.get_profile(f"{prefix}-{step}")
+        steps[step] = {
+            "wall_time" : profile.wall_time,
+            "cpu_time" : profile.cpu_time,
+            "peak_rss" : profile.peak_rss
+        }
+    artifact_sizes = {}
+    for step, step_output in [("create_data", _create_data), ("train", _train), ("evaluate", _evaluate)]:
+        for name, artifact in step_output.outputs.items():
+            uri = artifact['artifacts'][0]['uri']
+            artifact_sizes[f"{step}.{name}"] = get_size(uri.replace("gs://", f"{runner.local_dir}/", 1))
+    #
+    # Training can still stop early if the loss is no longer finite, so we
+    # take the number of epochs that were actually run from the metrics
+    #
+    stopped_epoch = _train.outputs['metrics']['artifacts'][0]['metadata'].get("stopped_epoch", 0)
+    return {
+        "steps" : steps,
+        "artifact_sizes" : artifact_sizes,
+        "accuracy" : _evaluate.parameters.get("Output"),
+        "epochs_run" : int(stopped_epoch) if stopped_epoch else epochs
+    }
+
+
+def summarize(runs, size):
+    """
+    Combine the results of several repetitions of a configuration, using the median
+    of the step latencies, and derive the throughput figures
+
+    Args:
+        runs : the results of the repetitions
+        size : the dataset size
+    """
+    steps = {}
+    for step in STEPS:
+        steps[step] = {
+            key : statistics.median(r['steps'][step][key] for r in runs) if runs[0]['steps'][step][key] is not None else None
+                for key in runs[0]['steps'][step].keys()
+        }
+    training_rows = int(size * 0.8)
+    epochs_run = statistics.median(r['epochs_run'] for r in runs)
+    return {
+        "steps" : steps,
+        "artifact_sizes" : runs[0]['artifact_sizes'],
+        "accuracy" : runs[0]['accuracy'],
+        "epochs_run" : epochs_run,
+        "throughput" : {
+            "create_data_rows_per_second" : size / steps['create_data']['wall_time'],
+            "train_samples_per_second" : training_rows * epochs_run / steps['train']['wall_time'],
+            "evaluate_rows_per_second" : (size - training_rows) / steps['evaluate']['wall_time']
+        }
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare step latencies against a baseline and print a table. Returns the number of
+    regressions, i.e. of steps that are slower than the baseline by more than the tolerance
+
+    Args:
+        results : the results of this run
+        baseline : the results of the baseline run
+        tolerance : the relative slowdown that we still accept
+    """
+    key = lambda r: (r['mode'], r.get('precision', "float32"), r['size'], r['epochs'])
+    baseline_results = { key(r) : r for r in baseline['results'] }
+    regressions = 0
+    print(f"{'Mode':<14} {'Precision':<10} {'Size':>10} {'Epochs':>8} {'Step':<12} {'Baseline s':>11} {'Current s':>11} {'Change':>8}")
+    for r in results['results']:
+        b = baseline_results.get(key(r))
+        if b is None:
+            continue
+        for step in STEPS:
+            old = b['steps'][step]['wall_time']
+            new = r['steps'][step]['wall_time']
+            change = (new - old) / old
+            flag = ""
+            if change > tolerance:
+                flag = "  REGRESSION"
+                regressions = regressions + 1
+            print(f"{r['mode']:<14} {r.get('precision', 'float32'):<10} {r['size']:>10} {r['epochs']:>8} {step:<12} {old:>11.3f} {new:>11.3f} {100 * change:>7.1f}%{flag}")
+    return regressions
+
+
+def compare_precisions(results):
+    """
+    Print throughput and accuracy of each reduced precision relative to float32 for the same configuration
+
+    Args:
+        results : the results of this run
+    """
+    key = lambda r: (r['mode'], r['size'], r['epochs'])
+    float32_results = { key(r) : r for r in results['results'] if r['precision'] == "float32" }
+    print(f"{'Mode':<14} {'Precision':<10} {'Size':>10} {'Epochs':>8} {'Train speedup':>14} {'Eval speedup':>13} {'Accuracy':>9} {'float32':>9}")
+    for r in results['results']:
+        b = float32_results.get(key(r))
+        if b is None or r['precision'] == "float32":
+            continue
+        train_speedup = r['throughput']['train_samples_per_second'] / b['throughput']['train_samples_per_second']
+        evaluate_speedup = r['throughput']['evaluate_rows_per_second'] / b['throughput']['evaluate_rows_per_second']
+        print(f"{r['mode']:<14} {r['precision']:<10} {r['size']:>10} {r['epochs']:>8} {train_speedup:>13.2f}x {evaluate_speedup:>12.2f}x {r['accuracy']:>9.2f} {b['accuracy']:>9.2f}")
+
+
+def has_bf16_support():
+    """
+    Return True if the CPU supports bfloat16 instructions (AVX-512 BF16 or AMX), None if we cannot tell
+    """
+    if not os.path.exists("/proc/cpuinfo"):
+        return None
+    with open("/proc/cpuinfo", "r") as file:
+        flags = file.read().split()
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+args = get_args()
+#
+# Train needs project and region, like in run_locally.py we take them from the
+# environment. The executor leaves out None values, so we pass an empty string
+#
+google_project_id = os.environ.get("GOOGLE_PROJECT_ID", "")
+google_region = os.environ.get("GOOGLE_REGION", "")
+sizes = [int(float(s)) for s in args.sizes.split(",")]
+epochs_grid = [int(e) for e in args.epochs.split(",")]
+modes = args.modes.split(",")
+precisions = args.precisions.split(",")
+#
+# Make sure that local ./gcs directory exists before we run a container
+# otherwise this will be added with owner root and we have a permission issue
+#
+os.makedirs("./gcs", exist_ok = True)
+results = {
+    "timestamp" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime()),
+    "host" : {
+        "platform" : platform.platform(),
+        "python" : platform.python_version(),
+        "cpus" : os.cpu_count(),
+        "bf16" : has_bf16_support()
+    },
+    "results" : []
+}
+for mode in modes:
+    tracer = StepTracer()
+    with ComponentRunner(no_container = (mode == "no_container"), tracer = tracer) as runner:
+        for precision in precisions:
+            for size in sizes:
+                for epochs in epochs_grid:
+                    print(f"Running benchmark for mode {mode}, precision {precision}, size {size}, epochs {epochs}")
+                    runs = [run_configuration(runner, tracer, mode, size, epochs, run, precision = precision) for run in range(args.repeat)]
+                    results['results'].append({
+                        "mode" : mode,
+                        "precision" : precision,
+                        "size" : size,
+                        "epochs" : epochs,
+                        **summarize(runs, size)
+                    })
+                    #
+                    # Write results after each configuration so that we keep
+                    # what we have if a large configuration fails
+                    #
+                    with open(args.output, "w") as file:
+                        json.dump(results, file, indent = 4)
+print(f"Results written to {args.output}")
+if "float32" in precisions and len(precisions) > 1:
+    compare_precisions(results)
+
+if args.baseline is not None:
+    with open(args.baseline, "r") as file:
+        baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions > 0:
+        print(f"Found {regressions} regressions")
+        exit(1)
@@ -0,0 +1,186 @@
+#
+# Periodic checkpoints of model and optimizer state, written in the background
+#
+import copy
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+
+def get_fingerprint(params, paths):
+    """
+    Return a fingerprint of the parameters and the input data of a training, so that we only resume from a
+    checkpoint which belongs to the same training. For the data we use names, sizes and modification times of
+    the files instead of their content, which is enough to detect data that has been created again
+
+    Args:
+        params : a dictionary with the parameters that influence the training
+        paths : the paths of the input artifacts
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(params, sort_keys = True).encode("utf-8"))
+    for path in paths:
+        sha.update(path.encode("utf-8"))
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        for file in files:
+            stat = os.stat(file)
+            sha.update(f"{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return sha.hexdigest()
+
+
+class AsyncCheckpointer:
+    """
+    Save model and optimizer state in regular intervals so that a training which is interrupted, for instance
+    because it runs on preemptible capacity, can resume from the last checkpoint instead of starting over.
+
+    The training loop only pays for copying the state. Serializing and writing the copy happens in a
+    background thread. Each checkpoint is written to a temporary file and renamed once it is complete, so
+    a checkpoint file is either complete or not there at all. While a checkpoint is being written, further
+    checkpoints are skipped rather than queued. Checkpoints are identified by the epoch and, for checkpoints
+    taken within an epoch, the batch at which training continues.
+
+    Each checkpoint carries a fingerprint of the training it belongs to. Checkpoints with a different fingerprint,
+    for instance left behind by a run of the same step with other parameters, are removed instead of restored.
+
+    """
+    def __init__(self, directory, interval = 60, keep = 2, fingerprint = None):
+        """
+        Initialize the checkpointer
+
+        Args:
+            directory : the directory in which checkpoints are stored
+            interval : the minimum number of seconds between two checkpoints
+            keep : the number of checkpoints that we keep
+            fingerprint : identifies the training, usually the result of get_fingerprint
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self._interval = interval
+        self._keep = keep
+        self._last_save = time.time()
+        self._thread = None
+        self._error = None
+        os.makedirs(directory, exist_ok = True)
+
+    def _checkpoints(self):
+        #
+        # Return all complete checkpoints, oldest first
+        #
+        checkpoints = []
+        for path in glob.glob(os.path.join(self.directory, "checkpoint-*.pt")):
+            match = re.fullmatch(r"checkpoint-(\d+)-(\d+)\.pt", os.path.basename(path))
+            if match is not None:
+                checkpoints.append((int(match.group(1)), int(match.group(2)), path))
+        return [path for _, _, path in sorted(checkpoints)]
+
+    def latest(self):
+        """
+        Return the path of the most recent checkpoint or None if there is none
+        """
+        checkpoints = self._checkpoints()
+        return checkpoints[-1] if len(checkpoints) > 0 else None
+
+    def restore(self, model, optimizer):
+        """
+        Load model and optimizer state from the most recent checkpoint
+
+        Args:
+            model : the model
+            optimizer : the optimizer
+
+        Returns:
+            the checkpoint as a dictionary, with the epoch and the batch within this epoch at which training continues
+            under the keys epoch and batch, or None if there is no checkpoint of this training
+        """
+        import torch
+        path = self.latest()
+        if path is None:
+            return None
+        checkpoint = torch.load(path, map_location = "cpu")
+        if checkpoint.get("fingerprint") != self.fingerprint:
+            #
+            # We remove the checkpoints, as they would otherwise be
+            # restored again or prevail over ours when we prune old ones
+            #
+            print(f"Ignoring checkpoint {path}, which belongs to a different training")
+            for old in self._checkpoints():
+                os.remove(old)
+            return None
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        print(f"Resuming from checkpoint {path} at epoch {checkpoint['epoch']}, batch {checkpoint['batch']}")
+        return checkpoint
+
+    def _write(self, checkpoint, path):
+        import torch
+        try:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as file:
+                torch.save(checkpoint, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
+            for old in self._checkpoints()[:-self._keep]:
+                os.remove(old)
+        except BaseException as e:
+            self._error = e
+
+    def save(self, epoch, model, optimizer, batch = 0, **extra):
+        """
+        Write a checkpoint in the background if the interval has passed since the last checkpoint and
+        no other checkpoint is being written
+
+        Args:
+            epoch : the epoch at which training continues when we resume from this checkpoint
+            model : the model
+            optimizer : the optimizer
+            batch : the batch within the epoch at which training continues, 0 for a checkpoint at the end of an epoch
+            extra : additional state to save
+
+        Returns:
+            True if a checkpoint is being written, False if it was skipped
+        """
+        if self._error is not None:
+            raise self._error
+        if time.time() - self._last_save < self._interval:
+            return False
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        #
+        # Take a copy of the state so that the training loop can continue to
+        # update the parameters while the copy is written
+        #
+        checkpoint = {
+            "epoch" : epoch,
+            "batch" : batch,
+            "fingerprint" : self.fingerprint,
+            "model" : { name : tensor.detach().clone() for name, tensor in model.state_dict().items() },
+            "optimizer" : copy.deepcopy(optimizer.state_dict()),
+            **copy.deepcopy(extra)
+        }
+        path = os.path.join(self.directory, f"checkpoint-{epoch:09d}-{batch:09d}.pt")
+        self._thread = threading.Thread(target = self._write, args = (checkpoint, path), daemon = True)
+        self._thread.start()
+        self._last_save = time.time()
+        return True
+
+    def close(self, remove = False):
+        """
+        Wait until the last checkpoint has been written
+
+        Args:
+            remove : remove all checkpoints, used once training has completed and the final model is saved
+        """
+        if self._thread is not None:
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
+        if remove:
+            shutil.rmtree(self.directory, ignore_errors = True)
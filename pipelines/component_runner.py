@@ -0,0 +1,562 @@
+#
+# A simple test driver to run individual pipeline components locally
+#
+import kfp
+from kfp.dsl import executor
+import contextlib
+import os
+import docker
+import json
+import pathlib
+from dataclasses import dataclass, field
+import resource
+import shutil
+import threading
+import time
+from step_trace import StepProfile, ContainerStatsCollector, get_size
+from step_resources import StepResources
+
+
+#
+# This class holds step output artifacts and the output parameters
+# that a step has written to its executor output file
+#
+@dataclass
+class StepOutput:
+    outputs : dict()
+    parameters : dict = field(default_factory = dict)
+
+#
+# The GCS prefix is a module level variable in KFP and therefore shared by all runners
+# (and all threads) in this process. We keep track of how many runners have patched it
+# so that nested runners do not restore a stale value and concurrent steps never touch it
+#
+_prefix_lock = threading.Lock()
+_prefix_users = 0
+_saved_prefix = None
+
+
+class ComponentRunner:
+    """
+    A simple test driver to run an invidual pipeline component. This class works by building an executor input
+    structure that points to local data for a given component function and then uses the KFP executor to actually
+    run it or runs a container.
+
+    Steps can be run concurrently from several threads. All state which is specific to a step (output
+    directory, executor output file) lives in a directory named after the step, the only state shared
+    between steps is the patched GCS prefix which is set once when entering the runner.
+
+    """
+    def __init__(self, pipeline_root = "pipeline_root", local_dir = "./gcs", no_container = False, cache = None, container_pool = None, process_pool = None, log_collector = None, artifact_store = None, tracer = None, image_pins = None):
+        """
+        Initialize a component runner
+
+        Args:
+            local_dir :  the local directory under which inputs and outputs are placed, not including a trailing slash
+            pipeline_root : the name of the subdirectory under this local dir where artifacts are created
+            no_container : set this to True to run outside of a container
+            cache : optional - a StepCache used to skip steps whose code and inputs have not changed
+            container_pool : optional - a WarmContainerPool used to run steps in warm containers instead of starting a new container per step
+            process_pool : optional - a ProcessPoolBackend used to run steps in worker processes if no_container is set
+            log_collector : optional - a LogCollector which receives the output of the steps instead of printing it directly
+            artifact_store : optional - an ArtifactStore which deduplicates the outputs of all steps
+            tracer : optional - a StepTracer which collects a resource profile for each step
+            image_pins : optional - a dictionary mapping image references to pinned references, as returned by ImagePreflight.run
+        """
+        self.local_dir = local_dir
+        self.pipeline_root = pipeline_root
+        self._no_container = no_container
+        self._cache = cache
+        self._container_pool = container_pool
+        self._process_pool = process_pool
+        self._log_collector = log_collector
+        self._artifact_store = artifact_store
+        self._tracer = tracer
+        self._image_pins = image_pins or {}
+        self._key_lock = threading.Lock()
+        self._key_json = None
+
+    def __enter__(self):
+        global _prefix_users, _saved_prefix
+        #
+        # Patch GCS prefix. When initializing the executor, an URI starting with
+        # gs:// is turned into a path by replacing gs:// by this prefix. Usually this
+        # is /gcs, we overwrite this by our local directory
+        #
+        prefix = f"{self.local_dir}/"
+        with _prefix_lock:
+            if _prefix_users == 0:
+                _saved_prefix = kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX
+                kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX = prefix
+            else:
+                assert kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX == prefix, \
+                    "Cannot use two runners with different local directories at the same time"
+            _prefix_users = _prefix_users + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        global _prefix_users
+        with _prefix_lock:
+            _prefix_users = _prefix_users - 1
+            if _prefix_users == 0:
+                kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX = _saved_prefix
+        return False
+
+    def create_runtime_artifact(self, artifact_name, step_name, schema_title):
+        """
+        Create the part of an execution input JSON which specifies an individual artifact. Uusally the URI used for this is
+        gs://{pipeline_root}/{step_name}/{artifact_name}
+
+        Args:
+            artifact_name : the name of the artifact
+            step_name : the name of the step, this will be used as part of the URI
+            schema_title : schema title to use for this artifact
+        """
+        #
+        # This dictionary represents a runtime artifact,
+        # i.e. an instance of one of the classes in dsl.types.artifact_types
+        # At runtime, the schema title is used to identify the correct class
+        #
+        return {
+            "name" : f"{artifact_name}",
+            "metadata" : {},
+            "type": {
+                "schemaTitle" : schema_title
+            },
+            #
+            # The URI will be used to determine the local path at runtime. For a GCS bucket,
+            # the KFP executor will replace gs:// prefix  by /gcs or more precisely by the value of
+            # types.artifact_types._GCS_LOCAL_MOUNT_PREFIX - this is what we patch in the __enter__ method
+            #
+            "uri" : f"gs://{self.pipeline_root}/{step_name}/{artifact_name}"
+        }
+
+    def get_param_type(self, param_spec):
+        """
+        Check whether an input or output is an artifact, a parameter and input or output.
+        At the time of writing at least this can be detected by checking whether the type is a schema definition
+        of the form <schema_title>@<schema_version>
+
+        Args:
+            param_spec : the parameter specifaction to inspect
+
+        """
+        is_input = isinstance (param_spec, kfp.dsl.structures.InputSpec)
+        is_artifact = "@" in param_spec.type
+        return is_input, is_artifact
+
+    def get_output_file(self, step_name, in_container = False):
+        """
+        Return the path of the executor output file for a step. When the step runs in a container,
+        the file needs to be written to the mounted volume so that we can pick it up afterwards
+
+        Args:
+            step_name : the step name
+            in_container : return the path as seen from within the container
+        """
+        if in_container:
+            return f"/gcs/{step_name}/execution_output.json"
+        return f"{self.local_dir}/{step_name}/execution_output.json"
+
+    def build_executor_input_from_function(self, comp, step_name, **kwargs):
+        """
+        Assemble an executor input structure for a component, using the provided input mappings
+        (see the comment for create_runtime_artifact). Input parameters will be taken from the kwargs
+
+        Args:
+            comp : the component for which we want to create the executor input, needs to be an instance of PythonComponent
+            step_name : the step name
+            kwargs : additional key word arguments used as inputs
+
+        """
+        inputs_and_outputs = { **(comp.component_spec.inputs or {}), **(comp.component_spec.outputs or {})}
+        output_artifacts = {}
+        input_artifacts = {}
+        parameter_values = {}
+        #
+        # Go through inputs and outputs and add items to input_artifacts and parameter_values
+        #
+        for param_name, param_spec in inputs_and_outputs.items():
+            is_input, is_artifact = self.get_param_type(param_spec)
+            if not is_artifact:
+                #
+                # This is a parameter - we only handle input parameters
+                #
+                if is_input:
+                    #
+                    # Check that input is contained in kwargs. An optional parameter can be left
+                    # out, the executor then uses the default of the component function
+                    #
+                    if param_name not in kwargs and param_spec.optional:
+                        continue
+                    assert param_name in kwargs, f"Parameter {param_name} not in parameter values"
+                    #
+                    # and take it from there
+                    #
+                    parameter_values[param_name] = kwargs[param_name]
+            else:
+                #
+                # If the input is contained in the kwargs, take it from there
+                #
+                if param_name in kwargs and is_input:
+                    input_artifacts[param_name] = kwargs[param_name]
+                elif is_input and param_spec.optional:
+                    #
+                    # An optional input artifact which is not given, the component gets None
+                    #
+                    continue
+                else:
+                    #
+                    # Need to build the structure ourselves. We can get the schema
+                    # title and the schema version from the type
+                    #
+                    schema_title = param_spec.type.split("@")[0]
+                    #
+                    # Add an entry to the input artifacts dictionary. Each entry
+                    # is a dictionary with the key artifacts. The value is a list
+                    # (we only use one entry) and each item in the list is an actual
+                    # artifact with name, metadata, schema and URI
+                    #
+                    run_artifact = {
+                        "artifacts" : [
+                            self.create_runtime_artifact(
+                                artifact_name = param_name,
+                                step_name = step_name,
+                                schema_title = schema_title)
+                        ]
+                    }
+                    if is_input:
+                        input_artifacts[param_name] = run_artifact
+                    else:
+                        output_artifacts[param_name] = run_artifact
+
+        #
+        # Assemble the executor input structure. There are two sections that will later
+        # be used by the executor:
+        #
+        # inputs: contains all inputs. This can be parameter values but also input artifacts
+        # outputs: contains all outputs. In addition, there is a key outputFile which is the
+        #          local path to which the executor output is written
+        #
+        executor_input = {
+            "inputs" : {
+                "parameterValues" : parameter_values,
+            },
+            "outputs":  {
+                "outputFile" : self.get_output_file(step_name, in_container = not self._no_container)
+            }
+        }
+        if len(input_artifacts.keys()) > 0:
+            executor_input['inputs']['artifacts'] = input_artifacts
+        if len(output_artifacts.keys()) > 0:
+            executor_input['outputs']['artifacts'] = output_artifacts
+        return executor_input
+
+    def run_step(self, comp, step_name, verbose = False,  key_json = None, use_cache = True, resources = None, **kwargs):
+        """
+        Run a step, using the provided kwargs and the provided input mappings.
+
+        We return a dataclass containing the output artifacts so that they can be used as input for the next
+        step in a syntax similar to a pipeline definition, i.e.
+
+        _first = run_step(...)
+        _second = run_step(..., <argument name> = _first.outputs['<argument_name>'])
+
+        Args:
+            comp : the PythonComponent to run
+            step_name : a step name (needs to be unique)
+            verbose : set this to True to collect extra output
+            kwargs : key word arguments that will be used as input parameters for the step
+            key_json : optional - full path of a service account key JSON file that we will use
+            use_cache : set this to False to always run the step, even if the cache has a result for it
+            resources : optional - the StepResources of the step, i.e. what set_cpu_limit and set_memory_limit do in a pipeline
+
+        """
+        executor_input = self.build_executor_input_from_function(comp, step_name, **kwargs)
+        return self.execute(executor_input = executor_input,
+                            step_name = step_name,
+                            function_to_execute = comp,
+                            image = comp.component_spec.implementation.container.image,
+                            command = comp.component_spec.implementation.container.command,
+                            function_name = comp.python_func.__name__,
+                            verbose = verbose,
+                            key_json = key_json,
+                            use_cache = use_cache,
+                            resources = resources)
+
+    def execute(self, executor_input, step_name, function_to_execute, image, command, function_name, verbose = False, key_json = None, use_cache = True, resources = None):
+        """
+        Run a step for which the executor input has already been assembled. This is used by run_step, but
+        also by the pipeline runner in dag_runner.py which builds the executor input from a compiled pipeline
+
+        Args:
+            executor_input : the executor input structure
+            step_name : the step name (needs to be unique)
+            function_to_execute : the function or PythonComponent to run when we do not use a container
+            image : the image to use when we run in a container
+            command : the container command (entrypoint)
+            function_name : the name of the function inside the component module that the container will execute
+            verbose : set this to True to collect extra output
+            key_json : optional - full path of a service account key JSON file that we will use
+            use_cache : set this to False to always run the step, even if the cache has a result for it
+            resources : optional - the StepResources of the step. CPU and memory limits are enforced in a container and in a
+                        worker process, but not when the step runs in the driver process
+
+        """
+        resources = resources or StepResources()
+        if verbose:
+            print(f"Preparing step {step_name} - using executor input: \n{json.dumps(executor_input, indent = 4)}")
+        output_dir = f"{self.local_dir}/{self.pipeline_root}/{step_name}"
+        #
+        # Use the pinned image if we have one, this also makes sure that the cache
+        # does not return results produced by an older version of a moving tag
+        #
+        image = self._image_pins.get(image, image)
+        profile = StepProfile(step_name = step_name, start = time.time())
+        profile.bytes_read = sum(get_size(self._get_local_path(artifact['uri']))
+                                    for input_artifact in executor_input['inputs'].get('artifacts', {}).values()
+                                    for artifact in input_artifact['artifacts'])
+        try:
+            #
+            # If we have seen the same code with the same inputs before, restore the outputs
+            # from the cache instead of running the step
+            #
+            cache_key = None
+            if self._cache is not None and use_cache:
+                cache_key = self._cache.fingerprint(image = image,
+                                                    command = command,
+                                                    function_name = function_name,
+                                                    executor_input = executor_input,
+                                                    local_dir = self.local_dir)
+                if self._cache.restore(cache_key, output_dir = output_dir, output_file = self.get_output_file(step_name)):
+                    print(f"Using cached result for step {step_name}")
+                    profile.cached = True
+                    return self.get_step_output(executor_input, self.read_executor_output(step_name))
+            #
+            # Outputs of an earlier run might be links to read-only blobs in the artifact store,
+            # so we remove them to make sure that the step writes new files. Files that are not
+            # in the store, like checkpoints of a failed attempt, are left for the step to resume
+            #
+            if self._artifact_store is not None and os.path.exists(output_dir):
+                self._artifact_store.unlink_tree(output_dir)
+            #
+            # Make sure that output directory exists
+            #
+            if "artifacts" in executor_input['outputs']:
+                os.makedirs(output_dir, exist_ok = True)
+            os.makedirs(f"{self.local_dir}/{step_name}", exist_ok = True)
+            executor_output = None
+            if self._no_container and self._process_pool is not None:
+                #
+                # Run the step in a worker process which returns the executor output
+                #
+                with profile.span("run"):
+                    executor_output, usage = self._process_pool.run(command = command,
+                                                                    function_name = function_name,
+                                                                    executor_input = executor_input,
+                                                                    step_name = step_name,
+                                                                    resources = resources)
+                profile.cpu_time = usage['cpu_time']
+                profile.peak_rss = usage['peak_rss']
+            elif self._no_container:
+                self._run_in_process(executor_input, step_name, function_to_execute, verbose, profile)
+            else:
+                self._run_in_container(executor_input, step_name, image, command, function_name, verbose, key_json, profile, resources)
+            profile.bytes_written = get_size(output_dir)
+            blobs = None
+            if self._artifact_store is not None and os.path.isdir(output_dir):
+                blobs = self._artifact_store.add_tree(output_dir)
+            if cache_key is not None:
+                self._cache.store(cache_key, output_dir = output_dir, output_file = self.get_output_file(step_name), step_name = step_name, blobs = blobs)
+            if executor_output is None:
+                executor_output = self.read_executor_output(step_name)
+            return self.get_step_output(executor_input, executor_output)
+        finally:
+            profile.end = time.time()
+            if self._tracer is not None:
+                self._tracer.add(profile)
+
+    def _run_in_process(self, executor_input, step_name, function_to_execute, verbose, profile):
+        #
+        # Create executor
+        #
+        _executor = executor.Executor(
+                executor_input = executor_input,
+                function_to_execute = function_to_execute)
+
+        #
+        # Run it. The executor will use the executor input to
+        # instantiate input and output artifacts, model etc. and then
+        # invoke the actual function with these inputs. Other steps might run
+        # in parallel, so we can only measure the CPU time of this thread
+        #
+        cpu_start = resource.getrusage(resource.RUSAGE_THREAD)
+        with profile.span("run"), self._capture_output(step_name):
+            output_file = _executor.execute()
+        cpu_end = resource.getrusage(resource.RUSAGE_THREAD)
+        profile.cpu_time = (cpu_end.ru_utime + cpu_end.ru_stime) - (cpu_start.ru_utime + cpu_start.ru_stime)
+        profile.peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if verbose:
+            print(f"Execution of step {step_name} complete, output file has been written to {output_file}")
+
+    def _run_in_container(self, executor_input, step_name, image, command, function_name, verbose, key_json, profile, resources):
+        #
+        # Run our component in a docker container
+        #
+        if verbose:
+            print(f"Command: {command}")
+        #
+        # Figure out whether we have credentials
+        #
+        env = resources.get_env()
+        if key_json is not None:
+            self._copy_key_json(key_json)
+            env["GOOGLE_APPLICATION_CREDENTIALS"] = f"/gcs/key.json"
+        docker_client = docker.from_env()
+        #
+        # Pull the image explicitly if we do not have it yet so that we
+        # can tell the time spent on pulling from the actual run time
+        #
+        try:
+            docker_client.images.get(image)
+        except docker.errors.ImageNotFound:
+            with profile.span("pull"):
+                docker_client.images.pull(image)
+            profile.pull_time = profile.spans[-1][2] - profile.spans[-1][1]
+        if self._container_pool is not None:
+            with profile.span("run"):
+                usage = self._container_pool.run(image = image,
+                                                 command = command,
+                                                 function_name = function_name,
+                                                 executor_input = executor_input,
+                                                 step_name = step_name,
+                                                 env = env,
+                                                 limits = resources.get_docker_limits(),
+                                                 log = self._get_log_function(step_name))
+            profile.cpu_time = usage.get('cpu_time')
+            profile.peak_rss = usage.get('peak_rss')
+            profile.start_time = usage.get('startup_time')
+            return
+        args = [
+            "--executor_input",
+            json.dumps(executor_input),
+            "--function_to_execute",
+            function_name
+        ]
+        with profile.span("create"):
+            container = docker_client.containers.create(
+                image = image,
+                entrypoint = command,
+                command = args,
+                volumes = [
+                    f"{pathlib.Path(self.local_dir).resolve()}:/gcs",
+                ],
+                environment = env,
+                **resources.get_docker_limits()
+            )
+        profile.create_time = profile.spans[-1][2] - profile.spans[-1][1]
+        #
+        # Attach before starting the container so that we do not miss any output. With
+        # demux, we get pairs of stdout and stderr chunks instead of a merged stream
+        #
+        output = container.attach(stdout = True, stderr = True, stream = True, logs = True, demux = True)
+        with profile.span("start"):
+            container.start()
+        profile.start_time = profile.spans[-1][2] - profile.spans[-1][1]
+        stats = ContainerStatsCollector(container) if self._tracer is not None else None
+        log = self._get_log_function(step_name)
+        with profile.span("run"):
+            for stdout, stderr in output:
+                if stdout is not None:
+                    log("stdout", stdout)
+                if stderr is not None:
+                    log("stderr", stderr)
+            exit_code = container.wait()['StatusCode']
+        if stats is not None:
+            stats.stop()
+            profile.cpu_time = stats.cpu_time
+            profile.peak_rss = stats.peak_memory
+        container.remove()
+        assert exit_code == 0, f"Step {step_name} failed with exit code {exit_code}"
+
+    def _get_local_path(self, uri):
+        #
+        # Turn an artifact URI into a local path, in the same way as the executor does
+        #
+        if uri.startswith("gs://"):
+            return f"{self.local_dir}/{uri[len('gs://'):]}"
+        return uri
+
+    def read_executor_output(self, step_name):
+        """
+        Read the executor output file of a step, an empty dictionary if the step did not write one
+
+        Args:
+            step_name : the step name
+        """
+        output_file = self.get_output_file(step_name)
+        if not os.path.exists(output_file):
+            return {}
+        with open(output_file, "r") as file:
+            return json.load(file)
+
+    def read_output_parameters(self, step_name):
+        """
+        Read the output parameters (including the return value of the component function which is
+        stored under the key Output) from the executor output file of a step
+
+        Args:
+            step_name : the step name
+        """
+        return self.read_executor_output(step_name).get("parameterValues", {})
+
+    def get_step_output(self, executor_input, executor_output):
+        """
+        Assemble the StepOutput of a step. The output artifacts are taken from the executor input, with the
+        metadata that the component has set on them taken from the executor output, so that downstream steps
+        see the metadata like they do on Vertex AI
+
+        Args:
+            executor_input : the executor input of the step
+            executor_output : the content of the executor output file
+        """
+        outputs = {}
+        for name, output_artifacts in executor_input['outputs'].get('artifacts', {}).items():
+            written = executor_output.get("artifacts", {}).get(name, {}).get("artifacts", [])
+            artifacts = []
+            for index, artifact in enumerate(output_artifacts['artifacts']):
+                artifact = dict(artifact)
+                if index < len(written):
+                    artifact['metadata'] = written[index].get("metadata", {})
+                artifacts.append(artifact)
+            outputs[name] = { "artifacts" : artifacts }
+        return StepOutput(outputs = outputs, parameters = executor_output.get("parameterValues", {}))
+
+    def _get_log_function(self, step_name):
+        #
+        # Return a function that accepts a stream name and a chunk of output for a step
+        #
+        if self._log_collector is None:
+            return lambda stream_name, data: print(data.decode("utf-8", errors = "replace"), end = "")
+        return lambda stream_name, data: self._log_collector.write(step_name, stream_name, data)
+
+    def _capture_output(self, step_name):
+        #
+        # Route output of a step that runs in this process to the log collector
+        #
+        if self._log_collector is None:
+            return contextlib.nullcontext()
+        return self._log_collector.capture(step_name)
+
+    def _copy_key_json(self, key_json):
+        #
+        # All steps share the same copy of the key, so we only copy it once, even if
+        # several steps are started at the same time
+        #
+        with self._key_lock:
+            if self._key_json != key_json:
+                if self._artifact_store is not None:
+                    self._artifact_store.import_file(key_json, f"{self.local_dir}/key.json")
+                else:
+                    shutil.copy(key_json, f"{self.local_dir}/key.json")
+                self._key_json = key_json
@@ -0,0 +1,272 @@
+#
+# A pool of long-lived containers which run pipeline components in place
+#
+import docker
+import json
+import kfp
+import os
+import pathlib
+import shutil
+import threading
+import time
+import uuid
+
+
+class WarmContainer:
+    """
+    A single warm container. The container runs pool_worker.py which waits for tasks in a work directory
+    on the mounted volume. This class is used by the pool and not supposed to be used directly.
+
+    """
+    def __init__(self, container, work_dir, container_work_dir, startup_time):
+        self.container = container
+        self.work_dir = work_dir
+        self.container_work_dir = container_work_dir
+        self.startup_time = startup_time
+        self.tasks = 0
+
+    def heartbeat_age(self):
+        try:
+            with open(f"{self.work_dir}/heartbeat", "r") as file:
+                return time.time() - float(file.read())
+        except (OSError, ValueError):
+            return None
+
+
+class WarmContainerPool:
+    """
+    A pool of warm containers per image. Each container is started once with the local directory mounted as /gcs,
+    imports kfp and (if available) torch and then runs one task after the other in the same interpreter. Containers are
+    health checked before each task and recycled after a configurable number of tasks so that state leaking from
+    one component into the next is bounded.
+
+    """
+    def __init__(self, local_dir = "./gcs", max_tasks = 20, preload = ("kfp.dsl.executor", "torch", "numpy"), startup_timeout = 300, heartbeat_timeout = 10):
+        """
+        Initialize the pool
+
+        Args:
+            local_dir : the local directory which is mounted as /gcs into the containers
+            max_tasks : number of tasks after which a container is replaced by a fresh one
+            preload : modules to import when a container starts
+            startup_timeout : seconds to wait until a new container reports to be ready
+            heartbeat_timeout : a container whose worker has not signalled for that many seconds while idle is considered unhealthy
+        """
+        self._local_dir = local_dir
+        self._max_tasks = max_tasks
+        self._preload = list(preload)
+        self._startup_timeout = startup_timeout
+        self._heartbeat_timeout = heartbeat_timeout
+        self._idle = {}
+        self._all = []
+        self._lock = threading.Lock()
+        self._docker_client = docker.from_env()
+        self._pool_dir = f"{local_dir}/.pool"
+        os.makedirs(self._pool_dir, exist_ok = True)
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "pool_worker.py"), f"{self._pool_dir}/pool_worker.py")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def _start_container(self, image, env, limits):
+        name = uuid.uuid4().hex[:12]
+        work_dir = f"{self._pool_dir}/{name}"
+        os.makedirs(work_dir)
+        container_work_dir = f"/gcs/.pool/{name}"
+        #
+        # Images like python:3.9 do not come with KFP, so we install it first
+        # if needed. This happens once per container, not once per step
+        #
+        script = (f"python3 -c 'import kfp' 2>/dev/null || "
+                  f"python3 -m pip install --quiet --no-warn-script-location 'kfp=={kfp.__version__}'; "
+                  f"exec python3 /gcs/.pool/pool_worker.py {container_work_dir} {' '.join(self._preload)}")
+        container = self._docker_client.containers.run(
+            image = image,
+            entrypoint = ["sh", "-c"],
+            command = [script],
+            volumes = [
+                f"{pathlib.Path(self._local_dir).resolve()}:/gcs",
+            ],
+            detach = True,
+            environment = env,
+            **limits
+        )
+        warm_container = WarmContainer(container, work_dir, container_work_dir, startup_time = None)
+        #
+        # Wait until the worker is ready, i.e. has written its first heartbeat
+        #
+        start = time.time()
+        while warm_container.heartbeat_age() is None:
+            container.reload()
+            if container.status not in ("created", "running"):
+                logs = container.logs().decode("utf-8")
+                self._remove(warm_container)
+                raise RuntimeError(f"Warm container for image {image} did not start: {logs}")
+            if time.time() - start > self._startup_timeout:
+                self._remove(warm_container)
+                raise RuntimeError(f"Timeout while waiting for warm container for image {image}")
+            time.sleep(0.1)
+        warm_container.startup_time = time.time() - start
+        print(f"Started warm container {container.short_id} for image {image} after {warm_container.startup_time:.2f} seconds")
+        with self._lock:
+            self._all.append(warm_container)
+        return warm_container
+
+    def _remove(self, warm_container):
+        with self._lock:
+            if warm_container in self._all:
+                self._all.remove(warm_container)
+        try:
+            warm_container.container.remove(force = True)
+        except docker.errors.APIError:
+            pass
+        shutil.rmtree(warm_container.work_dir, ignore_errors = True)
+
+    def is_healthy(self, warm_container):
+        """
+        Check whether an idle container is still usable, i.e. the container is running and the worker
+        has recently written a heartbeat
+
+        Args:
+            warm_container : the container to check
+        """
+        try:
+            warm_container.container.reload()
+        except docker.errors.NotFound:
+            return False
+        if warm_container.container.status != "running":
+            return False
+        age = warm_container.heartbeat_age()
+        return age is not None and age < self._heartbeat_timeout
+
+    def acquire(self, image, env, limits = None):
+        """
+        Get a healthy idle container for an image or start a new one. Containers are only reused
+        for steps with the same environment and the same CPU and memory limits
+
+        Args:
+            image : the image
+            env : the environment of the container
+            limits : optional - additional arguments for containers.run, like nano_cpus and mem_limit
+        """
+        limits = limits or {}
+        key = (image, json.dumps(env, sort_keys = True), json.dumps(limits, sort_keys = True))
+        while True:
+            with self._lock:
+                idle = self._idle.get(key, [])
+                warm_container = idle.pop() if len(idle) > 0 else None
+            if warm_container is None:
+                return key, self._start_container(image, env, limits)
+            if self.is_healthy(warm_container):
+                return key, warm_container
+            print(f"Replacing unhealthy warm container {warm_container.container.short_id}")
+            self._remove(warm_container)
+
+    def release(self, key, warm_container):
+        """
+        Return a container to the pool after a task, recycling it if it has reached the maximum number of tasks
+
+        Args:
+            key : the key returned by acquire
+            warm_container : the container
+        """
+        if warm_container.tasks >= self._max_tasks:
+            self._remove(warm_container)
+            return
+        with self._lock:
+            self._idle.setdefault(key, []).append(warm_container)
+
+    def run(self, image, command, function_name, executor_input, step_name, env = None, limits = None, log = None):
+        """
+        Run a component in a warm container. The output of the component is handed over to the log
+        function while it runs or printed if no log function is provided
+
+        Args:
+            image : the image of the component
+            command : the container command of the component, the last item is the source code
+            function_name : the function to execute
+            executor_input : the executor input
+            step_name : the step name
+            env : the environment of the container
+            limits : optional - the CPU and memory limits of the container as arguments for containers.run
+            log : optional - a function accepting a stream name (stdout or stderr) and a chunk of output as bytes
+
+        Returns:
+            a dictionary with the CPU time used by the task, the peak memory usage of the worker and the time
+            it took to start the container if a new container was started for this task
+        """
+        if log is None:
+            log = lambda stream_name, data: print(data.decode("utf-8", errors = "replace"), end = "")
+        key, warm_container = self.acquire(image, env or {}, limits)
+        task = {
+            "task_id" : uuid.uuid4().hex,
+            "step_name" : step_name,
+            "source" : command[-1],
+            "function_name" : function_name,
+            "executor_input" : executor_input
+        }
+        work_dir = warm_container.work_dir
+        with open(f"{work_dir}/task.json.tmp", "w") as file:
+            json.dump(task, file)
+        os.replace(f"{work_dir}/task.json.tmp", f"{work_dir}/task.json")
+        warm_container.tasks = warm_container.tasks + 1
+        #
+        # Wait for the result and print the log file while we wait
+        #
+        result_file = f"{work_dir}/result.json"
+        log_files = {
+            "stdout" : f"{work_dir}/{step_name}.stdout",
+            "stderr" : f"{work_dir}/{step_name}.stderr"
+        }
+        offsets = { stream_name : 0 for stream_name in log_files.keys() }
+        last_check = time.time()
+        while True:
+            done = os.path.exists(result_file)
+            for stream_name, log_file in log_files.items():
+                if os.path.exists(log_file):
+                    with open(log_file, "rb") as file:
+                        file.seek(offsets[stream_name])
+                        data = file.read()
+                        offsets[stream_name] = offsets[stream_name] + len(data)
+                        if len(data) > 0:
+                            log(stream_name, data)
+            if done:
+                break
+            #
+            # Make sure that the container is still alive, but do not
+            # ask the docker daemon more often than once per second
+            #
+            if time.time() - last_check > 1:
+                last_check = time.time()
+                warm_container.container.reload()
+                if warm_container.container.status != "running":
+                    self._remove(warm_container)
+                    raise RuntimeError(f"Warm container died while running step {step_name}")
+            time.sleep(0.05)
+        with open(result_file, "r") as file:
+            result = json.load(file)
+        os.remove(result_file)
+        for log_file in log_files.values():
+            os.remove(log_file)
+        startup_time = warm_container.startup_time if warm_container.tasks == 1 else 0.0
+        self.release(key, warm_container)
+        assert result['status'] == "ok", f"Step {step_name} failed: {result.get('error')}"
+        return {
+            "cpu_time" : result.get("cpu_time"),
+            "peak_rss" : result.get("peak_rss"),
+            "startup_time" : startup_time
+        }
+
+    def close(self):
+        """
+        Remove all containers of the pool
+        """
+        with self._lock:
+            containers = list(self._all)
+            self._idle = {}
+        for warm_container in containers:
+            self._remove(warm_container)
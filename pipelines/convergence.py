@@ -0,0 +1,137 @@
+#
+# Early stopping and learning rate scheduling for the training loop
+#
+import math
+import torch
+
+#
+# Learning rate schedules that we support
+#
+LR_SCHEDULES = ("none", "plateau", "cosine")
+
+
+def holdout_loss(model, X, Y, batch_size = 65536):
+    """
+    Return the mean binary cross entropy of a model on held-out data
+
+    Args:
+        model : the model
+        X : the features
+        Y : the labels
+        batch_size : the number of rows that we evaluate at a time
+    """
+    model.eval()
+    total = 0.0
+    with torch.inference_mode():
+        for start in range(0, len(Y), batch_size):
+            logits = model(X[start:start + batch_size]).reshape(-1)
+            total += torch.nn.functional.binary_cross_entropy_with_logits(logits, Y[start:start + batch_size], reduction = "sum").item()
+    model.train()
+    return total / len(Y)
+
+
+class ConvergenceMonitor:
+    """
+    Decide after each epoch whether training should continue. Training stops if the monitored loss, either the training
+    loss or the loss on a held-out slice, has not improved by more than min_delta for patience epochs, or if the loss is
+    no longer finite. The monitor also drives the learning rate schedule: with plateau, the learning rate is reduced
+    whenever the loss has not improved for half the patience window, with cosine it follows a cosine curve over all epochs.
+
+    """
+    def __init__(self, optimizer, epochs, patience = 0, min_delta = 1e-4, lr_schedule = "none", lr_factor = 0.5):
+        """
+        Initialize the monitor
+
+        Args:
+            optimizer : the optimizer whose learning rate we schedule
+            epochs : the maximum number of epochs
+            patience : the number of epochs without improvement after which we stop, 0 to never stop early
+            min_delta : the minimum decrease of the loss that counts as improvement
+            lr_schedule : none, plateau or cosine
+            lr_factor : the factor by which the plateau schedule reduces the learning rate
+        """
+        assert lr_schedule in LR_SCHEDULES, f"Unknown learning rate schedule {lr_schedule}"
+        self._epochs = epochs
+        self._patience = patience
+        self._min_delta = min_delta
+        self._scheduler = None
+        if lr_schedule == "plateau":
+            self._scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer,
+                                                                          factor = lr_factor,
+                                                                          patience = max(1, patience // 2),
+                                                                          threshold = min_delta,
+                                                                          threshold_mode = "abs")
+        elif lr_schedule == "cosine":
+            self._scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max = epochs)
+        self._optimizer = optimizer
+        self.best = math.inf
+        self.best_epoch = None
+        self.stopped_epoch = None
+        self.stop_reason = "max_epochs"
+
+    def step(self, epoch, loss):
+        """
+        Record the loss of an epoch and update the learning rate
+
+        Args:
+            epoch : the epoch that has just completed
+            loss : the monitored loss as a float
+
+        Returns:
+            True if training should stop
+        """
+        self.stopped_epoch = epoch
+        if not math.isfinite(loss):
+            self.stop_reason = "non_finite_loss"
+            return True
+        if loss < self.best - self._min_delta:
+            self.best = loss
+            self.best_epoch = epoch
+        if isinstance(self._scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+            self._scheduler.step(loss)
+        elif self._scheduler is not None:
+            self._scheduler.step()
+        if self._patience > 0 and epoch - self.best_epoch >= self._patience:
+            self.stop_reason = "no_improvement"
+            return True
+        return False
+
+    @property
+    def lr(self):
+        return self._optimizer.param_groups[0]['lr']
+
+    def state_dict(self):
+        """
+        Return the state of the monitor so that it can be saved with a checkpoint
+        """
+        return {
+            "best" : self.best,
+            "best_epoch" : self.best_epoch,
+            "scheduler" : self._scheduler.state_dict() if self._scheduler is not None else None
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restore the state from a checkpoint
+
+        Args:
+            state : a dictionary returned by state_dict
+        """
+        self.best = state['best']
+        self.best_epoch = state['best_epoch']
+        if self._scheduler is not None and state['scheduler'] is not None:
+            self._scheduler.load_state_dict(state['scheduler'])
+
+    def log(self, metrics):
+        """
+        Record why and when training stopped in a Metrics artifact
+
+        Args:
+            metrics : the Metrics artifact
+        """
+        metrics.log_metric("stopped_epoch", self.stopped_epoch + 1 if self.stopped_epoch is not None else 0)
+        if self.best_epoch is not None:
+            metrics.log_metric("best_epoch", self.best_epoch + 1)
+            metrics.log_metric("best_loss", self.best)
+        metrics.log_metric("final_lr", self.lr)
+        metrics.metadata['stop_reason'] = self.stop_reason
@@ -0,0 +1,478 @@
+#
+# Run a compiled pipeline (the YAML file written by compiler.Compiler().compile) locally. The
+# dependency graph is derived from the artifact and parameter wiring in the pipeline spec, and
+# all tasks whose upstream tasks have completed are run concurrently on a bounded thread pool
+#
+import concurrent.futures
+import json
+import re
+import threading
+import time
+import yaml
+
+from component_runner import StepOutput
+from step_resources import ResourceScheduler, get_resources_from_container_spec
+
+
+#
+# Placeholders that the Vertex AI backend would resolve at runtime
+#
+PIPELINE_JOB_NAME_PLACEHOLDER = "{{$.pipeline_job_name}}"
+PIPELINE_JOB_RESOURCE_NAME_PLACEHOLDER = "{{$.pipeline_job_resource_name}}"
+PIPELINE_JOB_ID_PLACEHOLDER = "{{$.pipeline_job_uuid}}"
+
+
+def load_function_from_executor(container_spec, function_name):
+    """
+    Compile the component source code which the KFP compiler embeds as last element of the
+    container command and return the function that the executor is supposed to run
+
+    Args:
+        container_spec : the container section of an executor in the deployment spec
+        function_name : the name of the function to execute
+    """
+    source = container_spec['command'][-1]
+    namespace = { "__name__" : f"ephemeral_{function_name}" }
+    exec(compile(source, f"<{function_name}>", "exec"), namespace)
+    return namespace[function_name]
+
+
+def apply_selector(value, selector):
+    """
+    Apply a parameter expression selector like parseJson(string_value)["lr"], which the compiler uses
+    to access a field of a loop item, to a value
+
+    Args:
+        value : the value, either a JSON string or already parsed
+        selector : the selector
+    """
+    match = re.fullmatch(r"parseJson\(string_value\)((\[\"[^\"]*\"\])+)", selector)
+    assert match is not None, f"Unsupported parameter expression selector {selector}"
+    if isinstance(value, str):
+        value = json.loads(value)
+    for key in re.findall(r"\[\"([^\"]*)\"\]", match.group(1)):
+        value = value[key]
+    return value
+
+
+def get_function_name(container_spec):
+    """
+    Get the name of the function to execute from the container arguments
+
+    Args:
+        container_spec : the container section of an executor in the deployment spec
+    """
+    args = container_spec['args']
+    return args[args.index("--function_to_execute") + 1]
+
+
+class PipelineRunner:
+    """
+    Run all tasks of a compiled pipeline using a ComponentRunner. Tasks are scheduled as soon
+    as all tasks they depend on have completed, so that a pipeline with fan-out completes in the
+    time of the critical path, not in the sum of the step times.
+
+    Tasks which run a sub-DAG, like the body of a dsl.ParallelFor loop, are run by running the DAG of
+    the component once, or once per item for a loop. All iterations of a loop run concurrently and the outputs
+    of the iterations are collected into lists, which is what dsl.Collected hands over to downstream tasks.
+
+    Tasks are only started if the cores and memory they request (set_cpu_limit, set_memory_limit and the
+    corresponding requests) are still available, and the limits are enforced while the task runs.
+
+    """
+    def __init__(self, runner, package_path = "my-pipeline.yaml", max_workers = 4, verbose = False, key_json = None, cpus = None, memory = None):
+        """
+        Initialize a pipeline runner
+
+        Args:
+            runner : the ComponentRunner used to run individual steps, needs to be entered already
+            package_path : the compiled pipeline
+            max_workers : the maximum number of steps that we run at the same time, across all (sub-)DAGs
+            verbose : set this to True to collect extra output
+            key_json : optional - full path of a service account key JSON file that we will use
+            cpus : the number of cores available for tasks, defaults to all cores
+            memory : the memory available for tasks in bytes, defaults to the physical memory
+        """
+        self._runner = runner
+        self._max_workers = max_workers
+        self._verbose = verbose
+        self._key_json = key_json
+        with open(package_path, "r") as file:
+            self._pipeline_spec = yaml.safe_load(file)
+        self._components = self._pipeline_spec['components']
+        self._executors = self._pipeline_spec['deploymentSpec']['executors']
+        self._functions = {}
+        self._scheduler = ResourceScheduler(cpus = cpus, memory = memory)
+        self._slots = threading.Semaphore(max_workers)
+
+    def get_resources(self, task_spec):
+        """
+        Return the StepResources of a task
+
+        Args:
+            task_spec : the specification of the task in the DAG
+        """
+        component_spec = self._components[task_spec['componentRef']['name']]
+        container_spec = self._executors[component_spec['executorLabel']]['container']
+        return get_resources_from_container_spec(container_spec)
+
+    def get_dependencies(self, tasks):
+        """
+        Build the dependency graph for a DAG. For each task, we return the set of tasks
+        that need to complete before the task can start
+
+        Args:
+            tasks : the tasks section of a DAG in the pipeline spec
+        """
+        dependencies = {}
+        for task_name, task_spec in tasks.items():
+            upstream = set(task_spec.get("dependentTasks", []))
+            inputs = task_spec.get("inputs", {})
+            for artifact_spec in inputs.get("artifacts", {}).values():
+                if "taskOutputArtifact" in artifact_spec:
+                    upstream.add(artifact_spec['taskOutputArtifact']['producerTask'])
+            for param_spec in inputs.get("parameters", {}).values():
+                if "taskOutputParameter" in param_spec:
+                    upstream.add(param_spec['taskOutputParameter']['producerTask'])
+            unknown = upstream - set(tasks.keys())
+            assert len(unknown) == 0, f"Task {task_name} depends on unknown tasks {unknown}"
+            dependencies[task_name] = upstream
+        return dependencies
+
+    def resolve_parameter(self, param_spec, pipeline_inputs, step_outputs):
+        """
+        Determine the value of an input parameter of a task
+
+        Args:
+            param_spec : the specification of the parameter in the inputs section of the task
+            pipeline_inputs : the input parameters of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        if "componentInputParameter" in param_spec:
+            value = pipeline_inputs.get(param_spec['componentInputParameter'])
+            if "parameterExpressionSelector" in param_spec and value is not None:
+                value = apply_selector(value, param_spec['parameterExpressionSelector'])
+            return value
+        if "taskOutputParameter" in param_spec:
+            producer = param_spec['taskOutputParameter']['producerTask']
+            key = param_spec['taskOutputParameter']['outputParameterKey']
+            return step_outputs[producer].parameters.get(key)
+        if "runtimeValue" in param_spec:
+            value = param_spec['runtimeValue']['constant']
+            if isinstance(value, str):
+                value = value.replace(PIPELINE_JOB_NAME_PLACEHOLDER, self._job_name)
+                value = value.replace(PIPELINE_JOB_RESOURCE_NAME_PLACEHOLDER, self._job_name)
+                value = value.replace(PIPELINE_JOB_ID_PLACEHOLDER, self._job_name)
+            return value
+        raise ValueError(f"Unsupported parameter specification {param_spec}")
+
+    def resolve_artifact(self, artifact_spec, dag_artifacts, step_outputs):
+        """
+        Determine the artifacts for an input artifact of a task
+
+        Args:
+            artifact_spec : the specification of the artifact in the inputs section of the task
+            dag_artifacts : the input artifacts of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        if "componentInputArtifact" in artifact_spec:
+            return dag_artifacts[artifact_spec['componentInputArtifact']]
+        producer = artifact_spec['taskOutputArtifact']['producerTask']
+        key = artifact_spec['taskOutputArtifact']['outputArtifactKey']
+        return step_outputs[producer].outputs[key]
+
+    def build_executor_input(self, step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs):
+        """
+        Assemble the executor input for a task from the pipeline spec, using the outputs of
+        the tasks that have already completed
+
+        Args:
+            step_name : the step name of the task
+            task_spec : the specification of the task in the DAG
+            pipeline_inputs : the input parameters of the enclosing DAG
+            dag_artifacts : the input artifacts of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        component_spec = self._components[task_spec['componentRef']['name']]
+        inputs = task_spec.get("inputs", {})
+        parameter_values = {}
+        for param_name, param_spec in inputs.get("parameters", {}).items():
+            value = self.resolve_parameter(param_spec, pipeline_inputs, step_outputs)
+            #
+            # Parameters which are not set are left out so that the executor
+            # uses the default of the component function
+            #
+            if value is not None:
+                parameter_values[param_name] = value
+        input_artifacts = {}
+        for artifact_name, artifact_spec in inputs.get("artifacts", {}).items():
+            input_artifacts[artifact_name] = self.resolve_artifact(artifact_spec, dag_artifacts, step_outputs)
+        output_artifacts = {}
+        output_definitions = component_spec.get("outputDefinitions", {})
+        for artifact_name, artifact_spec in output_definitions.get("artifacts", {}).items():
+            output_artifacts[artifact_name] = {
+                "artifacts" : [
+                    self._runner.create_runtime_artifact(
+                        artifact_name = artifact_name,
+                        step_name = step_name,
+                        schema_title = artifact_spec['artifactType']['schemaTitle'])
+                ]
+            }
+        executor_input = {
+            "inputs" : {
+                "parameterValues" : parameter_values,
+            },
+            "outputs" : {
+                "outputFile" : self._runner.get_output_file(step_name, in_container = not self._runner._no_container)
+            }
+        }
+        if len(input_artifacts.keys()) > 0:
+            executor_input['inputs']['artifacts'] = input_artifacts
+        if len(output_artifacts.keys()) > 0:
+            executor_input['outputs']['artifacts'] = output_artifacts
+        return executor_input
+
+    def run_task(self, step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs):
+        """
+        Run a single task of the pipeline and return its StepOutput. The task waits until one of the
+        max_workers slots and the cores and memory that it requests are available
+
+        Args:
+            step_name : the step name, i.e. the name of the task prefixed by the names of the enclosing loops
+            task_spec : the specification of the task in the DAG
+            pipeline_inputs : the input parameters of the enclosing DAG
+            dag_artifacts : the input artifacts of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        component_spec = self._components[task_spec['componentRef']['name']]
+        executor_label = component_spec['executorLabel']
+        container_spec = self._executors[executor_label]['container']
+        function_name = get_function_name(container_spec)
+        if self._runner._no_container and executor_label not in self._functions:
+            self._functions[executor_label] = load_function_from_executor(container_spec, function_name)
+        executor_input = self.build_executor_input(step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs)
+        resources = self.get_resources(task_spec)
+        with self._slots, self._scheduler.reserve(resources):
+            print(f"Starting task {step_name}")
+            start = time.time()
+            step_output = self._runner.execute(executor_input = executor_input,
+                                               step_name = step_name,
+                                               function_to_execute = self._functions.get(executor_label),
+                                               image = container_spec['image'],
+                                               command = container_spec['command'],
+                                               function_name = function_name,
+                                               verbose = self._verbose,
+                                               key_json = self._key_json,
+                                               resources = resources,
+                                               use_cache = task_spec.get("cachingOptions", {}).get("enableCache", True))
+            print(f"Task {step_name} completed after {time.time() - start:.2f} seconds")
+        return step_output
+
+    def get_loop_items(self, task_spec, dag_inputs):
+        """
+        Return the items of a loop task as a list
+
+        Args:
+            task_spec : the specification of the loop task
+            dag_inputs : the input parameters of the sub-DAG
+        """
+        items_spec = task_spec['parameterIterator']['items']
+        if "raw" in items_spec:
+            items = items_spec['raw']
+        else:
+            items = dag_inputs[items_spec['inputParameter']]
+        if isinstance(items, str):
+            items = json.loads(items)
+        return items
+
+    def collect_outputs(self, dag_spec, runs, iterated):
+        """
+        Build the StepOutput of a sub-DAG from the outputs of its tasks. For a loop, each output is a list with
+        the values of all iterations, in the order of the loop items
+
+        Args:
+            dag_spec : the dag section of the component
+            runs : for each run of the sub-DAG, a dictionary mapping task names to StepOutput instances
+            iterated : True if the sub-DAG is the body of a loop
+        """
+        dag_outputs = dag_spec.get("outputs", {})
+        outputs = {}
+        for name, output_spec in dag_outputs.get("artifacts", {}).items():
+            artifacts = []
+            for step_outputs in runs:
+                for selector in output_spec['artifactSelectors']:
+                    producer = step_outputs[selector['producerSubtask']]
+                    artifacts.extend(producer.outputs[selector['outputArtifactKey']]['artifacts'])
+            outputs[name] = { "artifacts" : artifacts }
+        parameters = {}
+        for name, output_spec in dag_outputs.get("parameters", {}).items():
+            selector = output_spec['valueFromParameter']
+            values = [step_outputs[selector['producerSubtask']].parameters.get(selector['outputParameterKey']) for step_outputs in runs]
+            parameters[name] = values if iterated else values[0]
+        return StepOutput(outputs = outputs, parameters = parameters)
+
+    def run_sub_dag(self, step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs):
+        """
+        Run a task whose component is a DAG, once or, if the task has a parameter iterator, once per loop item
+
+        Args:
+            step_name : the step name of the task, used as prefix for the step names of the tasks in the sub-DAG
+            task_spec : the specification of the task in the DAG
+            pipeline_inputs : the input parameters of the enclosing DAG
+            dag_artifacts : the input artifacts of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        dag_spec = self._components[task_spec['componentRef']['name']]['dag']
+        inputs = task_spec.get("inputs", {})
+        dag_inputs = {
+            name : self.resolve_parameter(param_spec, pipeline_inputs, step_outputs)
+                for name, param_spec in inputs.get("parameters", {}).items()
+        }
+        sub_dag_artifacts = {
+            name : self.resolve_artifact(artifact_spec, dag_artifacts, step_outputs)
+                for name, artifact_spec in inputs.get("artifacts", {}).items()
+        }
+        if "parameterIterator" not in task_spec:
+            runs = [self.run_dag(dag_spec['tasks'], dag_inputs, sub_dag_artifacts, prefix = f"{step_name}-")]
+            return self.collect_outputs(dag_spec, runs, iterated = False)
+        items = self.get_loop_items(task_spec, dag_inputs)
+        item_input = task_spec['parameterIterator']['itemInput']
+        parallelism = task_spec.get("iteratorPolicy", {}).get("parallelismLimit", 0) or len(items)
+        print(f"Running {len(items)} iterations of {step_name}")
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, parallelism)) as pool:
+            futures = [pool.submit(self.run_dag, dag_spec['tasks'], { **dag_inputs, item_input : item }, sub_dag_artifacts, f"{step_name}-{index}-")
+                          for index, item in enumerate(items)]
+            runs = [future.result() for future in futures]
+        return self.collect_outputs(dag_spec, runs, iterated = True)
+
+    def run_importer(self, step_name, task_spec, pipeline_inputs, step_outputs):
+        """
+        Run a task created by dsl.importer, which does not execute anything but turns a URI into an
+        artifact. The URI is either a constant or, more commonly, a parameter of the task
+
+        Args:
+            step_name : the step name of the task
+            task_spec : the specification of the task in the DAG
+            pipeline_inputs : the input parameters of the enclosing DAG
+            step_outputs : the StepOutput instances of all tasks completed so far
+        """
+        component_spec = self._components[task_spec['componentRef']['name']]
+        importer_spec = self._executors[component_spec['executorLabel']]['importer']
+        uri_spec = importer_spec['artifactUri']
+        if "runtimeParameter" in uri_spec:
+            param_spec = task_spec['inputs']['parameters'][uri_spec['runtimeParameter']]
+            uri = self.resolve_parameter(param_spec, pipeline_inputs, step_outputs)
+        elif "constant" in uri_spec:
+            uri = uri_spec['constant']
+        else:
+            uri = uri_spec['constantValue']['stringValue']
+        print(f"Importing {uri} in task {step_name}")
+        artifact = {
+            "name" : "artifact",
+            "metadata" : importer_spec.get("metadata", {}),
+            "type" : {
+                "schemaTitle" : importer_spec['typeSchema']['schemaTitle']
+            },
+            "uri" : uri
+        }
+        return StepOutput(outputs = { "artifact" : { "artifacts" : [artifact] } }, parameters = {})
+
+    def run_any_task(self, step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs):
+        """
+        Run a task of a DAG, either a container step, an importer or a sub-DAG, and return its StepOutput
+        """
+        component_spec = self._components[task_spec['componentRef']['name']]
+        if "dag" in component_spec:
+            return self.run_sub_dag(step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs)
+        if "importer" in self._executors[component_spec['executorLabel']]:
+            return self.run_importer(step_name, task_spec, pipeline_inputs, step_outputs)
+        return self.run_task(step_name, task_spec, pipeline_inputs, dag_artifacts, step_outputs)
+
+    def run_dag(self, tasks, pipeline_inputs, dag_artifacts = None, prefix = ""):
+        """
+        Run all tasks in a DAG. A task is submitted to the pool as soon as all its upstream
+        tasks have completed. If a task fails, no new tasks are started, but we wait for the
+        running tasks to complete before we raise the error
+
+        Args:
+            tasks : the tasks section of a DAG in the pipeline spec
+            pipeline_inputs : the input parameters of the DAG
+            dag_artifacts : optional - the input artifacts of the DAG
+            prefix : the prefix for the step names of the tasks in the DAG
+
+        Returns:
+            a dictionary mapping task names to StepOutput instances
+        """
+        dependencies = self.get_dependencies(tasks)
+        step_outputs = {}
+        pending = { task_name : set(upstream) for task_name, upstream in dependencies.items() }
+        running = {}
+        error = None
+        #
+        # The number of steps running at the same time is limited in run_task, so that the
+        # limit also holds for the tasks of sub-DAGs which run on their own pools
+        #
+        with concurrent.futures.ThreadPoolExecutor(max_workers = max(1, len(tasks))) as pool:
+            while True:
+                #
+                # Submit all tasks which are ready
+                #
+                if error is None:
+                    ready = [task_name for task_name, upstream in pending.items() if len(upstream) == 0]
+                    for task_name in ready:
+                        del pending[task_name]
+                        future = pool.submit(self.run_any_task, f"{prefix}{task_name}", tasks[task_name], pipeline_inputs, dag_artifacts or {}, step_outputs)
+                        running[future] = task_name
+                if len(running) == 0:
+                    break
+                done, _ = concurrent.futures.wait(running.keys(), return_when = concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    task_name = running.pop(future)
+                    if future.exception() is not None:
+                        print(f"Task {task_name} failed: {future.exception()}")
+                        error = error or future.exception()
+                        continue
+                    step_outputs[task_name] = future.result()
+                    for upstream in pending.values():
+                        upstream.discard(task_name)
+        if error is not None:
+            raise error
+        assert len(pending) == 0, f"Could not schedule tasks {list(pending.keys())}, is there a cycle?"
+        return step_outputs
+
+    def get_pipeline_inputs(self, parameter_values):
+        """
+        Merge the provided parameter values with the defaults from the pipeline spec
+
+        Args:
+            parameter_values : a dictionary of pipeline parameters
+        """
+        pipeline_inputs = {}
+        input_definitions = self._pipeline_spec['root'].get("inputDefinitions", {})
+        for param_name, param_spec in input_definitions.get("parameters", {}).items():
+            if param_name in parameter_values and parameter_values[param_name] is not None:
+                pipeline_inputs[param_name] = parameter_values[param_name]
+            elif "defaultValue" in param_spec:
+                pipeline_inputs[param_name] = param_spec['defaultValue']
+            else:
+                assert param_spec.get("isOptional", False), f"No value for required pipeline parameter {param_name}"
+        return pipeline_inputs
+
+    def run(self, parameter_values, job_name = None):
+        """
+        Run the pipeline
+
+        Args:
+            parameter_values : a dictionary of pipeline parameters
+            job_name : the job name that we use to resolve the pipeline job name placeholder
+
+        Returns:
+            a dictionary mapping task names to StepOutput instances
+        """
+        pipeline_name = self._pipeline_spec['pipelineInfo']['name']
+        self._job_name = job_name or f"{pipeline_name}-{time.strftime('%Y%m%d%H%M%S', time.localtime())}"
+        start = time.time()
+        step_outputs = self.run_dag(tasks = self._pipeline_spec['root']['dag']['tasks'],
+                                    pipeline_inputs = self.get_pipeline_inputs(parameter_values))
+        print(f"Pipeline {self._job_name} completed after {time.time() - start:.2f} seconds")
+        return step_outputs
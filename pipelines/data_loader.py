@@ -0,0 +1,221 @@
+#
+# A streaming mini-batch loader for datasets in the format of dataset_io.py
+#
+import copy
+import queue
+import threading
+import numpy as np
+
+import dataset_io
+
+#
+# Marks the end of an epoch in the queue
+#
+_END = object()
+
+
+class StreamingLoader:
+    """
+    Iterate over a dataset on disk in mini-batches. A background thread reads the dataset shard by shard from the
+    memory mapped column files and places batches in a bounded queue, so reading the next shard overlaps with the
+    training on the current batches and at most a few shards are in memory at any time.
+
+    Shuffling is done in two stages: the order of the shards is shuffled per epoch, and the rows pass through a
+    shuffle buffer of a configurable size from which batches are drawn at random. A larger buffer gives a better
+    approximation of a full shuffle at the cost of memory.
+
+    The position within an epoch can be saved with state_dict and restored with load_state_dict, so that a training
+    which resumes from a checkpoint taken within an epoch continues with the same batches in the same order.
+
+    """
+    def __init__(self, path, batch_size, shard_size = 2**20, shuffle_buffer = 0, prefetch = 8, seed = None, start = 0, stop = None):
+        """
+        Initialize the loader
+
+        Args:
+            path : the dataset directory
+            batch_size : the number of rows per batch
+            shard_size : the number of rows that the background thread reads at a time
+            shuffle_buffer : the number of rows in the shuffle buffer, 0 to read the data in order
+            prefetch : the maximum number of batches that are waiting in the queue
+            seed : optional - the seed for shuffling
+            start : the first row of the dataset that we use
+            stop : optional - the row after the last row of the dataset that we use
+        """
+        self._columns = { name : column[start:stop] for name, column in dataset_io.load_columns(path).items() }
+        self.rows = len(self._columns['labels'])
+        self.batch_size = batch_size
+        self._shard_size = shard_size
+        self._shuffle_buffer = shuffle_buffer
+        self._prefetch = prefetch
+        self._rng = np.random.default_rng(seed)
+        #
+        # The state of the random number generator at the start of the current epoch,
+        # the number of batches of that epoch which have been handed out and the number
+        # of batches that we skip in the next epoch as they have been trained on before
+        #
+        self._epoch_rng_state = copy.deepcopy(self._rng.bit_generator.state)
+        self.position = 0
+        self._skip = 0
+
+    def __len__(self):
+        return (self.rows + self.batch_size - 1) // self.batch_size
+
+    def _shards(self):
+        starts = np.arange(0, self.rows, self._shard_size)
+        if self._shuffle_buffer > 0:
+            self._rng.shuffle(starts)
+        for start in starts:
+            #
+            # np.array copies the slice, which makes the reader thread pay for
+            # the page faults instead of the training loop
+            #
+            yield (np.array(self._columns['features'][start:start + self._shard_size]),
+                   np.array(self._columns['labels'][start:start + self._shard_size]))
+
+    def state_dict(self):
+        """
+        Return the position of the loader, i.e. the state of the random number generator at the start of the
+        current epoch and the number of batches of this epoch which have been handed out
+        """
+        return { "rng" : copy.deepcopy(self._epoch_rng_state), "position" : self.position }
+
+    def load_state_dict(self, state):
+        """
+        Restore a position saved with state_dict, the next epoch starts with the first batch after this position
+
+        Args:
+            state : the position
+        """
+        self._rng.bit_generator.state = copy.deepcopy(state['rng'])
+        self._epoch_rng_state = copy.deepcopy(state['rng'])
+        self._skip = state['position']
+
+    def _read(self, batches, stop, skip):
+        #
+        # The first skip batches are drawn, so that the random number generator
+        # advances as before, but not handed out
+        #
+        def put(batch):
+            nonlocal skip
+            if skip > 0:
+                skip = skip - 1
+            else:
+                batches.put(batch)
+        try:
+            X = np.empty((0, *self._columns['features'].shape[1:]), dtype = self._columns['features'].dtype)
+            Y = np.empty((0, ), dtype = self._columns['labels'].dtype)
+            for shard_X, shard_Y in self._shards():
+                X = np.concatenate([X, shard_X])
+                Y = np.concatenate([Y, shard_Y])
+                #
+                # Keep at least shuffle_buffer rows in the buffer and hand
+                # out random batches from it
+                #
+                if len(Y) < self._shuffle_buffer + self.batch_size:
+                    continue
+                X, Y = self._permute(X, Y)
+                count = (len(Y) - self._shuffle_buffer) // self.batch_size * self.batch_size
+                for start in range(0, count, self.batch_size):
+                    if stop.is_set():
+                        return
+                    put((X[start:start + self.batch_size], Y[start:start + self.batch_size]))
+                X, Y = X[count:], Y[count:]
+            X, Y = self._permute(X, Y)
+            for start in range(0, len(Y), self.batch_size):
+                if stop.is_set():
+                    return
+                put((X[start:start + self.batch_size], Y[start:start + self.batch_size]))
+            batches.put(_END)
+        except BaseException as e:
+            batches.put(e)
+
+    def _permute(self, X, Y):
+        if self._shuffle_buffer == 0:
+            return X, Y
+        permutation = self._rng.permutation(len(Y))
+        return X[permutation], Y[permutation]
+
+    def __iter__(self):
+        """
+        Iterate over the batches of one epoch
+
+        Yields:
+            features and labels of a batch as tensors
+        """
+        import torch
+        batches = queue.Queue(maxsize = self._prefetch)
+        stop = threading.Event()
+        #
+        # The reader advances the random number generator, so we take its state before we start it
+        #
+        self._epoch_rng_state = copy.deepcopy(self._rng.bit_generator.state)
+        self.position = self._skip
+        reader = threading.Thread(target = self._read, args = (batches, stop, self._skip), daemon = True)
+        self._skip = 0
+        reader.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is _END:
+                    #
+                    # The next epoch starts from the beginning
+                    #
+                    self._epoch_rng_state = copy.deepcopy(self._rng.bit_generator.state)
+                    self.position = 0
+                    break
+                if isinstance(batch, BaseException):
+                    raise batch
+                self.position = self.position + 1
+                yield torch.from_numpy(batch[0]), torch.from_numpy(batch[1])
+        finally:
+            #
+            # If the consumer stops early, make sure that the reader
+            # is not blocked on a full queue forever
+            #
+            stop.set()
+            while reader.is_alive():
+                try:
+                    batches.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+
+
+class TensorLoader:
+    """
+    Iterate over features and labels which are already in memory in mini-batches, shuffled once per epoch
+
+    """
+    def __init__(self, X, Y, batch_size, shuffle = True, seed = None):
+        """
+        Initialize the loader
+
+        Args:
+            X : the features as a tensor
+            Y : the labels as a tensor
+            batch_size : the number of rows per batch
+            shuffle : draw the batches in a different random order in each epoch
+            seed : optional - the seed for shuffling
+        """
+        import torch
+        self._X = X
+        self._Y = Y
+        self.rows = len(Y)
+        self.batch_size = batch_size
+        self._shuffle = shuffle
+        self._generator = torch.Generator()
+        if seed is not None:
+            self._generator.manual_seed(seed)
+
+    def __len__(self):
+        return (self.rows + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        import torch
+        if self._shuffle:
+            permutation = torch.randperm(self.rows, generator = self._generator)
+            X, Y = self._X[permutation], self._Y[permutation]
+        else:
+            X, Y = self._X, self._Y
+        for start in range(0, self.rows, self.batch_size):
+            yield X[start:start + self.batch_size], Y[start:start + self.batch_size]
@@ -0,0 +1,177 @@
+#
+# Read and write datasets as a directory of .npy column files which can be memory mapped
+#
+# A dataset directory contains one file per column and a schema file:
+#
+# features.npy    float32, shape (rows, 2)
+# labels.npy      float32, shape (rows)
+# schema.json     rows and dtype and shape of each column
+#
+# The .npy header is padded so that the data starts at an aligned offset, so a consumer
+# can map the file and create a tensor on top of the mapped buffer without a copy
+#
+import json
+import os
+import numpy as np
+
+FORMAT = "npy-columns"
+
+#
+# Number of rows that we copy at a time when merging datasets
+#
+COPY_ROWS = 2**20
+
+#
+# Columns of our dataset and the shape of a single row of each column
+#
+SCHEMA = {
+    "features" : (2, ),
+    "labels" : ()
+}
+
+
+class DatasetWriter:
+    """
+    Write a dataset with a known number of rows chunk by chunk. The column files are created with their final
+    size up front and filled through a memory map, so the memory used does not depend on the size of the dataset.
+
+    """
+    def __init__(self, path, rows, schema = SCHEMA, dtype = np.float32):
+        """
+        Create the dataset directory and the column files
+
+        Args:
+            path : the directory, usually the path of a Dataset artifact
+            rows : the overall number of rows
+            schema : a dictionary mapping column names to the shape of a single row
+            dtype : the data type of all columns
+        """
+        self.path = path
+        self.rows = rows
+        self._position = 0
+        self._schema = schema
+        os.makedirs(path, exist_ok = True)
+        self._columns = {
+            name : np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode = "w+", dtype = dtype, shape = (rows, *shape))
+                for name, shape in schema.items()
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def write(self, *chunks):
+        """
+        Append a chunk of rows
+
+        Args:
+            chunks : one array per column, in the order of the schema
+        """
+        rows = len(chunks[0])
+        assert self._position + rows <= self.rows, f"Dataset {self.path} has only {self.rows} rows"
+        for column, chunk in zip(self._columns.values(), chunks):
+            assert len(chunk) == rows, "All columns of a chunk need to have the same number of rows"
+            column[self._position:self._position + rows] = chunk
+        self._position = self._position + rows
+
+    def close(self):
+        """
+        Flush the column files and write the schema
+        """
+        assert self._position == self.rows, f"Only {self._position} of {self.rows} rows written to {self.path}"
+        for column in self._columns.values():
+            column.flush()
+        self._columns = {}
+        with open(os.path.join(self.path, "schema.json"), "w") as file:
+            json.dump(get_metadata(self.path, rows = self.rows, schema = self._schema), file)
+
+
+def get_metadata(path, rows = None, schema = None):
+    """
+    Return the metadata that we attach to a Dataset artifact, i.e. the format, the number of rows
+    and the schema. If rows and schema are not given, they are read from the dataset directory
+
+    Args:
+        path : the dataset directory
+        rows : optional - the number of rows
+        schema : optional - a dictionary mapping column names to the shape of a single row
+    """
+    if rows is None or schema is None:
+        with open(os.path.join(path, "schema.json"), "r") as file:
+            return json.load(file)
+    return {
+        "format" : FORMAT,
+        "rows" : rows,
+        "schema" : { name : { "dtype" : "float32", "shape" : list(shape) } for name, shape in schema.items() }
+    }
+
+
+def load_columns(path):
+    """
+    Map all columns of a dataset into memory and return a dictionary of numpy arrays. The
+    arrays are copy-on-write, i.e. they can be modified without changing the files
+
+    Args:
+        path : the dataset directory
+    """
+    metadata = get_metadata(path)
+    assert metadata['format'] == FORMAT, f"Unsupported dataset format {metadata['format']}"
+    columns = {}
+    for name in metadata['schema'].keys():
+        columns[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode = "c")
+        assert len(columns[name]) == metadata['rows'], f"Column {name} in {path} does not have {metadata['rows']} rows"
+    return columns
+
+
+def load_dataset(path):
+    """
+    Return features and labels of a dataset as tensors which share the memory mapped buffer, so that
+    the data is only read from disk when it is accessed
+
+    Args:
+        path : the dataset directory
+    """
+    import torch
+    columns = load_columns(path)
+    return torch.from_numpy(columns['features']), torch.from_numpy(columns['labels'])
+
+
+def merge_datasets(paths, path):
+    """
+    Concatenate datasets with the same schema into a new dataset, copying a bounded number of
+    rows at a time
+
+    Args:
+        paths : the directories of the datasets to merge, in the order in which they are concatenated
+        path : the directory of the merged dataset
+    """
+    datasets = [load_columns(p) for p in paths]
+    rows = sum(len(columns['labels']) for columns in datasets)
+    with DatasetWriter(path, rows = rows) as writer:
+        for columns in datasets:
+            for start in range(0, len(columns['labels']), COPY_ROWS):
+                writer.write(*[column[start:start + COPY_ROWS] for column in columns.values()])
+    return rows
+
+
+def sample_rows(path, rows, seed = None):
+    """
+    Read a uniform random sample of rows of a dataset without replacement. The sample is read in the order of
+    the rows, so that the reads from the memory mapped files move forward only
+
+    Args:
+        path : the dataset directory
+        rows : the number of rows in the sample, if the dataset has fewer rows we return all of them
+        seed : optional - the seed of the random number generator
+
+    Returns:
+        a dictionary mapping column names to numpy arrays
+    """
+    columns = load_columns(path)
+    available = len(columns['labels'])
+    indices = np.sort(np.random.default_rng(seed).choice(available, size = min(rows, available), replace = False))
+    return { name : column[indices] for name, column in columns.items() }
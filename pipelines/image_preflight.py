@@ -0,0 +1,131 @@
+#
+# Pull all images needed by a local run up front and pin them by digest
+#
+import concurrent.futures
+import docker
+import time
+import yaml
+
+
+def get_images_from_components(components):
+    """
+    Return the set of images used by a list of components
+
+    Args:
+        components : a list of PythonComponent instances
+    """
+    return sorted({ comp.component_spec.implementation.container.image for comp in components })
+
+
+def get_images_from_pipeline_spec(package_path):
+    """
+    Return the set of images used by the executors of a compiled pipeline
+
+    Args:
+        package_path : the compiled pipeline (YAML)
+    """
+    with open(package_path, "r") as file:
+        pipeline_spec = yaml.safe_load(file)
+    executors = pipeline_spec['deploymentSpec']['executors']
+    return sorted({ e['container']['image'] for e in executors.values() if "container" in e })
+
+
+def get_repository(image):
+    """
+    Strip tag and digest from an image reference, taking into account that the registry
+    part can contain a port, as in localhost:5000/pipeline:latest
+
+    Args:
+        image : the image reference
+    """
+    name = image.split("@")[0]
+    last = name.rsplit("/", 1)[-1]
+    if ":" in last:
+        name = name[:len(name) - len(last)] + last.split(":")[0]
+    return name
+
+
+class ImagePreflight:
+    """
+    Pull a set of images in parallel before a run starts and resolve each image to an immutable reference,
+    so that the steps of a run do not wait for an implicit pull and all steps that use the same tag run
+    the same image even if the tag is moved while the run is in progress.
+
+    Images are pinned by their repository digest (repo@sha256:...) if they have one. Images which only exist
+    locally, like images that we have built but not pushed, are pinned by their image ID.
+
+    """
+    def __init__(self, max_workers = 4, pull = "missing"):
+        """
+        Initialize the preflight stage
+
+        Args:
+            max_workers : the number of images that we pull at the same time
+            pull : always to pull all images, missing to only pull images that are not present locally
+        """
+        assert pull in ("always", "missing"), f"Invalid pull policy {pull}"
+        self._max_workers = max_workers
+        self._pull = pull
+        self._docker_client = docker.from_env()
+        self.pull_times = {}
+        self.pins = {}
+
+    def _resolve(self, image):
+        start = time.time()
+        local_image = None
+        try:
+            local_image = self._docker_client.images.get(image)
+        except docker.errors.ImageNotFound:
+            pass
+        if local_image is None or self._pull == "always":
+            try:
+                local_image = self._docker_client.images.pull(image)
+            except docker.errors.APIError as e:
+                #
+                # An image which we have built locally can usually not be pulled
+                #
+                if local_image is None:
+                    raise
+                print(f"Could not pull {image}, using local image ({e.explanation})")
+        pull_time = time.time() - start
+        #
+        # RepoDigests has one entry per repository, we use the one matching the
+        # repository of the image reference if there is one
+        #
+        repository = get_repository(image)
+        digests = local_image.attrs.get("RepoDigests") or []
+        matching = [d for d in digests if d.split("@")[0] == repository]
+        if len(matching) > 0:
+            pin = matching[0]
+        elif len(digests) > 0:
+            pin = digests[0]
+        else:
+            pin = local_image.id
+        return image, pin, pull_time
+
+    def run(self, images):
+        """
+        Pull and pin a list of images
+
+        Args:
+            images : the images
+
+        Returns:
+            a dictionary mapping each image to its pinned reference
+        """
+        start = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self._max_workers) as pool:
+            for image, pin, pull_time in pool.map(self._resolve, images):
+                self.pins[image] = pin
+                self.pull_times[image] = pull_time
+        self.total_time = time.time() - start
+        return self.pins
+
+    def report(self):
+        """
+        Return a summary of the time spent in the preflight stage
+        """
+        lines = [f"Image preflight took {self.total_time:.2f} seconds"]
+        for image, pin in self.pins.items():
+            lines.append(f"  {image} -> {pin} ({self.pull_times[image]:.2f} seconds)")
+        return "\n".join(lines)
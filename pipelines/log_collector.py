@@ -0,0 +1,247 @@
+#
+# Collect the output of pipeline steps which run concurrently
+#
+import asyncio
+import concurrent.futures
+import os
+import sys
+import threading
+
+
+class RotatingLogFile:
+    """
+    A log file which is rotated once it exceeds a given size, keeping a number of older files
+    as <name>.1, <name>.2 and so forth
+
+    """
+    def __init__(self, path, max_bytes, backup_count):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._file = open(path, "ab")
+        self._size = self._file.tell()
+
+    def write(self, data):
+        if self._size + len(data) > self._max_bytes and self._size > 0:
+            self._rotate()
+        self._file.write(data)
+        self._size = self._size + len(data)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self._backup_count - 1, 0, -1):
+            if os.path.exists(f"{self._path}.{i}"):
+                os.replace(f"{self._path}.{i}", f"{self._path}.{i + 1}")
+        if self._backup_count > 0:
+            os.replace(self._path, f"{self._path}.1")
+        else:
+            os.remove(self._path)
+        self._file = open(self._path, "ab")
+        self._size = 0
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class _ThreadRouter:
+    #
+    # Used as sys.stdout / sys.stderr while the collector is active. Output written by a thread
+    # which runs a step in process is forwarded to the collector, everything else goes to
+    # the original stream
+    #
+    def __init__(self, collector, stream_name, original):
+        self._collector = collector
+        self._stream_name = stream_name
+        self._original = original
+
+    def write(self, text):
+        step_name = getattr(self._collector._local, "step_name", None)
+        if step_name is None:
+            return self._original.write(text)
+        self._collector.write(step_name, self._stream_name, text.encode("utf-8"))
+        return len(text)
+
+    def flush(self):
+        self._original.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._original, name)
+
+
+class LogCollector:
+    """
+    Collect stdout and stderr of steps which run concurrently. Producers (the threads that run the steps) hand
+    over chunks of output to a queue. An asyncio event loop in a background thread groups the chunks in batches,
+    writes them to rotating log files per step and stream and prints them to the console, each line prefixed with
+    the step name.
+
+    The queue holds at most max_queue chunks. When it is full, producers block until the event loop has written
+    a batch, so that memory usage stays bounded even if a step writes faster than we can write the log files. If
+    only the console falls behind, lines are dropped from the console view (but not from the log files) instead.
+
+    """
+    def __init__(self, log_dir = "./logs", max_bytes = 10 * 1024**2, backup_count = 3, batch_size = 256,
+                 flush_interval = 0.1, console = True, max_pending = 10000, max_queue = 100000):
+        """
+        Initialize the collector and start the event loop
+
+        Args:
+            log_dir : the directory in which log files are created
+            max_bytes : size at which a log file is rotated
+            backup_count : number of rotated log files to keep
+            batch_size : maximum number of chunks that we write in one batch
+            flush_interval : maximum time in seconds that we wait for a batch to fill up
+            console : set this to False to write log files only
+            max_pending : number of pending chunks above which we stop printing to the console
+            max_queue : number of pending chunks above which producers block
+        """
+        self._log_dir = log_dir
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._console = console
+        self._max_pending = max_pending
+        self._max_queue = max_queue
+        self._slots = threading.Semaphore(max_queue)
+        self._files = {}
+        self._partial = {}
+        self._dropped = 0
+        self._local = threading.local()
+        os.makedirs(log_dir, exist_ok = True)
+        self._stdout = sys.stdout
+        #
+        # We write batches with an executor of our own, the default executor of the event
+        # loop is shut down with the interpreter and we might be closed after that
+        #
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target = self._loop.run_forever, daemon = True)
+        self._thread.start()
+        self._queue = asyncio.run_coroutine_threadsafe(self._create_queue(), self._loop).result()
+        self._consumer = asyncio.run_coroutine_threadsafe(self._consume(), self._loop)
+        sys.stdout = _ThreadRouter(self, "stdout", sys.stdout)
+        sys.stderr = _ThreadRouter(self, "stderr", sys.stderr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    async def _create_queue(self):
+        #
+        # The semaphore keeps the number of chunks below max_queue, the
+        # additional slot is for the None which tells the consumer to stop
+        #
+        return asyncio.Queue(maxsize = self._max_queue + 1)
+
+    def write(self, step_name, stream_name, data):
+        """
+        Hand over a chunk of output. This can be called from any thread except the one running the event
+        loop and blocks while max_queue chunks are pending
+
+        Args:
+            step_name : the step that has produced the output
+            stream_name : stdout or stderr
+            data : the output as bytes
+        """
+        if len(data) > 0:
+            self._slots.acquire()
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (step_name, stream_name, data))
+
+    def capture(self, step_name):
+        """
+        Return a context manager which routes everything that the current thread writes to
+        sys.stdout and sys.stderr to the logs of a step
+
+        Args:
+            step_name : the step name
+        """
+        collector = self
+
+        class _Capture:
+            def __enter__(self):
+                collector._local.step_name = step_name
+            def __exit__(self, exc_type, exc_value, exc_traceback):
+                collector._local.step_name = None
+                return False
+
+        return _Capture()
+
+    async def _consume(self):
+        done = False
+        while not done:
+            batch = [await self._queue.get()]
+            deadline = self._loop.time() + self._flush_interval
+            while len(batch) < self._batch_size:
+                timeout = deadline - self._loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            if None in batch:
+                done = True
+                batch = [item for item in batch if item is not None]
+            #
+            # File I/O happens in a thread so that the event loop can accept
+            # new chunks while a batch is being written
+            #
+            console = self._console and self._queue.qsize() < self._max_pending
+            await self._loop.run_in_executor(self._writer, self._write_batch, batch, console, done)
+            for _ in batch:
+                self._slots.release()
+
+    def _write_batch(self, batch, console, final):
+        lines = []
+        for step_name, stream_name, data in batch:
+            key = (step_name, stream_name)
+            if key not in self._files:
+                self._files[key] = RotatingLogFile(f"{self._log_dir}/{step_name}.{stream_name}.log",
+                                                   max_bytes = self._max_bytes,
+                                                   backup_count = self._backup_count)
+            self._files[key].write(data)
+            #
+            # Only complete lines go to the console, the remainder is kept until
+            # the next chunk for this step and stream arrives
+            #
+            text = self._partial.get(key, "") + data.decode("utf-8", errors = "replace")
+            *complete, self._partial[key] = text.split("\n")
+            prefix = f"[{step_name}]" if stream_name == "stdout" else f"[{step_name}:{stream_name}]"
+            lines.extend(f"{prefix} {line}\n" for line in complete)
+        if final:
+            for (step_name, stream_name), text in self._partial.items():
+                if len(text) > 0:
+                    lines.append(f"[{step_name}] {text}\n")
+            self._partial = {}
+        for log_file in self._files.values():
+            log_file.flush()
+        if console:
+            if self._dropped > 0:
+                self._stdout.write(f"[logs] {self._dropped} lines not shown, see the log files in {self._log_dir}\n")
+                self._dropped = 0
+            self._stdout.write("".join(lines))
+            self._stdout.flush()
+        else:
+            self._dropped = self._dropped + len(lines)
+
+    def close(self):
+        """
+        Write all pending output, close the log files and stop the event loop
+        """
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, None)
+        self._consumer.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._writer.shutdown(wait = True)
+        sys.stdout = sys.stdout._original if isinstance(sys.stdout, _ThreadRouter) else sys.stdout
+        sys.stderr = sys.stderr._original if isinstance(sys.stderr, _ThreadRouter) else sys.stderr
+        for log_file in self._files.values():
+            log_file.close()
@@ -1,5 +1,6 @@
 from kfp import dsl, compiler
-from kfp.dsl import Output, Model, Input, Dataset, Metrics, Markdown
+from kfp.dsl import Output, Model, Input, Dataset, Metrics, Markdown, Artifact
+from typing import List, NamedTuple
 import os
 
 #
@@ -14,7 +15,8 @@ google_region = os.environ.get("GOOGLE_REGION")
 )
 def create_data(training_data : Output[Dataset], 
                 validation_data : Output[Dataset],
-                size : int ):
+                size : int,
+                seed : int = None):
     """
     Create training- and validation data with a 80/20 split
 
@@ -22,49 +24,96 @@ def create_data(training_data : Output[Dataset],
         size : the number of items in the dataset overall 
         training_data : the training data set
         validation_data : the validation data set 
+        seed : optional - the seed, the data is the same as the one created by create_data_shard for the same seed
 
     """
-    import numpy as np
-    import torch
-    import pickle
-    X = []
-    Y = []
-    for i in range(size):
-        #
-        # First do the label, then choose a point in a corresponding cluster
-        #
-        label = np.random.randint(0, 2)
-        if label == 0:
-            #
-            # below diagonal
-            #
-            x = np.array([ 0.5, 0.25 ])
-        else:
-            x = np.array([ 0.5, 0.75 ])
-        #
-        # Add some noise
-        #
-        x = x + 0.05 * np.random.random(2)
-        X.append(x)
-        Y.append(label)
-    #
-    # X is now a list of arrays - converting this to a single array 
-    # before turning this into a tensor is more efficient
-    #
-    X = np.array(X)
-    X = torch.tensor(X, dtype = torch.float32)
-    Y = torch.tensor(Y, dtype = torch.float32)
-    assert X.shape == torch.Size([size, 2])
-    assert Y.shape == torch.Size([size])
+    from training import datagen
+    import dataset_io
+    if seed is None:
+        seed = datagen.get_seed()
+    #
+    # Rows 0 to split - 1 are the training data, the remaining rows the validation
+    # data. We stream each block to the column files of the respective dataset
+    #
     split = int(size*0.8)
-    training_dataset = (X[:split], Y[:split])
-    validation_dataset = (X[split:], Y[split:])
-    print(f"Writing training data to {training_data.path}")
-    with open(training_data.path, "wb") as out:
-        pickle.dump(training_dataset, out)
-    print(f"Writing validation data to {validation_data.path}")
-    with open(validation_data.path, "wb") as out:
-        pickle.dump(validation_dataset, out)
+    for dataset, start, stop in [(training_data, 0, split), (validation_data, split, size)]:
+        print(f"Writing {stop - start} rows to {dataset.path}")
+        with dataset_io.DatasetWriter(dataset.path, rows = stop - start) as writer:
+            for X, Y in datagen.generate_rows(start, stop, seed):
+                writer.write(X, Y)
+        dataset.metadata.update(dataset_io.get_metadata(dataset.path))
+        dataset.metadata.update({ "seed" : seed, "start" : start })
+
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest",
+)
+def plan_shards(shards : int) -> List[int]:
+    """
+    Return the shard indices over which a sharded pipeline iterates
+
+    Args:
+        shards : the number of shards
+    """
+    return list(range(shards))
+
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest",
+)
+def create_data_shard(training_data : Output[Dataset], 
+                      validation_data : Output[Dataset],
+                      size : int,
+                      shard : int,
+                      shards : int,
+                      seed : int):
+    """
+    Create one shard of the training- and validation data. The shards of all tasks together contain exactly
+    the rows that create_data creates for the same size and seed, whatever the number of shards
+
+    Args:
+        training_data : the training rows of this shard
+        validation_data : the validation rows of this shard
+        size : the number of items in the dataset overall 
+        shard : the index of this shard
+        shards : the number of shards
+        seed : the seed, which needs to be the same for all shards
+    """
+    from training import datagen
+    import dataset_io
+    split = int(size*0.8)
+    for dataset, offset, rows in [(training_data, 0, split), (validation_data, split, size - split)]:
+        start, stop = datagen.get_shard(rows, shard, shards)
+        print(f"Writing rows {offset + start} to {offset + stop - 1} to {dataset.path}")
+        with dataset_io.DatasetWriter(dataset.path, rows = stop - start) as writer:
+            for X, Y in datagen.generate_rows(offset + start, offset + stop, seed):
+                writer.write(X, Y)
+        dataset.metadata.update(dataset_io.get_metadata(dataset.path))
+        dataset.metadata.update({ "seed" : seed, "start" : offset + start, "shard" : shard })
+
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest",
+)
+def merge_datasets(shards : Input[List[Dataset]],
+                   merged : Output[Dataset]):
+    """
+    Concatenate dataset shards in the order of their first row
+
+    Args:
+        shards : the shards
+        merged : the merged dataset
+    """
+    import dataset_io
+    #
+    # We cannot rely on the order of the list, so we sort by the
+    # first row of each shard
+    #
+    shards = sorted(shards, key = lambda shard: shard.metadata['start'])
+    rows = dataset_io.merge_datasets([shard.path for shard in shards], merged.path)
+    print(f"Merged {len(shards)} shards with {rows} rows to {merged.path}")
+    merged.metadata.update(dataset_io.get_metadata(merged.path))
+    merged.metadata.update({ "seed" : shards[0].metadata['seed'], "start" : shards[0].metadata['start'] })
 
 
 @dsl.component(
@@ -75,10 +124,28 @@ def train(epochs : int,
             data : Input[Dataset],  
             trained_model : Output[Model],
             metrics: Output[Metrics],
+            profile_report : Output[Artifact],
             job_name : str,
             google_project_id : str,
             google_region : str ,
             experiment_name : str = None,
+            batch_size : int = 0,
+            shuffle_buffer : int = 65536,
+            checkpoint_interval : int = 60,
+            checkpoint_batches : int = 1000,
+            patience : int = 0,
+            min_delta : float = 1e-5,
+            validation_fraction : float = 0.0,
+            lr_schedule : str = "none",
+            torchscript : bool = True,
+            solver : str = "sgd",
+            tolerance : float = 1e-6,
+            initial_model : Input[Model] = None,
+            delta_data : Input[Dataset] = None,
+            replay_size : int = 65536,
+            profile_steps : int = 0,
+            profile_skip : int = 10,
+            precision : str = "float32",
 ):
     """
     Do the actual training. This is a simple binary classification model
@@ -88,7 +155,25 @@ def train(epochs : int,
         lr : learning rate
         trained_model : model output 
         metrics : training metrics
+        profile_report : trace and operator summary of the profiled training steps
         job_name : the name of the pipeline job in which this executes
+        batch_size : 0 to train on the full dataset in each step, otherwise the size of the mini-batches that are streamed from disk
+        shuffle_buffer : the number of rows from which mini-batches are drawn at random
+        checkpoint_interval : seconds between two checkpoints, 0 to disable checkpoints
+        checkpoint_batches : when streaming mini-batches, also checkpoint within an epoch every that many batches once the interval has passed, 0 to only checkpoint at the end of an epoch
+        patience : stop if the loss has not improved for that many epochs, 0 to always run all epochs
+        min_delta : the minimum decrease of the loss that counts as improvement
+        validation_fraction : the fraction of the data that we hold out to monitor the loss, 0 to monitor the training loss
+        lr_schedule : none, plateau (reduce the learning rate when the loss stalls) or cosine
+        torchscript : also save a frozen TorchScript version of the model next to the state dict, which evaluate uses if present
+        solver : sgd or adam, or lbfgs or newton to fit the model on the full batch with a second-order method, for which epochs is the maximum number of iterations
+        tolerance : the convergence tolerance of the second-order solvers
+        initial_model : optional - a previously trained model from which we start instead of a random initialization
+        delta_data : optional - new rows, if given we train on these plus a random sample of replay_size rows of data
+        replay_size : the number of old rows that we replay together with the new rows
+        profile_steps : the number of training steps (batches) that we profile with torch.profiler, 0 to disable profiling
+        profile_skip : the number of training steps before the profiled window
+        precision : float32, or bfloat16 to run the forward pass of the SGD or Adam training loop under CPU autocast, parameters are kept in float32. The second-order solvers only support float32
 
     """
     print(f"Job name : {job_name}")
@@ -113,41 +198,189 @@ def train(epochs : int,
     else:
         tb_run = None
     #
-    # Unpickle data again
+    # Either map the data into memory and use it as one batch or stream
+    # mini-batches from disk while we train. If requested, the last rows
+    # are held out to decide when to stop
     #
-    import pickle
-    with open(data.path, "rb") as file:
-        X, Y = pickle.load(file)
-    print(f"Got {len(X)} rows of training data")
-    import model    
+    import dataset_io
+    import data_loader
+    from training import model
     import torch
+    import time
+    X, Y = dataset_io.load_dataset(data.path)
+    if delta_data is not None:
+        #
+        # Incremental training: the new rows plus a bounded sample of the old rows, so that
+        # the model does not forget what it has learned, in random order so that a holdout
+        # taken from the end contains both
+        #
+        delta = dataset_io.load_columns(delta_data.path)
+        replay = dataset_io.sample_rows(data.path, replay_size)
+        X = torch.cat([torch.from_numpy(delta['features']), torch.from_numpy(replay['features'])])
+        Y = torch.cat([torch.from_numpy(delta['labels']), torch.from_numpy(replay['labels'])])
+        permutation = torch.randperm(len(Y))
+        X, Y = X[permutation], Y[permutation]
+        print(f"Training on {len(delta['labels'])} new rows and {len(replay['labels'])} replayed rows")
+    rows = len(Y) - int(len(Y) * validation_fraction)
+    holdout = (X[rows:], Y[rows:]) if rows < len(Y) else None
+    streaming = False
+    if batch_size > 0 and delta_data is not None:
+        batches = data_loader.TensorLoader(X[:rows], Y[:rows], batch_size = batch_size)
+    elif batch_size > 0:
+        batches = data_loader.StreamingLoader(data.path, batch_size = batch_size, shuffle_buffer = shuffle_buffer, stop = rows)
+        streaming = True
+    else:
+        batches = [(X[:rows], Y[:rows])]
+    print(f"Got {len(Y)} rows of data, using {rows} rows for training")
+    assert precision in model.PRECISIONS, f"Unknown precision {precision}"
     _model = model.Model()
+    if initial_model is not None:
+        print(f"Starting from model {initial_model.uri}")
+        with open(initial_model.path, "rb") as file:
+            _model.load_state_dict(torch.load(file))
+    import os
+    import profiling
+    checkpointer = None
+    from training import loop
+    from training import solvers
+    assert solver in loop.OPTIMIZERS or solver in solvers.SOLVERS, f"Unknown solver {solver}"
     #
-    # Run actual training loop
+    # The second-order solvers work in float32 and double precision, so we do not record
+    # a model as trained in bfloat16 which has never seen autocast
     #
-    _model.train()
-    optimizer = torch.optim.SGD(_model.parameters(), lr = lr)
-    loss_fn = torch.nn.functional.binary_cross_entropy_with_logits
-    for e in range(epochs):
-        logits = _model(X).squeeze(dim = 1)
+    assert solver not in solvers.SOLVERS or precision == "float32", f"Solver {solver} only supports precision float32"
+    if solver in solvers.SOLVERS:
+        #
+        # A second-order solver needs tens of passes over the full batch
+        # instead of thousands of epochs, so we do not checkpoint
+        #
+        start = time.time()
+        #
+        # The solver has no steps that we could count, so we profile it as a whole
+        #
+        with profiling.ComponentProfiler(profile_report.path, steps = None if profile_steps > 0 else 0) as profiler:
+            report = solvers.fit(solver, _model, X[:rows], Y[:rows], max_iter = epochs, tolerance = tolerance)
+        print(f"Solver {solver} {'converged' if report['converged'] else 'did not converge'} after {report['iterations']} iterations, final loss: {report['final_loss']}")
+        for name, value in report.items():
+            metrics.log_metric(name, value)
+        metrics.log_metric("training_time", time.time() - start)
+    else:
+        #
+        # Run actual training loop
+        #
+        _model.train()
+        optimizer = loop.OPTIMIZERS[solver](_model.parameters(), lr = lr)
+        loss_fn = torch.nn.functional.binary_cross_entropy_with_logits
+        #
+        # Checkpoints go into the directory of the model artifact. If we find one, this is a
+        # restart after an interruption and we continue where the previous attempt stopped
         #
-        # Yes, the targets are expected to be floats
+        import checkpoint
+        import convergence
+        monitor = convergence.ConvergenceMonitor(optimizer,
+                                                 epochs = epochs,
+                                                 patience = patience,
+                                                 min_delta = min_delta,
+                                                 lr_schedule = lr_schedule)
+        first_epoch = 0
         #
-        loss = loss_fn(input = logits, target = Y)
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        if tb_run is not None and 0 == (e % 100):
-            tb_run.log_time_series_metrics({
-                "loss" : loss.item(),
-            },
-            step = e)
-    print(f"Final loss: {loss.item()}")
-    metrics.log_metric("final_loss", loss.item())
+        # The loss is still undefined if there are no epochs or batches to run
+        #
+        loss = torch.tensor(float("nan"))
+        initial_epoch_loss = torch.tensor(0.0)
+        if checkpoint_interval > 0:
+            #
+            # Only resume from checkpoints written with the same parameters and data
+            #
+            fingerprint = checkpoint.get_fingerprint({
+                    "epochs" : epochs, "lr" : lr, "batch_size" : batch_size, "shuffle_buffer" : shuffle_buffer,
+                    "patience" : patience, "min_delta" : min_delta, "validation_fraction" : validation_fraction,
+                    "lr_schedule" : lr_schedule, "solver" : solver, "replay_size" : replay_size, "precision" : precision
+                },
+                [artifact.path for artifact in (data, initial_model, delta_data) if artifact is not None])
+            checkpointer = checkpoint.AsyncCheckpointer(os.path.join(os.path.dirname(trained_model.path), "checkpoints"),
+                                                        interval = checkpoint_interval,
+                                                        fingerprint = fingerprint)
+            state = checkpointer.restore(_model, optimizer)
+            if state is not None:
+                first_epoch = state['epoch']
+                loss = state['loss']
+                monitor.load_state_dict(state['monitor'])
+                #
+                # A checkpoint taken within an epoch also has the position of the loader
+                # and the loss accumulated so far in this epoch
+                #
+                if streaming:
+                    batches.load_state_dict(state['loader'])
+                if state['batch'] > 0:
+                    initial_epoch_loss = state['epoch_loss']
+        start = time.time()
+        epochs_run = 0
+        with profiling.ComponentProfiler(profile_report.path, steps = profile_steps, skip = profile_skip) as profiler:
+            for e in range(first_epoch, epochs):
+                epoch_loss = initial_epoch_loss
+                initial_epoch_loss = torch.tensor(0.0)
+                for X_batch, Y_batch in batches:
+                    with torch.autocast(device_type = "cpu", dtype = torch.bfloat16, enabled = (precision == "bfloat16")):
+                        logits = _model(X_batch).squeeze(dim = 1)
+                    #
+                    # Yes, the targets are expected to be floats, and we
+                    # always calculate the loss in float32
+                    #
+                    loss = loss_fn(input = logits.float(), target = Y_batch)
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+                    epoch_loss = epoch_loss + loss.detach() * len(Y_batch)
+                    profiler.step()
+                    #
+                    # An epoch over a large dataset can take longer than the checkpoint interval,
+                    # so in streaming mode we also checkpoint within an epoch
+                    #
+                    if checkpointer is not None and streaming and checkpoint_batches > 0 and batches.position % checkpoint_batches == 0:
+                        checkpointer.save(e, _model, optimizer, batch = batches.position, loss = loss.detach(), epoch_loss = epoch_loss,
+                                          monitor = monitor.state_dict(), loader = batches.state_dict())
+                epochs_run = epochs_run + 1
+                if tb_run is not None and 0 == (e % 100):
+                    tb_run.log_time_series_metrics({
+                        "loss" : loss.item(),
+                    },
+                    step = e)
+                #
+                # Monitor the loss on the held-out rows if we have them, otherwise
+                # the mean training loss of this epoch
+                #
+                if holdout is not None:
+                    monitored_loss = convergence.holdout_loss(_model, *holdout)
+                else:
+                    monitored_loss = (epoch_loss / rows).item()
+                stop = monitor.step(e, monitored_loss)
+                if checkpointer is not None:
+                    checkpointer.save(e + 1, _model, optimizer, loss = loss.detach(), monitor = monitor.state_dict(),
+                                      loader = batches.state_dict() if streaming else None)
+                if stop:
+                    print(f"Stopping after epoch {e + 1}, reason: {monitor.stop_reason}")
+                    break
+        samples_per_second = rows * epochs_run / (time.time() - start)
+        print(f"Final loss: {loss.item()}, {samples_per_second:.0f} samples per second")
+        metrics.log_metric("final_loss", loss.item())
+        metrics.log_metric("samples_per_second", samples_per_second)
+        monitor.log(metrics)
     #
     # Store trained model as state dir
     #
     torch.save(_model.state_dict(), trained_model.path)
+    trained_model.metadata.update({ "lr" : lr, "epochs" : epochs, "solver" : solver, "precision" : precision })
+    if initial_model is not None:
+        trained_model.metadata['initial_model'] = initial_model.uri
+    if delta_data is not None:
+        trained_model.metadata.update({ "delta_rows" : len(delta['labels']), "replay_rows" : len(replay['labels']) })
+    if torchscript:
+        model.export_torchscript(_model, model.get_torchscript_path(trained_model.path))
+    trained_model.metadata['torchscript'] = torchscript
+    if checkpointer is not None:
+        checkpointer.close(remove = True)
+    profiler.log(profile_report)
 
 @dsl.component(
     base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest"
@@ -155,7 +388,11 @@ def train(epochs : int,
 def evaluate(trained_model : Input[Model], 
              validation_data : Input[Dataset], 
              metrics: Output[Metrics],
-             model_card : Output[Markdown]) -> float:
+             model_card : Output[Markdown],
+             profile_report : Output[Artifact],
+             batch_size : int = 65536,
+             profile : bool = False,
+             precision : str = None) -> float:
     """
     Evaluate the model
 
@@ -163,53 +400,121 @@ def evaluate(trained_model : Input[Model],
         trained_model : the model to be evaluated
         validation_data : the validation data
         metrics : metric artifact to which we log the result of the validation
+        profile_report : trace and operator summary of the evaluation pass
+        batch_size : the number of rows that we evaluate at a time
+        profile : profile the evaluation pass with torch.profiler
+        precision : float32 or bfloat16, defaults to the precision in which the model has been trained
     
     Returns:
         the accuracy of the model (a float in the range 0 to 100)
 
     """
-    import model 
-    import torch
-    import numpy as np
+    from training import model
+    from training import evaluation
+    import os
     #
-    # Load model
-    #        
-    _model = model.Model()
-    with open(trained_model.path, "rb") as file:
-        _model.load_state_dict(torch.load(file))
-    hits = 0 
+    # Load model, preferring the compiled version if train has exported one
     #
-    # Unpickle validation data
+    if precision is None:
+        precision = trained_model.metadata.get("precision", "float32")
+    print(f"Evaluating in {precision}")
+    _model = model.load_model(trained_model.path, precision = precision)
     #
-    import pickle
-    with open(validation_data.path, "rb") as file:
-        X, Y = pickle.load(file)
+    # Map validation data into memory and evaluate batch by batch
+    #
+    import dataset_io
+    X, Y = dataset_io.load_dataset(validation_data.path)
     print(f"Got {len(X)} rows of validation data")
-    for t, x in enumerate(X):
-        label = Y[t]
-        prediction = _model.predict(x)
-        if prediction == label:
-            hits = hits + 1
-        accuracy = 100.0 * hits / len(X)
+    import profiling
+    with profiling.ComponentProfiler(profile_report.path, steps = None if profile else 0) as profiler:
+        results = evaluation.evaluate_model(_model, evaluation.iterate_batches(X, Y, batch_size = batch_size), dtype = model.get_dtype(precision)).result()
+    profiler.log(profile_report)
+    accuracy = results['accuracy']
     print(f"Accuracy: {accuracy}")
-    metrics.log_metric("accuracy", accuracy)
-    #
-    # Write to model card - of course this is
-    # just a toy example, for real use cases you might
-    # want to consider a toolkit like Googles Model Card Toolkit
-    #
-    with open(model_card.path, "w") as model_card:
-        model_card.write("# Model card\n\n")
-        model_card.write("| Item | Value |\n")
-        model_card.write("| --- | --- |\n")
-        model_card.write(f"| Accuracy | {accuracy} |\n")
-        model_card.write(f"| PyTorch version | {torch.__version__} |\n")
+    evaluation.log_results(metrics, results)
+    #
+    # Remember which model we have evaluated, so that a downstream
+    # step can relate a list of metrics to a list of models
+    #
+    metrics.metadata['model'] = trained_model.uri
+    metrics.metadata['torchscript'] = os.path.exists(model.get_torchscript_path(trained_model.path)) and precision == "float32"
+    metrics.metadata['precision'] = precision
+    evaluation.write_model_card(model_card.path, results)
     return accuracy
 
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest"
+)
+def evaluate_shard(trained_model : Input[Model], 
+                   validation_data : Input[Dataset], 
+                   shard : int,
+                   shards : int,
+                   partial_metrics : Output[Artifact],
+                   batch_size : int = 65536):
+    """
+    Evaluate the model on one shard of the validation data and save the state of the metric accumulator,
+    which reduce_metrics merges with the state of the other shards
+
+    Args:
+        trained_model : the model to be evaluated
+        validation_data : the merged validation data, we evaluate the rows of the shard with the given index
+        shard : the index of the shard
+        shards : the number of shards
+        partial_metrics : the state of the accumulator for this shard
+        batch_size : the number of rows that we evaluate at a time
+    """
+    from training import model
+    from training import evaluation
+    from training import datagen
+    import dataset_io
+    _model = model.load_model(trained_model.path)
+    #
+    # The dataset is memory mapped, so slicing only reads the rows of our shard
+    #
+    X, Y = dataset_io.load_dataset(validation_data.path)
+    start, stop = datagen.get_shard(len(Y), shard, shards)
+    X, Y = X[start:stop], Y[start:stop]
+    print(f"Got {len(X)} rows of validation data in shard {shard}")
+    partial = evaluation.evaluate_model(_model, evaluation.iterate_batches(X, Y, batch_size = batch_size))
+    evaluation.save_partial(partial, partial_metrics.path)
+    partial_metrics.metadata.update({ "shard" : shard, "samples" : partial.count })
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest"
+)
+def reduce_metrics(trained_model : Input[Model], 
+                   partial_metrics : Input[List[Artifact]], 
+                   metrics: Output[Metrics],
+                   model_card : Output[Markdown]) -> float:
+    """
+    Merge the metric accumulators of all validation shards, the result is the same as evaluating the
+    model on the full validation data
+
+    Args:
+        trained_model : the model that has been evaluated
+        partial_metrics : the accumulator states written by evaluate_shard
+        metrics : metric artifact to which we log the result of the validation
+        model_card : the model card
+
+    Returns:
+        the accuracy of the model (a float in the range 0 to 100)
+    """
+    from training import evaluation
+    merged = evaluation.BinaryClassificationMetrics()
+    for partial in partial_metrics:
+        merged.merge(evaluation.load_partial(partial.path))
+    results = merged.result()
+    print(f"Accuracy on {len(partial_metrics)} shards: {results['accuracy']}")
+    evaluation.log_results(metrics, results)
+    metrics.metadata['model'] = trained_model.uri
+    evaluation.write_model_card(model_card.path, results)
+    return results['accuracy']
+
 @dsl.pipeline(
     name = "my-pipeline"
 )
-def my_pipeline(epochs : int, lr : float, size : int, experiment_name : str = None):
+def my_pipeline(epochs : int, lr : float, size : int, experiment_name : str = None, batch_size : int = 0, patience : int = 0, solver : str = "sgd",
+                profile_steps : int = 0, profile_evaluation : bool = False, precision : str = "float32"):
     _create_data = create_data(size = size)
     _train = train(epochs = epochs,
                   lr = lr,
@@ -224,15 +529,295 @@ def my_pipeline(epochs : int, lr : float, size : int, experiment_name : str = No
                   job_name = dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
                   google_project_id = google_project_id, 
                   google_region = google_region,
-                  experiment_name = experiment_name
+                  experiment_name = experiment_name,
+                  batch_size = batch_size,
+                  patience = patience,
+                  solver = solver,
+                  profile_steps = profile_steps,
+                  precision = precision
 )
     _train.set_cpu_limit("2")
     _eval = evaluate(trained_model = _train.outputs['trained_model'],
-                     validation_data = _create_data.outputs['validation_data'])
+                     validation_data = _create_data.outputs['validation_data'],
+                     profile = profile_evaluation)
+
+@dsl.pipeline(
+    name = "my-sharded-pipeline"
+)
+def my_sharded_pipeline(epochs : int, lr : float, size : int, shards : int = 4, seed : int = 0, batch_size : int = 0, patience : int = 0):
+    """
+    Like my_pipeline, but generate the data in parallel shards and evaluate the validation shards in parallel,
+    reducing the partial metrics into one Metrics artifact. The data only depends on size and seed, not on the
+    number of shards
+    """
+    _plan_shards = plan_shards(shards = shards)
+    with dsl.ParallelFor(items = _plan_shards.output) as shard:
+        _create_data_shard = create_data_shard(size = size, shard = shard, shards = shards, seed = seed)
+    #
+    # Training needs all rows, so we merge the training shards
+    #
+    _merge_datasets = merge_datasets(shards = dsl.Collected(_create_data_shard.outputs['training_data']))
+    _train = train(epochs = epochs,
+                   lr = lr,
+                   data = _merge_datasets.outputs['merged'],
+                   job_name = dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
+                   google_project_id = google_project_id, 
+                   google_region = google_region,
+                   batch_size = batch_size,
+                   patience = patience)
+    _train.set_cpu_limit("2")
+    #
+    # A collected output cannot be consumed inside another loop, so we merge the validation
+    # shards as well and each evaluation task reads the rows of its shard from the merged data
+    #
+    _merge_validation = merge_datasets(shards = dsl.Collected(_create_data_shard.outputs['validation_data']))
+    with dsl.ParallelFor(items = _plan_shards.output) as shard:
+        _evaluate_shard = evaluate_shard(trained_model = _train.outputs['trained_model'],
+                                         validation_data = _merge_validation.outputs['merged'],
+                                         shard = shard,
+                                         shards = shards)
+    reduce_metrics(trained_model = _train.outputs['trained_model'],
+                   partial_metrics = dsl.Collected(_evaluate_shard.outputs['partial_metrics']))
+
+@dsl.pipeline(
+    name = "my-incremental-pipeline"
+)
+def my_incremental_pipeline(epochs : int, lr : float, model_uri : str, data_uri : str, delta_size : int, replay_size : int = 65536, batch_size : int = 0, patience : int = 0):
+    """
+    Continue training an existing model on new data. The model and the data that it has been trained on are
+    imported from their URIs, for instance the trained_model and training_data artifacts of an earlier run, and we
+    train on newly created rows plus a sample of the old ones, usually for far fewer epochs than a full training
+    """
+    _initial_model = dsl.importer(artifact_uri = model_uri, artifact_class = Model, reimport = False)
+    _data = dsl.importer(artifact_uri = data_uri, artifact_class = Dataset, reimport = False)
+    _delta = create_data(size = delta_size)
+    _train = train(epochs = epochs,
+                   lr = lr,
+                   data = _data.output,
+                   initial_model = _initial_model.output,
+                   delta_data = _delta.outputs['training_data'],
+                   replay_size = replay_size,
+                   job_name = dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
+                   google_project_id = google_project_id, 
+                   google_region = google_region,
+                   batch_size = batch_size,
+                   patience = patience)
+    _train.set_cpu_limit("2")
+    _eval = evaluate(trained_model = _train.outputs['trained_model'],
+                     validation_data = _delta.outputs['validation_data'])
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest"
+)
+def select_best(models : Input[List[Model]],
+                evaluations : Input[List[Metrics]],
+                best_model : Output[Model],
+                best_metrics : Output[Metrics]) -> float:
+    """
+    Pick the model with the highest accuracy from the models trained in a sweep
+
+    Args:
+        models : the trained models
+        evaluations : the metrics of the evaluate steps, each one refers to the model it belongs to
+        best_model : a copy of the best model
+        best_metrics : accuracy and hyperparameters of the best model
+
+    Returns:
+        the accuracy of the best model
+    """
+    from training import model
+    import os
+    import shutil
+    #
+    # We do not rely on the order of the collected lists but match
+    # metrics and models via the URI of the model
+    #
+    accuracies = { evaluation.metadata['model'] : evaluation.metadata['accuracy'] for evaluation in evaluations }
+    missing = [m.uri for m in models if m.uri not in accuracies]
+    assert len(missing) == 0, f"No evaluation refers to the models {missing}"
+    best = max(models, key = lambda m: accuracies[m.uri])
+    accuracy = accuracies[best.uri]
+    print(f"Best model {best.uri} with accuracy {accuracy}")
+    shutil.copy(best.path, best_model.path)
+    if os.path.exists(model.get_torchscript_path(best.path)):
+        shutil.copy(model.get_torchscript_path(best.path), model.get_torchscript_path(best_model.path))
+    best_model.metadata.update(best.metadata)
+    best_metrics.log_metric("accuracy", accuracy)
+    for name in ("lr", "epochs"):
+        best_metrics.log_metric(name, best.metadata[name])
+    best_metrics.metadata['model'] = best.uri
+    return accuracy
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest"
+)
+def unpack_config(config : dict) -> NamedTuple("Outputs", epochs = int, lr = float):
+    """
+    Turn a configuration of a sweep into typed parameters. The fields of a loop item cannot be passed
+    to the train component directly, as KFP types them as strings
+
+    Args:
+        config : a dictionary with the keys lr and epochs
+
+    Returns:
+        epochs and learning rate
+    """
+    from collections import namedtuple
+    outputs = namedtuple("Outputs", ["epochs", "lr"])
+    return outputs(int(config['epochs']), float(config['lr']))
+
+#
+# Maximum number of configurations that we train at the same time in a sweep
+#
+SWEEP_PARALLELISM = 4
+
+@dsl.pipeline(
+    name = "my-sweep"
+)
+def my_sweep(configs : List[dict], size : int, batch_size : int = 0, patience : int = 0):
+    """
+    Train and evaluate the model for a list of configurations (dictionaries with keys lr and epochs) on the
+    same data and select the best model. We do not log to TensorBoard here, as all branches would use the
+    same experiment run
+    """
+    _create_data = create_data(size = size)
+    with dsl.ParallelFor(items = configs, parallelism = SWEEP_PARALLELISM) as config:
+        _unpack_config = unpack_config(config = config)
+        _train = train(epochs = _unpack_config.outputs['epochs'],
+                       lr = _unpack_config.outputs['lr'],
+                       data = _create_data.outputs['training_data'],
+                       job_name = dsl.PIPELINE_JOB_NAME_PLACEHOLDER,
+                       google_project_id = google_project_id,
+                       google_region = google_region,
+                       batch_size = batch_size,
+                       patience = patience)
+        _train.set_cpu_limit("2")
+        _eval = evaluate(trained_model = _train.outputs['trained_model'],
+                         validation_data = _create_data.outputs['validation_data'])
+    select_best(models = dsl.Collected(_train.outputs['trained_model']),
+                evaluations = dsl.Collected(_eval.outputs['metrics']))
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest",
+)
+def train_ensemble(configs : List[dict],
+                   data : Input[Dataset],
+                   ensemble : Output[Artifact],
+                   metrics : Output[Metrics],
+                   batch_size : int = 0,
+                   shuffle_buffer : int = 65536) -> List[int]:
+    """
+    Train one model per configuration in a single vectorised training loop
+
+    Args:
+        configs : a list of dictionaries with the keys lr, epochs and optionally seed
+        data : the training data
+        ensemble : a directory with the state dict of each model and the configurations
+        metrics : training metrics of the ensemble as a whole
+        batch_size : 0 to train on the full dataset in each step, otherwise the size of the mini-batches that are streamed from disk
+        shuffle_buffer : the number of rows from which mini-batches are drawn at random
+
+    Returns:
+        the indices of the models, over which the pipeline iterates to extract them
+    """
+    import dataset_io
+    import data_loader
+    import ensemble as _ensemble
+    import json
+    import os
+    import time
+    import torch
+    X, Y = dataset_io.load_dataset(data.path)
+    if batch_size > 0:
+        batches = data_loader.StreamingLoader(data.path, batch_size = batch_size, shuffle_buffer = shuffle_buffer)
+    else:
+        batches = [(X, Y)]
+    trainer = _ensemble.EnsembleTrainer(configs)
+    print(f"Training {len(trainer)} models on {len(Y)} rows for up to {trainer.epochs} epochs")
+    start = time.time()
+    for e in range(trainer.epochs):
+        trainer.train_epoch(e, batches)
+    duration = time.time() - start
+    #
+    # Store each model in the format of the train component
+    #
+    os.makedirs(ensemble.path, exist_ok = True)
+    for index in range(len(trainer)):
+        torch.save(trainer.state_dict(index), os.path.join(ensemble.path, f"model-{index}.pt"))
+    with open(os.path.join(ensemble.path, "ensemble.json"), "w") as file:
+        json.dump({ "configs" : trainer.configs, "final_losses" : trainer.losses.tolist() }, file)
+    ensemble.metadata['models'] = len(trainer)
+    metrics.log_metric("models", len(trainer))
+    metrics.log_metric("training_time", duration)
+    metrics.log_metric("model_epochs_per_second", sum(config['epochs'] for config in trainer.configs) / duration)
+    return list(range(len(trainer)))
+
+@dsl.component(
+    base_image = f"{google_region}-docker.pkg.dev/{google_project_id}/vertex-ai-docker-repo/pipeline:latest",
+)
+def extract_model(ensemble : Input[Artifact],
+                  index : int,
+                  trained_model : Output[Model],
+                  metrics : Output[Metrics],
+                  torchscript : bool = True):
+    """
+    Turn one model of an ensemble into a Model artifact like the one written by train
+
+    Args:
+        ensemble : the output of train_ensemble
+        index : the index of the model
+        trained_model : the model
+        metrics : the training metrics of the model
+        torchscript : also save a frozen TorchScript version of the model next to the state dict
+    """
+    import json
+    import os
+    import shutil
+    import torch
+    from training import model
+    with open(os.path.join(ensemble.path, "ensemble.json"), "r") as file:
+        description = json.load(file)
+    config = description['configs'][index]
+    shutil.copy(os.path.join(ensemble.path, f"model-{index}.pt"), trained_model.path)
+    trained_model.metadata.update({ "lr" : config['lr'], "epochs" : config['epochs'], "seed" : config['seed'] })
+    if torchscript:
+        _model = model.Model()
+        _model.load_state_dict(torch.load(trained_model.path))
+        model.export_torchscript(_model, model.get_torchscript_path(trained_model.path))
+    trained_model.metadata['torchscript'] = torchscript
+    metrics.log_metric("final_loss", description['final_losses'][index])
+
+@dsl.pipeline(
+    name = "my-ensemble"
+)
+def my_ensemble(configs : List[dict], size : int, batch_size : int = 0):
+    """
+    Like my_sweep, but train all configurations in one vectorised task and then
+    extract, evaluate and compare the models in parallel
+    """
+    _create_data = create_data(size = size)
+    _train_ensemble = train_ensemble(configs = configs,
+                                     data = _create_data.outputs['training_data'],
+                                     batch_size = batch_size)
+    _train_ensemble.set_cpu_limit("2")
+    with dsl.ParallelFor(items = _train_ensemble.outputs['Output'], parallelism = SWEEP_PARALLELISM) as index:
+        _extract_model = extract_model(ensemble = _train_ensemble.outputs['ensemble'], index = index)
+        _eval = evaluate(trained_model = _extract_model.outputs['trained_model'],
+                         validation_data = _create_data.outputs['validation_data'])
+    select_best(models = dsl.Collected(_extract_model.outputs['trained_model']),
+                evaluations = dsl.Collected(_eval.outputs['metrics']))
 
 if __name__ == "__main__":
     #
     # Compile
     #
     compiler.Compiler().compile(pipeline_func = my_pipeline, 
-                            package_path = "my-pipeline.yaml")
\ No newline at end of file
+                            package_path = "my-pipeline.yaml")
+    compiler.Compiler().compile(pipeline_func = my_sweep, 
+                            package_path = "my-sweep.yaml")
+    compiler.Compiler().compile(pipeline_func = my_sharded_pipeline, 
+                            package_path = "my-sharded-pipeline.yaml")
+    compiler.Compiler().compile(pipeline_func = my_ensemble, 
+                            package_path = "my-ensemble.yaml")
+    compiler.Compiler().compile(pipeline_func = my_incremental_pipeline, 
+                            package_path = "my-incremental-pipeline.yaml")
\ No newline at end of file
@@ -0,0 +1,99 @@
+#
+# The worker that runs inside a warm container of the WarmContainerPool. This script is copied to
+# the mounted /gcs volume and started once per container. It imports the expensive modules once
+# and then waits for tasks in its work directory. A task consists of the component source code,
+# the function to execute and the executor input
+#
+# Protocol (all files in the work directory):
+#
+# task.json       written by the driver (atomically, via rename) to submit a task
+# heartbeat       touched by the worker while it waits, used for health checks
+# <step>.stdout   stdout of the task
+# <step>.stderr   stderr of the task
+# result.json     written by the worker (atomically) when the task is complete
+#
+import contextlib
+import importlib
+import importlib.util
+import json
+import os
+import resource
+import sys
+import time
+import traceback
+
+POLL_INTERVAL = 0.05
+HEARTBEAT_INTERVAL = 1
+
+def run_task(work_dir, task):
+    #
+    # Write the component source to a file and import it as a module under a name which is
+    # unique for this task, similar to what kfp.dsl.executor_main does
+    #
+    from kfp.dsl import executor
+    module_name = f"ephemeral_component_{task['task_id']}"
+    module_path = os.path.join(work_dir, f"{module_name}.py")
+    with open(module_path, "w") as file:
+        file.write(task['source'])
+    spec = importlib.util.spec_from_file_location(module_name, module_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    function_to_execute = getattr(module, task['function_name'])
+    _executor = executor.Executor(
+        executor_input = task['executor_input'],
+        function_to_execute = function_to_execute)
+    _executor.execute()
+    os.remove(module_path)
+
+
+def main(work_dir, preload):
+    #
+    # Components import modules like model.py from the working directory
+    # of the image, so make sure that we can find them
+    #
+    sys.path.insert(0, os.getcwd())
+    #
+    # Files written here are owned by the container user, so we avoid
+    # creating a __pycache__ directory that the driver cannot clean up
+    #
+    sys.dont_write_bytecode = True
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            print(f"Could not preload module {module}")
+    task_file = os.path.join(work_dir, "task.json")
+    heartbeat_file = os.path.join(work_dir, "heartbeat")
+    last_heartbeat = 0
+    while True:
+        if not os.path.exists(task_file):
+            if time.time() - last_heartbeat > HEARTBEAT_INTERVAL:
+                last_heartbeat = time.time()
+                with open(heartbeat_file, "w") as file:
+                    file.write(str(last_heartbeat))
+            time.sleep(POLL_INTERVAL)
+            continue
+        with open(task_file, "r") as file:
+            task = json.load(file)
+        os.remove(task_file)
+        result = { "status" : "ok" }
+        usage_start = resource.getrusage(resource.RUSAGE_SELF)
+        stdout_file = os.path.join(work_dir, f"{task['step_name']}.stdout")
+        stderr_file = os.path.join(work_dir, f"{task['step_name']}.stderr")
+        with open(stdout_file, "w", buffering = 1) as out, open(stderr_file, "w", buffering = 1) as err:
+            with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+                try:
+                    run_task(work_dir, task)
+                except BaseException as e:
+                    traceback.print_exc()
+                    result = { "status" : "error", "error" : repr(e) }
+        usage_end = resource.getrusage(resource.RUSAGE_SELF)
+        result['cpu_time'] = (usage_end.ru_utime + usage_end.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime)
+        result['peak_rss'] = usage_end.ru_maxrss * 1024
+        with open(os.path.join(work_dir, "result.json.tmp"), "w") as file:
+            json.dump(result, file)
+        os.replace(os.path.join(work_dir, "result.json.tmp"), os.path.join(work_dir, "result.json"))
+
+
+if __name__ == "__main__":
+    main(work_dir = sys.argv[1], preload = sys.argv[2:])
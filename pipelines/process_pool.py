@@ -0,0 +1,312 @@
+#
+# A process pool backend to run components outside of a container
+#
+import contextlib
+import importlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import sys
+import threading
+import time
+import traceback
+
+#
+# How often the watchdog in a worker checks the resident memory of the task, and how long a task has
+# to unwind after we have raised a MemoryError in it before we terminate the worker
+#
+MEMORY_POLL_INTERVAL = 0.05
+MEMORY_GRACE_PERIOD = 5
+
+
+#
+# These functions run in the worker processes
+#
+_log_queue = None
+_baseline_rss = 0
+
+
+def _get_rss():
+    #
+    # The current resident memory of this process in bytes. Without /proc, we can
+    # only get the high water mark, which is stricter than what we want
+    #
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+
+def _raise_memory_error(signum, frame):
+    raise MemoryError("Resident memory of the task exceeds the memory limit")
+
+
+class _MemoryWatchdog:
+    #
+    # Poll the resident memory of the worker while a task runs. If it exceeds the limit, we
+    # raise a MemoryError in the main thread which runs the task via a signal. If the task does
+    # not unwind within the grace period, e.g. because it is stuck in native code, we terminate
+    # the worker, which the driver reports as a dead worker
+    #
+    def __init__(self, limit):
+        self._limit = limit
+        self._done = threading.Event()
+        self._thread = threading.Thread(target = self._watch, daemon = True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self._done.set()
+        self._thread.join()
+        return False
+
+    def _watch(self):
+        exceeded_at = None
+        while not self._done.wait(MEMORY_POLL_INTERVAL):
+            if exceeded_at is None and _get_rss() > self._limit:
+                exceeded_at = time.time()
+                os.kill(os.getpid(), signal.SIGUSR1)
+            elif exceeded_at is not None and time.time() - exceeded_at > MEMORY_GRACE_PERIOD:
+                os._exit(1)
+
+
+class _QueueWriter(io.TextIOBase):
+    #
+    # Used as sys.stdout / sys.stderr of a worker while it runs a task, sends
+    # the output to the driver which hands it over to the log function
+    #
+    def __init__(self, step_name, stream_name):
+        self._step_name = step_name
+        self._stream_name = stream_name
+
+    def write(self, text):
+        if len(text) > 0:
+            _log_queue.put((self._step_name, self._stream_name, text.encode("utf-8")))
+        return len(text)
+
+
+def _init_worker(local_dir, preload, log_queue):
+    global _log_queue, _baseline_rss
+    #
+    # Each worker has its own copy of the KFP module state, so we can patch the
+    # GCS prefix here without affecting the driver or other workers
+    #
+    import kfp
+    kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX = f"{local_dir}/"
+    _log_queue = log_queue
+    for module in preload:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            print(f"Could not preload module {module}")
+    #
+    # The memory limit of a task applies to the memory it uses on top of
+    # what the worker needs after preloading, mostly torch
+    #
+    _baseline_rss = _get_rss()
+    signal.signal(signal.SIGUSR1, _raise_memory_error)
+
+
+def _run_task(source, function_name, executor_input, memory_limit, task_memory, num_threads, step_name):
+    from kfp.dsl import executor
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    #
+    # Torch is preloaded, so setting OMP_NUM_THREADS would be too late and
+    # we limit the number of intra-op threads directly
+    #
+    torch = sys.modules.get("torch")
+    old_threads = torch.get_num_threads() if torch is not None else None
+    if torch is not None and num_threads is not None:
+        torch.set_num_threads(num_threads)
+    with contextlib.ExitStack() as stack:
+        #
+        # Limit the resident memory for this task only. We do not use RLIMIT_AS, as the
+        # address space of a worker which has loaded torch is much larger than its resident
+        # memory, so that a limit on the address space would not mean much. The memory limit
+        # of a step applies to the whole worker, like the limit of a container, whereas the
+        # task memory of the pool applies on top of what the worker needs after preloading
+        #
+        if memory_limit is not None:
+            stack.enter_context(_MemoryWatchdog(memory_limit))
+        elif task_memory is not None:
+            stack.enter_context(_MemoryWatchdog(_baseline_rss + task_memory))
+        if _log_queue is not None:
+            stack.enter_context(contextlib.redirect_stdout(_QueueWriter(step_name, "stdout")))
+            stack.enter_context(contextlib.redirect_stderr(_QueueWriter(step_name, "stderr")))
+        try:
+            namespace = { "__name__" : f"ephemeral_{function_name}" }
+            exec(compile(source, f"<{function_name}>", "exec"), namespace)
+            _executor = executor.Executor(
+                executor_input = executor_input,
+                function_to_execute = namespace[function_name])
+            output_file = _executor.execute()
+        finally:
+            if old_threads is not None:
+                torch.set_num_threads(old_threads)
+    #
+    # Return the executor output and the resources used by this task to the driver. The peak
+    # memory usage is the high water mark of the worker process
+    #
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    usage = {
+        "cpu_time" : (usage_end.ru_utime + usage_end.ru_stime) - (usage_start.ru_utime + usage_start.ru_stime),
+        "peak_rss" : usage_end.ru_maxrss * 1024
+    }
+    with open(output_file, "r") as file:
+        return json.load(file), usage
+
+
+def _worker_main(connection, local_dir, preload, log_queue, task):
+    #
+    # Entry point of a worker process, which runs a single task and sends the result or
+    # the exception back to the driver. Exceptions that cannot be pickled are turned into
+    # a RuntimeError with the traceback
+    #
+    _init_worker(local_dir, preload, log_queue)
+    try:
+        result = ("ok", _run_task(*task))
+    except BaseException as e:
+        result = ("error", e)
+        details = traceback.format_exc()
+        try:
+            connection.send(result)
+            return
+        except Exception:
+            result = ("error", RuntimeError(details))
+    connection.send(result)
+
+
+class ProcessPoolBackend:
+    """
+    Run components in worker processes, at most max_workers at a time. Each step gets a worker of its own,
+    forked from a server process which has already imported torch and kfp, so that starting a worker is cheap
+    and these modules are imported only once. Running components in separate processes allows several steps to
+    run in parallel and makes sure that steps do not share global state. As workers are not shared, a worker
+    which dies, for instance because it was killed by the OOM killer or the memory watchdog, only fails its
+    own step, whereas a dead worker in a concurrent.futures pool fails all pending tasks.
+
+    If a log function is given, the Python level output of a task (sys.stdout and sys.stderr) is sent back to
+    the driver through a queue and handed over to this function, for instance LogCollector.write.
+
+    """
+    def __init__(self, local_dir = "./gcs", max_workers = 4, task_memory = None, preload = ("kfp.dsl.executor", "torch", "numpy"), log_function = None):
+        """
+        Initialize the backend
+
+        Args:
+            local_dir : the local directory under which inputs and outputs are placed
+            max_workers : the maximum number of worker processes that run at the same time
+            task_memory : optional - the maximum resident memory of a task in bytes, on top of the memory that a worker uses after preloading
+            preload : modules to import in the worker processes
+            log_function : optional - a function accepting step name, stream name and a chunk of output as bytes
+        """
+        self._local_dir = local_dir
+        self._task_memory = task_memory
+        self._preload = list(preload)
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max_workers)
+        self._workers = set()
+        #
+        # The forkserver start method lets us preload modules once in the server process. Forking
+        # from the driver directly is not safe as the driver might run several threads
+        #
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            self._context.set_forkserver_preload(self._preload)
+        else:
+            self._context = multiprocessing.get_context("spawn")
+        self._log_queue = None
+        self._log_thread = None
+        if log_function is not None:
+            self._log_queue = self._context.Queue()
+            self._log_thread = threading.Thread(target = self._forward_logs, args = (log_function, ), daemon = True)
+            self._log_thread.start()
+
+    def _forward_logs(self, log_function):
+        #
+        # Runs in a thread of the driver until close puts None on the queue
+        #
+        while True:
+            item = self._log_queue.get()
+            if item is None:
+                break
+            log_function(*item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+        return False
+
+    def run(self, command, function_name, executor_input, step_name, resources = None):
+        """
+        Run a component in a worker process and return the executor output and a dictionary
+        with the CPU time and the peak memory usage of the worker
+
+        Args:
+            command : the container command of the component, the last item is the source code
+            function_name : the function to execute
+            executor_input : the executor input
+            step_name : the step name
+            resources : optional - the StepResources of the step, a memory limit of the step is the maximum resident memory of the whole worker
+                        as for a container and takes precedence over the task memory of the pool
+        """
+        memory_limit = None
+        num_threads = None
+        if resources is not None:
+            memory_limit = resources.memory_limit
+            num_threads = resources.num_threads
+        task = (command[-1], function_name, executor_input, memory_limit, self._task_memory, num_threads, step_name)
+        with self._slots:
+            receiver, sender = self._context.Pipe(duplex = False)
+            worker = self._context.Process(target = _worker_main,
+                                           args = (sender, self._local_dir, self._preload, self._log_queue, task),
+                                           daemon = True)
+            with self._lock:
+                self._workers.add(worker)
+            try:
+                worker.start()
+                sender.close()
+                #
+                # Receive before we join, as the worker cannot exit before the
+                # result has been read from the pipe
+                #
+                try:
+                    status, result = receiver.recv()
+                except EOFError:
+                    worker.join()
+                    raise RuntimeError(f"Worker process died while running step {step_name} with exit code {worker.exitcode}")
+                worker.join()
+            finally:
+                receiver.close()
+                with self._lock:
+                    self._workers.discard(worker)
+        if status == "ok":
+            return result
+        if isinstance(result, MemoryError):
+            if memory_limit is not None:
+                raise RuntimeError(f"Step {step_name} exceeded the memory limit of {memory_limit} bytes")
+            raise RuntimeError(f"Step {step_name} exceeded the task memory of {self._task_memory} bytes")
+        raise result
+
+    def close(self):
+        """
+        Terminate workers which are still running and stop forwarding their output
+        """
+        with self._lock:
+            workers = list(self._workers)
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        if self._log_thread is not None:
+            self._log_queue.put(None)
+            self._log_thread.join()
+            self._log_thread = None
@@ -0,0 +1,94 @@
+#
+# Optional torch.profiler instrumentation for the training and evaluation components
+#
+import os
+import torch
+
+#
+# Number of operators in the summary tables
+#
+TOP_OPERATORS = 20
+
+
+class ComponentProfiler:
+    """
+    Profile a window of steps of a component with torch.profiler and write a trace in Chrome trace format plus a
+    summary of the operators with the highest CPU time and memory usage to a directory, usually the path of an
+    output artifact. The window starts after a number of steps that are skipped, so that one-off costs at the
+    start do not dominate. If no steps are profiled, the profiler does nothing but write a note to the directory,
+    so that the artifact always exists.
+
+    """
+    def __init__(self, path, steps = 0, skip = 0):
+        """
+        Initialize the profiler
+
+        Args:
+            path : the directory to which we write trace and summary
+            steps : the number of steps to profile, 0 to disable profiling, None to profile everything until the profiler is exited
+            skip : the number of steps before the window
+        """
+        self.path = path
+        self._steps = steps
+        self._skip = skip
+        self._profile = None
+        self.top_operators = []
+        os.makedirs(path, exist_ok = True)
+
+    @property
+    def enabled(self):
+        return self._steps is None or self._steps > 0
+
+    def __enter__(self):
+        if self.enabled:
+            schedule = None
+            if self._steps is not None:
+                schedule = torch.profiler.schedule(wait = self._skip, warmup = 1, active = self._steps, repeat = 1)
+            self._profile = torch.profiler.profile(activities = [torch.profiler.ProfilerActivity.CPU],
+                                                   schedule = schedule,
+                                                   on_trace_ready = self._write,
+                                                   record_shapes = True,
+                                                   profile_memory = True)
+            self._profile.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if self._profile is not None:
+            self._profile.__exit__(exc_type, exc_value, exc_traceback)
+        if not os.path.exists(os.path.join(self.path, "summary.txt")):
+            with open(os.path.join(self.path, "summary.txt"), "w") as file:
+                file.write("Profiling disabled or the profiled window was not reached\n")
+        return False
+
+    def step(self):
+        """
+        Mark the end of a step, e.g. a training batch
+        """
+        if self._profile is not None:
+            self._profile.step()
+
+    def _write(self, profile):
+        profile.export_chrome_trace(os.path.join(self.path, "trace.json"))
+        averages = profile.key_averages()
+        with open(os.path.join(self.path, "summary.txt"), "w") as file:
+            file.write("Top operators by self CPU time\n\n")
+            file.write(averages.table(sort_by = "self_cpu_time_total", row_limit = TOP_OPERATORS))
+            file.write("\n\nTop operators by CPU memory\n\n")
+            file.write(averages.table(sort_by = "self_cpu_memory_usage", row_limit = TOP_OPERATORS))
+            file.write("\n")
+        ranked = sorted(averages, key = lambda event: event.self_cpu_time_total, reverse = True)
+        self.top_operators = [event.key for event in ranked[:5]]
+        print(f"Profile written to {self.path}, top operators: {', '.join(self.top_operators)}")
+
+    def log(self, artifact):
+        """
+        Record the profiled window and the top operators in the metadata of the artifact
+
+        Args:
+            artifact : the output artifact whose path we have written to
+        """
+        artifact.metadata.update({
+            "profiled_steps" : self._steps if self._steps is not None else "all",
+            "skipped_steps" : self._skip,
+            "top_operators" : self.top_operators
+        })
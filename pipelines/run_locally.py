@@ -2,24 +2,31 @@
 # Run a component locally
 #
 import kfp
-from kfp.dsl import executor
 import pipeline_definition
+from component_runner import ComponentRunner
+from dag_runner import PipelineRunner
+from step_cache import StepCache
+from container_pool import WarmContainerPool
+from process_pool import ProcessPoolBackend
+from log_collector import LogCollector
+from artifact_store import ArtifactStore
+from step_trace import StepTracer, StepProfile
+from step_resources import StepResources
+from image_preflight import ImagePreflight, get_images_from_components, get_images_from_pipeline_spec
+import sweep
 import argparse
+import atexit
 import os
-import docker
-import json
-import pathlib
-from dataclasses import dataclass
+import sys
 import time
-import shutil
-
 
 #
-# This class holds step output artifacts
+# Steps that run outside of a container import the training package from the root
+# of the repository, in the images it is on the PYTHONPATH. Worker processes of the
+# process pool inherit the search path from us
 #
-@dataclass
-class StepOutput:
-    outputs : dict()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
 
 #
 # A simple component for testing this test driver
@@ -31,258 +38,6 @@ def say_hello():
     print("Hello")
     
 
-class ComponentRunner:
-    """
-    A simple test driver to run an invidual pipeline component. This class works by building an executor input
-    structure that points to local data for a given component function and then uses the KFP executor to actually
-    run it or runs a container. 
-
-    """
-    def __init__(self, pipeline_root = "pipeline_root", local_dir = "./gcs", no_container = False):
-        """
-        Initialize a component runner
-
-        Args:
-            local_dir :  the local directory under which inputs and outputs are placed, not including a trailing slash
-            pipeline_root : the name of the subdirectory under this local dir where artifacts are created
-            no_container : set this to True to run outside of a container
-        """
-        self.local_dir = local_dir
-        self.pipeline_root = pipeline_root
-        self._no_container = no_container
-
-    def __enter__(self):
-        #
-        # Patch GCS prefix. When initializing the executor, an URI starting with
-        # gs:// is turned into a path by replacing gs:// by this prefix. Usually this 
-        # is /gcs, we overwrite this by our local directory
-        #
-        self._old_prefix = kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX
-        kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX = f"{self.local_dir}/"
-        return self
-    
-    def __exit__(self, exc_type, exc_value, exc_traceback):
-        kfp.dsl.types.artifact_types._GCS_LOCAL_MOUNT_PREFIX = self._old_prefix
-        return False
-
-    def create_runtime_artifact(self, artifact_name, step_name, schema_title):
-        """
-        Create the part of an execution input JSON which specifies an individual artifact. Uusally the URI used for this is 
-        gs://{pipeline_root}/{step_name}/{artifact_name}
-    
-        Args:
-            artifact_name : the name of the artifact
-            step_name : the name of the step, this will be used as part of the URI
-            schema_title : schema title to use for this artifact
-        """
-        #
-        # This dictionary represents a runtime artifact,
-        # i.e. an instance of one of the classes in dsl.types.artifact_types
-        # At runtime, the schema title is used to identify the correct class
-        #
-        return {
-            "name" : f"{artifact_name}",    
-            "metadata" : {},
-            "type": {
-                "schemaTitle" : schema_title
-            },  
-            #
-            # The URI will be used to determine the local path at runtime. For a GCS bucket,
-            # the KFP executor will replace gs:// prefix  by /gcs or more precisely by the value of
-            # types.artifact_types._GCS_LOCAL_MOUNT_PREFIX - this is what we patch in the __enter__ method
-            #
-            "uri" : f"gs://{self.pipeline_root}/{step_name}/{artifact_name}"
-        }
-
-    def get_param_type(self, param_spec):
-        """
-        Check whether an input or output is an artifact, a parameter and input or output. 
-        At the time of writing at least this can be detected by checking whether the type is a schema definition 
-        of the form <schema_title>@<schema_version>
-        
-        Args:
-            param_spec : the parameter specifaction to inspect
-
-        """
-        is_input = isinstance (param_spec, kfp.dsl.structures.InputSpec)
-        is_artifact = "@" in param_spec.type
-        return is_input, is_artifact
-
-    def build_executor_input_from_function(self, comp, step_name, **kwargs):
-        """
-        Assemble an executor input structure for a component, using the provided input mappings
-        (see the comment for create_runtime_artifact). Input parameters will be taken from the kwargs
-
-        Args:
-            comp : the component for which we want to create the executor input, needs to be an instance of PythonComponent
-            step_name : the step name
-            kwargs : additional key word arguments used as inputs
-
-        """
-        inputs_and_outputs = { **(comp.component_spec.inputs or {}), **(comp.component_spec.outputs or {})}
-        output_artifacts = {}
-        input_artifacts = {}
-        parameter_values = {}
-        #
-        # Go through inputs and outputs and add items to input_artifacts and parameter_values
-        #
-        for param_name, param_spec in inputs_and_outputs.items():
-            is_input, is_artifact = self.get_param_type(param_spec)
-            if not is_artifact:
-                #
-                # This is a parameter - we only handle input parameters
-                # 
-                if is_input:
-                    #
-                    # Check that input is contained in kwargs
-                    #
-                    assert param_name in kwargs, f"Parameter {param_name} not in parameter values"
-                    #
-                    # and take it from there
-                    #
-                    parameter_values[param_name] = kwargs[param_name]
-            else:
-                #
-                # If the input is contained in the kwargs, take it from there
-                #
-                if param_name in kwargs and is_input:
-                    input_artifacts[param_name] = kwargs[param_name]
-                else:
-                    #
-                    # Need to build the structure ourselves. We can get the schema
-                    # title and the schema version from the type
-                    #
-                    schema_title = param_spec.type.split("@")[0]
-                    #
-                    # Add an entry to the input artifacts dictionary. Each entry
-                    # is a dictionary with the key artifacts. The value is a list
-                    # (we only use one entry) and each item in the list is an actual
-                    # artifact with name, metadata, schema and URI
-                    #
-                    run_artifact = {
-                        "artifacts" : [
-                            self.create_runtime_artifact(
-                                artifact_name = param_name, 
-                                step_name = step_name,
-                                schema_title = schema_title)
-                        ]
-                    }
-                    if is_input:
-                        input_artifacts[param_name] = run_artifact
-                    else:
-                        output_artifacts[param_name] = run_artifact
-            
-        #
-        # Assemble the executor input structure. There are two sections that will later
-        # be used by the executor:
-        # 
-        # inputs: contains all inputs. This can be parameter values but also input artifacts
-        # outputs: contains all outputs. In addition, there is a key outputFile which is the
-        #          local path to which the executor output is written
-        #
-        executor_input = {
-            "inputs" : {
-                "parameterValues" : parameter_values,
-            }, 
-            "outputs":  {
-                "outputFile" : f"{self.local_dir}/{step_name}/execution_output.json"
-            }
-        }
-        if len(input_artifacts.keys()) > 0:
-            executor_input['inputs']['artifacts'] = input_artifacts
-        if len(output_artifacts.keys()) > 0:
-            executor_input['outputs']['artifacts'] = output_artifacts
-        return executor_input
-
-    def run_step(self, comp, step_name, verbose = False,  key_json = None, **kwargs):
-        """
-        Run a step, using the provided kwargs and the provided input mappings. 
-    
-        We return a dataclass containing the output artifacts so that they can be used as input for the next
-        step in a syntax similar to a pipeline definition, i.e.
-
-        _first = run_step(...)
-        _second = run_step(..., <argument name> = _first.outputs['<argument_name>'])
-
-        Args:
-            comp : the PythonComponent to run
-            step_name : a step name (needs to be unique)
-            verbose : set this to True to collect extra output
-            kwargs : key word arguments that will be used as input parameters for the step      
-            key_json : optional - full path of a service account key JSON file that we will use 
-        
-        """
-        executor_input = self.build_executor_input_from_function(comp, step_name, **kwargs)
-        if verbose: 
-            print(f"Preparing step {step_name} - using executor input: \n{json.dumps(executor_input, indent = 4)}")
-        #
-        # Make sure that output directory exists
-        # 
-        if "artifacts" in executor_input['outputs']:
-            output_dir = f"{self.local_dir}/{self.pipeline_root}/{step_name}"
-            os.makedirs(output_dir, exist_ok = True)
-        if self._no_container:
-            #
-            # Create executor 
-            #    
-            _executor = executor.Executor(
-                    executor_input = executor_input, 
-                    function_to_execute = comp)
-
-            # 
-            # Run it. The executor will use the executor input to 
-            # instantiate input and output artifacts, model etc. and then
-            # invoke the actual function with these inputs
-            #
-            output_file = _executor.execute()
-            if verbose: 
-                print(f"Execution of step {step_name} complete, output file has been written to {output_file}")
-        else:
-            #
-            # Run our component in a docker container
-            #
-            image = comp.component_spec.implementation.container.image
-            command = comp.component_spec.implementation.container.command
-            if verbose:
-                print(f"Command: {command}")
-            args = [
-                "--executor_input",
-                json.dumps(executor_input),
-                "--function_to_execute",
-                step_name
-            ]
-            docker_client = docker.from_env()
-            #
-            # Figure out whether we have credentials
-            #
-            env = {}
-            if key_json is not None:
-                shutil.copy(key_json, f"{self.local_dir}/key.json")
-                env["GOOGLE_APPLICATION_CREDENTIALS"] = f"/gcs/key.json"
-            container = docker_client.containers.run(
-                image = image,
-                entrypoint = command,
-                command = args,
-                volumes = [
-                    f"{pathlib.Path(self.local_dir).resolve()}:/gcs",
-                ],
-                stderr = True,
-                stdout = True,
-                detach = True,
-                environment = env
-            )
-            for l in container.logs(stream = True):
-                print(l.decode('utf-8'), end = "")
-            container.remove()
-        if "artifacts" in executor_input['outputs']:
-            # TODO: also consider the data in the output file here to 
-            # learn about parameter outputs and updated metadata
-            return StepOutput(outputs = executor_input['outputs']['artifacts'] )
-        else:
-            return StepOutput(outputs = {})
-        
-            
-
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--verbose", 
@@ -301,61 +56,285 @@ def get_args():
                         type = str,
                         default = None,
                         help = "JSON service account key")
+    parser.add_argument("--pipeline", 
+                        type = str,
+                        default = None,
+                        help = "Run all tasks of this compiled pipeline instead of the individual steps")
+    parser.add_argument("--max_workers", 
+                        type = int,
+                        default = 4,
+                        help = "Maximum number of tasks to run in parallel when using --pipeline")
+    parser.add_argument("--cpus", 
+                        type = float,
+                        default = None,
+                        help = "Number of cores available for tasks when using --pipeline, defaults to all cores")
+    parser.add_argument("--memory", 
+                        type = int,
+                        default = None,
+                        help = "Memory in MB available for tasks when using --pipeline, defaults to the physical memory")
+    parser.add_argument("--no_cache", 
+                        action = "store_true",
+                        default = False,
+                        help = "Do not use cached step results")
+    parser.add_argument("--cache_size", 
+                        type = int,
+                        default = 2048,
+                        help = "Maximum size of the step cache in MB")
+    parser.add_argument("--warm_containers", 
+                        action = "store_true",
+                        default = False,
+                        help = "Run steps in a pool of warm containers")
+    parser.add_argument("--max_container_tasks", 
+                        type = int,
+                        default = 20,
+                        help = "Number of steps after which a warm container is recycled")
+    parser.add_argument("--process_pool", 
+                        action = "store_true",
+                        default = False,
+                        help = "With --no_container, run steps in a pool of worker processes")
+    parser.add_argument("--workers", 
+                        type = int,
+                        default = 4,
+                        help = "Number of worker processes")
+    parser.add_argument("--task_memory", 
+                        type = int,
+                        default = None,
+                        help = "Maximum resident memory per step in MB on top of the preloaded modules when using --process_pool")
+    parser.add_argument("--log_dir", 
+                        type = str,
+                        default = None,
+                        help = "Write the output of each step to log files in this directory")
+    parser.add_argument("--dedup", 
+                        action = "store_true",
+                        default = False,
+                        help = "Deduplicate artifacts in ./gcs and in the step cache")
+    parser.add_argument("--trace", 
+                        type = str,
+                        default = "trace.json",
+                        help = "File to which we write a trace in Chrome trace format")
+    parser.add_argument("--pull", 
+                        type = str,
+                        default = "missing",
+                        choices = ["always", "missing"],
+                        help = "Pull all images before the run (always) or only images that are not present locally (missing)")
+    parser.add_argument("--pull_workers", 
+                        type = int,
+                        default = 4,
+                        help = "Number of images that are pulled in parallel")
+    parser.add_argument("--sweep_lrs", 
+                        type = str,
+                        default = None,
+                        help = "Comma separated learning rates, run the sweep pipeline (--pipeline my-sweep.yaml or my-ensemble.yaml) for all combinations with --sweep_epochs")
+    parser.add_argument("--sweep_epochs", 
+                        type = str,
+                        default = "1000",
+                        help = "Comma separated numbers of epochs for the sweep")
+    parser.add_argument("--shards", 
+                        type = int,
+                        default = 4,
+                        help = "Number of data shards when running the sharded pipeline (--pipeline my-sharded-pipeline.yaml)")
+    parser.add_argument("--profile_steps", 
+                        type = int,
+                        default = 0,
+                        help = "Profile this number of training steps and the evaluation with torch.profiler")
+    parser.add_argument("--model_uri", 
+                        type = str,
+                        default = None,
+                        help = "URI of the model to continue training with the incremental pipeline (--pipeline my-incremental-pipeline.yaml)")
+    parser.add_argument("--data_uri", 
+                        type = str,
+                        default = None,
+                        help = "URI of the training data of that model, from which we replay rows")
     return parser.parse_args()
 
-#
-# Get arguments
-#
-args = get_args()
-#
-# Get Google project ID and region from enironment
-#
-google_project_id = os.environ.get("GOOGLE_PROJECT_ID")
-google_region = os.environ.get("GOOGLE_REGION")
-#
-# Make sure that local ./gcs directory exists before we run a container
-# otherwise this will be added with owner root and we have a permission issue
-#
-os.makedirs("./gcs", exist_ok = True)
-#
-# Create runner
-#
-with ComponentRunner(no_container = args.no_container) as runner:
+
+def main():
     #
-    # Be nice and say hello first
-    # 
-    runner.run_step(comp = say_hello,
-                    step_name = "say_hello",
-                    verbose = args.verbose)
+    # Get arguments
     #
-    # Run the first step of our pipeline
+    args = get_args()
     #
-    _create_data = runner.run_step(comp = pipeline_definition.create_data, 
-            step_name = "create_data", 
-            verbose = args.verbose,
-            size = 1000)
-
+    # Get Google project ID and region from enironment
     #
-    # Run step "train", using the artifact "data"
-    # from step "create_data" as input for the parameter "data"
+    google_project_id = os.environ.get("GOOGLE_PROJECT_ID")
+    google_region = os.environ.get("GOOGLE_REGION")
     #
-    timestamp = time.strftime("%Y%m%d%H%M%S",time.localtime())
-    _train = runner.run_step(comp = pipeline_definition.train, 
-            step_name = "train",
-            key_json = args.key_json,
-            data = _create_data.outputs['training_data'],
-            verbose = args.verbose,
-            epochs = 1000,
-            lr = 0.05, 
-            job_name = f"my-run-{timestamp}",
-            google_project_id = google_project_id,
-            google_region = google_region, 
-            experiment_name = args.experiment,
-)
+    # Make sure that local ./gcs directory exists before we run a container
+    # otherwise this will be added with owner root and we have a permission issue
+    #
+    os.makedirs("./gcs", exist_ok = True)
+    #
+    # Create artifact store which needs to be on the same file system as ./gcs
+    #
+    artifact_store = None
+    if args.dedup:
+        artifact_store = ArtifactStore(store_dir = "./gcs/.store")
+    #
+    # Create cache. The job name contains a timestamp and does not have any
+    # impact on the outputs, so we do not make it part of the fingerprint. The
+    # modules in this directory and the training package are, as a step that
+    # runs outside of a container or in a rebuilt image imports their current version
+    #
+    cache = None
+    if not args.no_cache:
+        pipelines_dir = os.path.dirname(os.path.abspath(__file__))
+        cache = StepCache(max_bytes = args.cache_size * 1024**2, 
+                          ignore_parameters = ["job_name"],
+                          artifact_store = artifact_store,
+                          source_dirs = [pipelines_dir, os.path.join(os.path.dirname(pipelines_dir), "training")])
+    #
+    # Create pool of warm containers and make sure that the containers are
+    # removed when we are done, even if a step fails
+    #
+    container_pool = None
+    if args.warm_containers and not args.no_container:
+        container_pool = WarmContainerPool(max_tasks = args.max_container_tasks)
+        atexit.register(container_pool.close)
+    #
+    # Collect step output in log files if requested
+    #
+    log_collector = None
+    if args.log_dir is not None:
+        log_collector = LogCollector(log_dir = args.log_dir)
+    #
+    # Similarly create a process pool if requested. The workers send their output
+    # to the log collector. We close both explicitly instead of at exit, as
+    # the collector needs to write the remaining output before the interpreter
+    # shuts down, and the pool first so that the output of its workers is complete
+    #
+    process_pool = None
+    try:
+        if args.process_pool and args.no_container:
+            process_pool = ProcessPoolBackend(max_workers = args.workers,
+                                              task_memory = args.task_memory * 1024**2 if args.task_memory is not None else None,
+                                              log_function = log_collector.write if log_collector is not None else None)
+        #
+        # Create tracer
+        #
+        tracer = StepTracer()
+        #
+        # When running in containers, pull all images that we need in parallel before
+        # we start and pin them so that all steps of this run use the same image
+        #
+        image_pins = None
+        if not args.no_container:
+            if args.pipeline is not None:
+                images = get_images_from_pipeline_spec(args.pipeline)
+            else:
+                images = get_images_from_components([say_hello, pipeline_definition.create_data, pipeline_definition.train, pipeline_definition.evaluate])
+            preflight = ImagePreflight(max_workers = args.pull_workers, pull = args.pull)
+            profile = StepProfile(step_name = "preflight", start = time.time())
+            image_pins = preflight.run(images)
+            profile.end = time.time()
+            profile.pull_time = preflight.total_time
+            tracer.add(profile)
+            print(preflight.report())
+        #
+        # Outputs go to gs://pipeline_root/<step name>/<artifact name>, so a run which imports the
+        # model and data of an earlier run would overwrite them with its own steps of the same name.
+        # Such a run gets a pipeline root of its own, as it would on VertexAI
+        #
+        pipeline_root = "pipeline_root"
+        if args.model_uri is not None or args.data_uri is not None:
+            pipeline_root = f"pipeline_root/run-{time.strftime('%Y%m%d%H%M%S', time.localtime())}"
+            print(f"Writing the artifacts of this run to gs://{pipeline_root}")
+        #
+        # Create runner
+        #
+        with ComponentRunner(pipeline_root = pipeline_root, no_container = args.no_container, cache = cache, container_pool = container_pool, process_pool = process_pool, log_collector = log_collector, artifact_store = artifact_store, tracer = tracer, image_pins = image_pins) as runner:
+            if args.pipeline is not None:
+                #
+                # Run the compiled pipeline, using the same parameters as below
+                # or the grid of configurations for a sweep
+                #
+                parameter_values = {
+                    "epochs" : 1000,
+                    "lr" : 0.05,
+                    "size" : 1000,
+                    "experiment_name" : args.experiment,
+                    "shards" : args.shards,
+                    "model_uri" : args.model_uri,
+                    "data_uri" : args.data_uri,
+                    "delta_size" : 1000,
+                    "profile_steps" : args.profile_steps,
+                    "profile_evaluation" : args.profile_steps > 0
+                }
+                if args.sweep_lrs is not None:
+                    parameter_values = {
+                        "configs" : sweep.grid(lrs = sweep.parse_list(args.sweep_lrs), 
+                                               epochs = sweep.parse_list(args.sweep_epochs, type = int)),
+                        "size" : 1000
+                    }
+                PipelineRunner(runner = runner,
+                               package_path = args.pipeline,
+                               max_workers = args.max_workers,
+                               verbose = args.verbose,
+                               key_json = args.key_json,
+                               cpus = args.cpus,
+                               memory = args.memory * 1024**2 if args.memory is not None else None).run(parameter_values = parameter_values)
+            else:
+                #
+                # Be nice and say hello first
+                # 
+                runner.run_step(comp = say_hello,
+                                step_name = "say_hello",
+                                verbose = args.verbose,
+                                use_cache = False)
+                #
+                # Run the first step of our pipeline
+                #
+                _create_data = runner.run_step(comp = pipeline_definition.create_data, 
+                        step_name = "create_data", 
+                        verbose = args.verbose,
+                        size = 1000)
+
+                #
+                # Run step "train", using the artifact "data"
+                # from step "create_data" as input for the parameter "data". We
+                # use the same CPU limit as in the pipeline definition
+                #
+                timestamp = time.strftime("%Y%m%d%H%M%S",time.localtime())
+                _train = runner.run_step(comp = pipeline_definition.train, 
+                        step_name = "train",
+                        key_json = args.key_json,
+                        data = _create_data.outputs['training_data'],
+                        verbose = args.verbose,
+                        epochs = 1000,
+                        lr = 0.05, 
+                        job_name = f"my-run-{timestamp}",
+                        google_project_id = google_project_id,
+                        google_region = google_region, 
+                        experiment_name = args.experiment,
+                        profile_steps = args.profile_steps,
+                        resources = StepResources(cpu_limit = 2),
+            )
+                #
+                # Similarly run step evaluate
+                #
+                runner.run_step(comp = pipeline_definition.evaluate, 
+                        step_name = "evaluate",
+                        trained_model = _train.outputs['trained_model'],
+                        validation_data = _create_data.outputs['validation_data'],
+                        profile = args.profile_steps > 0)
+    finally:
+        if process_pool is not None:
+            process_pool.close()
+        if log_collector is not None:
+            log_collector.close()
     #
-    # Similarly run step evaluate
+    # Print a summary and write trace, which can be viewed with
+    # chrome://tracing or https://ui.perfetto.dev
     #
-    runner.run_step(comp = pipeline_definition.evaluate, 
-            step_name = "evaluate",
-            trained_model = _train.outputs['trained_model'],
-            validation_data = _create_data.outputs['validation_data'])
+    print(tracer.summary())
+    tracer.write_chrome_trace(args.trace)
+    print(f"Trace written to {args.trace}")
+    if artifact_store is not None:
+        print(artifact_store.report())
+
+
+#
+# Worker processes of the process pool import this module as well, so we only run when
+# invoked as a script
+#
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#
+# A content addressed cache for the results of local pipeline steps
+#
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+
+class StepCache:
+    """
+    A cache for step results. The key of a cache entry is a fingerprint of the component code (image, command
+    which contains the source code of a Python component and function name), the input parameter values and the
+    URIs and content of the input artifacts. As components import local modules which are not part of their source
+    code, the Python files in a list of source directories are part of the key as well. An entry holds a copy of the output artifacts of the step and of the
+    executor output file.
+
+    The cache is bounded in size. When adding an entry would exceed this size, the least recently used entries
+    are evicted first.
+
+    If an ArtifactStore is provided, entries do not hold copies. Files that the runner has already added to the store
+    are hardlinks to their blobs. Large files which are not in the store, for instance because they are in a directory
+    we cannot write to, are kept as a list of content defined chunks, smaller ones are copied.
+
+    """
+    def __init__(self, cache_dir = "./.cache/steps", max_bytes = 2 * 1024**3, ignore_parameters = (), artifact_store = None, chunk_threshold = 64 * 1024**2, source_dirs = ()):
+        """
+        Initialize a step cache
+
+        Args:
+            cache_dir : the directory in which cache entries are stored
+            max_bytes : the maximum overall size of all cache entries
+            ignore_parameters : names of parameters that do not influence the outputs and are therefore not part of the fingerprint
+            artifact_store : optional - an ArtifactStore used to deduplicate the content of cache entries
+            chunk_threshold : files of at least this size which are not in the artifact store are stored in chunks
+            source_dirs : directories with modules that components import, a change to any Python file in them invalidates all entries
+        """
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._ignore_parameters = set(ignore_parameters)
+        self._artifact_store = artifact_store
+        self._chunk_threshold = chunk_threshold
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok = True)
+        self._index_file = f"{cache_dir}/index.json"
+        self._index = { "entries" : {}, "files" : {} }
+        if os.path.exists(self._index_file):
+            with open(self._index_file, "r") as file:
+                self._index = json.load(file)
+        self._prune_files()
+        self._source_digest = self._hash_sources(source_dirs)
+
+    def _save_index(self):
+        #
+        # Write to a temporary file first and rename so that an interrupted
+        # run does not leave a corrupt index behind
+        #
+        with open(f"{self._index_file}.tmp", "w") as file:
+            json.dump(self._index, file)
+        os.replace(f"{self._index_file}.tmp", self._index_file)
+
+    def _prune_files(self):
+        #
+        # Drop remembered hashes of files which have been removed or changed since, so
+        # that the index does not grow with every artifact that we have ever hashed
+        #
+        files = {}
+        for path, memo in self._index.get("files", {}).items():
+            if not isinstance(memo, dict):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if stat.st_size == memo['size'] and stat.st_mtime_ns == memo['mtime_ns']:
+                files[path] = memo
+        self._index['files'] = files
+
+    def _hash_file(self, path):
+        #
+        # Hashing large artifacts is expensive, so we remember the hash of a file as long
+        # as its size and modification time do not change. We keep one hash per file,
+        # so a file which is written again replaces its old hash
+        #
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        with self._lock:
+            memo = self._index['files'].get(path)
+        if memo is not None and memo['size'] == stat.st_size and memo['mtime_ns'] == stat.st_mtime_ns:
+            return memo['digest']
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1024 * 1024), b""):
+                sha.update(block)
+        digest = sha.hexdigest()
+        with self._lock:
+            self._index['files'][path] = { "size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "digest" : digest }
+        return digest
+
+    def _hash_path(self, path, sha):
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    file_path = os.path.join(root, name)
+                    sha.update(os.path.relpath(file_path, path).encode("utf-8"))
+                    sha.update(self._hash_file(file_path).encode("utf-8"))
+        elif os.path.exists(path):
+            sha.update(self._hash_file(path).encode("utf-8"))
+        else:
+            sha.update(b"<missing>")
+
+    def _hash_sources(self, source_dirs):
+        #
+        # We hash the sources once, so edits made while a pipeline is
+        # running only take effect for the next run
+        #
+        sha = hashlib.sha256()
+        for source_dir in source_dirs:
+            for root, dirs, files in os.walk(source_dir):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith(".py"):
+                        file_path = os.path.join(root, name)
+                        sha.update(os.path.relpath(file_path, source_dir).encode("utf-8"))
+                        sha.update(self._hash_file(file_path).encode("utf-8"))
+        return sha.hexdigest()
+
+    def fingerprint(self, image, command, function_name, executor_input, local_dir):
+        """
+        Calculate the cache key for a step
+
+        Args:
+            image : the image of the component
+            command : the container command, for a Python component this contains the source code
+            function_name : the name of the function to execute
+            executor_input : the executor input for the step
+            local_dir : the local directory that corresponds to the gs:// prefix
+        """
+        sha = hashlib.sha256()
+        sha.update(json.dumps([image, command, function_name, self._source_digest]).encode("utf-8"))
+        parameter_values = {
+            name : value for name, value in executor_input['inputs'].get("parameterValues", {}).items()
+                if name not in self._ignore_parameters
+        }
+        sha.update(json.dumps(parameter_values, sort_keys = True).encode("utf-8"))
+        input_artifacts = executor_input['inputs'].get("artifacts", {})
+        for name in sorted(input_artifacts.keys()):
+            sha.update(name.encode("utf-8"))
+            for artifact in input_artifacts[name]['artifacts']:
+                uri = artifact['uri']
+                #
+                # The URI is part of the key as well, as a component can record the URI of an
+                # input in its outputs, like evaluate does for the model. Otherwise a step in a
+                # loop could restore the outputs of another iteration with the same input content
+                #
+                sha.update(uri.encode("utf-8"))
+                path = uri.replace("gs://", f"{local_dir}/", 1) if uri.startswith("gs://") else uri
+                self._hash_path(path, sha)
+        return sha.hexdigest()
+
+    def restore(self, key, output_dir, output_file):
+        """
+        Restore the outputs of a step from the cache
+
+        Args:
+            key : the fingerprint of the step
+            output_dir : the directory into which the output artifacts are restored
+            output_file : the path to which the executor output file is restored
+
+        Returns:
+            True if the cache contained an entry for this key, False otherwise
+
+        """
+        entry_dir = f"{self._cache_dir}/{key}"
+        with self._lock:
+            if key not in self._index['entries'] or not os.path.isdir(entry_dir):
+                return False
+            self._index['entries'][key]['last_used'] = time.time()
+            self._save_index()
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        if os.path.isdir(f"{entry_dir}/outputs"):
+            copy_function = shutil.copy2 if self._artifact_store is None else self._link_file
+            shutil.copytree(f"{entry_dir}/outputs", output_dir, copy_function = copy_function)
+        for relpath, manifest in self._read_chunked(entry_dir).items():
+            self._artifact_store.restore_chunked(manifest, os.path.join(output_dir, relpath))
+        if os.path.exists(f"{entry_dir}/execution_output.json"):
+            os.makedirs(os.path.dirname(output_file), exist_ok = True)
+            shutil.copy(f"{entry_dir}/execution_output.json", output_file)
+        return True
+
+    def store(self, key, output_dir, output_file, step_name = None, blobs = None):
+        """
+        Add the outputs of a step to the cache and evict old entries if needed
+
+        Args:
+            key : the fingerprint of the step
+            output_dir : the directory holding the output artifacts of the step
+            output_file : the executor output file of the step
+            step_name : the name of the step, only used for informational purposes
+            blobs : optional - the result of ArtifactStore.add_tree for the output directory, the entry links these blobs
+        """
+        entry_dir = f"{self._cache_dir}/{key}"
+        tmp_dir = f"{entry_dir}.{threading.get_ident()}.tmp"
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        size = 0
+        if os.path.isdir(output_dir) and self._artifact_store is None:
+            shutil.copytree(output_dir, f"{tmp_dir}/outputs")
+        elif os.path.isdir(output_dir):
+            size = self._store_deduplicated(output_dir, tmp_dir, blobs or {})
+        if os.path.exists(output_file):
+            shutil.copy(output_file, f"{tmp_dir}/execution_output.json")
+        for root, _, files in os.walk(tmp_dir):
+            size = size + sum(os.path.getsize(os.path.join(root, name)) for name in files)
+        with self._lock:
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.rename(tmp_dir, entry_dir)
+            self._index['entries'][key] = {
+                "size" : size,
+                "last_used" : time.time(),
+                "step" : step_name
+            }
+            self._evict()
+            self._save_index()
+
+    def _store_deduplicated(self, output_dir, entry_dir, blobs):
+        #
+        # Link files to the blobs which the runner has already stored, so that they are neither
+        # stored nor counted twice. Files which are not in the store are split into chunks if
+        # they are large and copied otherwise. Returns the size of the chunked files
+        #
+        chunked = {}
+        size = 0
+        for root, _, files in os.walk(output_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, output_dir)
+                if relpath in blobs and self._artifact_store.has_blob(blobs[relpath]):
+                    self._artifact_store.link(blobs[relpath], os.path.join(entry_dir, "outputs", relpath))
+                elif os.path.getsize(path) >= self._chunk_threshold:
+                    chunked[relpath] = self._artifact_store.put_chunked(path)
+                    size = size + os.path.getsize(path)
+                else:
+                    os.makedirs(os.path.dirname(os.path.join(entry_dir, "outputs", relpath)), exist_ok = True)
+                    shutil.copy2(path, os.path.join(entry_dir, "outputs", relpath))
+        with open(f"{entry_dir}/chunked.json", "w") as file:
+            json.dump(chunked, file)
+        return size
+
+    def _read_chunked(self, entry_dir):
+        if not os.path.exists(f"{entry_dir}/chunked.json"):
+            return {}
+        with open(f"{entry_dir}/chunked.json", "r") as file:
+            return json.load(file)
+
+    def _link_file(self, source, target):
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+    def _evict(self):
+        #
+        # Remove least recently used entries until we are below the size limit. Needs
+        # to be called with the lock held
+        #
+        entries = self._index['entries']
+        total = sum(entry['size'] for entry in entries.values())
+        evicted = False
+        for key in sorted(entries.keys(), key = lambda k: entries[k]['last_used']):
+            if total <= self._max_bytes:
+                break
+            total = total - entries[key]['size']
+            del entries[key]
+            shutil.rmtree(f"{self._cache_dir}/{key}", ignore_errors = True)
+            evicted = True
+        #
+        # Blobs and chunks that were only used by the evicted entries can go now
+        #
+        if evicted and self._artifact_store is not None:
+            live_chunks = set()
+            for key in entries.keys():
+                for manifest in self._read_chunked(f"{self._cache_dir}/{key}").values():
+                    live_chunks.update(manifest)
+            self._artifact_store.gc(live_chunks = live_chunks)
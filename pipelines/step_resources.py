@@ -0,0 +1,221 @@
+#
+# CPU and memory requirements of pipeline steps and a simple scheduler that packs
+# steps onto the cores and memory of the local machine
+#
+from dataclasses import dataclass
+import contextlib
+import math
+import os
+import threading
+
+#
+# Suffixes accepted by set_memory_limit and set_memory_request
+#
+MEMORY_UNITS = {
+    "E" : 10**18, "P" : 10**15, "T" : 10**12, "G" : 10**9, "M" : 10**6, "K" : 10**3,
+    "Ei" : 2**60, "Pi" : 2**50, "Ti" : 2**40, "Gi" : 2**30, "Mi" : 2**20, "Ki" : 2**10
+}
+
+#
+# Number of cores that we assume for a step which does not specify a CPU request or limit
+#
+DEFAULT_CPU = 1.0
+
+
+def parse_cpu(value):
+    """
+    Convert a CPU value as used by set_cpu_limit ("2", "0.5", "500m") or as stored in the
+    compiled pipeline (2.0) into a number of cores
+
+    Args:
+        value : the value
+    """
+    if value is None:
+        return None
+    if isinstance(value, str) and value.endswith("m"):
+        return float(value[:-1]) / 1000
+    return float(value)
+
+
+def parse_memory(value):
+    """
+    Convert a memory value as used by set_memory_limit ("4G", "512Mi") into bytes
+
+    Args:
+        value : the value
+    """
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        return int(value)
+    for suffix in sorted(MEMORY_UNITS.keys(), key = len, reverse = True):
+        if value.endswith(suffix):
+            return int(float(value[:-len(suffix)]) * MEMORY_UNITS[suffix])
+    return int(float(value))
+
+
+def get_total_memory():
+    """
+    Return the physical memory of this machine in bytes
+    """
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+#
+# The resources of a step. CPUs are in cores, memory in bytes. Requests are what the
+# scheduler reserves for a step, limits are enforced while the step runs
+#
+@dataclass
+class StepResources:
+    cpu_request : float = None
+    cpu_limit : float = None
+    memory_request : int = None
+    memory_limit : int = None
+
+    @property
+    def cpu(self):
+        """
+        The number of cores that we reserve for the step
+        """
+        return self.cpu_request or self.cpu_limit or DEFAULT_CPU
+
+    @property
+    def memory(self):
+        """
+        The memory that we reserve for the step
+        """
+        return self.memory_request or self.memory_limit or 0
+
+    @property
+    def num_threads(self):
+        """
+        The number of intra-op threads that a step should use or None if the CPU is not limited
+        """
+        if self.cpu_limit is None:
+            return None
+        return max(1, math.ceil(self.cpu_limit))
+
+    def get_env(self):
+        """
+        Return environment variables which make torch, OpenMP and MKL use as many threads as
+        we have cores. This needs to be set before torch is imported
+        """
+        if self.num_threads is None:
+            return {}
+        return {
+            "OMP_NUM_THREADS" : str(self.num_threads),
+            "MKL_NUM_THREADS" : str(self.num_threads)
+        }
+
+    def get_docker_limits(self):
+        """
+        Return the arguments for containers.create or containers.run that enforce the limits
+        """
+        limits = {}
+        if self.cpu_limit is not None:
+            limits['nano_cpus'] = int(self.cpu_limit * 1e9)
+        if self.memory_limit is not None:
+            limits['mem_limit'] = self.memory_limit
+        return limits
+
+
+def get_resources_from_container_spec(container_spec):
+    """
+    Read the resources from the container section of an executor in a compiled pipeline. Depending on the
+    KFP version, the compiler stores CPUs in cores (cpuLimit) and memory in GB (memoryLimit) or the
+    original strings (resourceCpuLimit, resourceMemoryLimit)
+
+    Args:
+        container_spec : the container section of an executor in the deployment spec
+    """
+    resources = container_spec.get("resources", {})
+
+    def get_value(name, parse, scale):
+        if name in resources:
+            return parse(resources[name] * scale)
+        return parse(resources.get(f"resource{name[0].upper()}{name[1:]}"))
+
+    return StepResources(cpu_request = get_value("cpuRequest", parse_cpu, 1),
+                         cpu_limit = get_value("cpuLimit", parse_cpu, 1),
+                         memory_request = get_value("memoryRequest", parse_memory, 10**9),
+                         memory_limit = get_value("memoryLimit", parse_memory, 10**9))
+
+
+class ResourceScheduler:
+    """
+    Keep track of the cores and the memory reserved by running steps. A step is only started if its
+    reservation fits into what is left, so that steps running in parallel do not oversubscribe the machine.
+    A step that needs more than the machine has is reduced to the full machine and runs alone.
+
+    """
+    def __init__(self, cpus = None, memory = None):
+        """
+        Initialize the scheduler
+
+        Args:
+            cpus : the number of cores available for steps, defaults to all cores
+            memory : the memory available for steps in bytes, defaults to the physical memory
+        """
+        self.cpus = cpus or os.cpu_count()
+        self.memory = memory or get_total_memory()
+        self._used_cpus = 0.0
+        self._used_memory = 0
+        self._condition = threading.Condition()
+
+    def _reservation(self, resources):
+        return min(resources.cpu, self.cpus), min(resources.memory, self.memory)
+
+    def try_acquire(self, resources):
+        """
+        Reserve resources for a step if they are available
+
+        Args:
+            resources : the StepResources of the step
+
+        Returns:
+            True if the resources have been reserved, False otherwise
+        """
+        cpus, memory = self._reservation(resources)
+        with self._condition:
+            if self._used_cpus + cpus > self.cpus or self._used_memory + memory > self.memory:
+                return False
+            self._used_cpus = self._used_cpus + cpus
+            self._used_memory = self._used_memory + memory
+            return True
+
+    def acquire(self, resources):
+        """
+        Reserve resources for a step, waiting until other steps have released enough
+
+        Args:
+            resources : the StepResources of the step
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self.try_acquire(resources))
+
+    def release(self, resources):
+        """
+        Release the resources reserved for a step
+
+        Args:
+            resources : the StepResources of the step
+        """
+        cpus, memory = self._reservation(resources)
+        with self._condition:
+            self._used_cpus = self._used_cpus - cpus
+            self._used_memory = self._used_memory - memory
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def reserve(self, resources):
+        """
+        Hold a reservation while the body of the with statement runs
+
+        Args:
+            resources : the StepResources of the step
+        """
+        self.acquire(resources)
+        try:
+            yield
+        finally:
+            self.release(resources)
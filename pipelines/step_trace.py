@@ -0,0 +1,191 @@
+#
+# Tracing and resource profiles for local pipeline runs
+#
+from dataclasses import dataclass, field
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def get_size(path):
+    """
+    Return the size of a file or of all files in a directory in bytes, 0 if the path does not exist
+
+    Args:
+        path : the path
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+#
+# The resource profile of a single step. Times are in seconds, sizes in bytes. Bytes read
+# and written are determined from the size of the input and output artifacts under the
+# local directory, which works the same way for all backends
+#
+@dataclass
+class StepProfile:
+    step_name : str
+    start : float = 0.0
+    end : float = 0.0
+    cpu_time : float = None
+    peak_rss : int = None
+    bytes_read : int = 0
+    bytes_written : int = 0
+    pull_time : float = None
+    create_time : float = None
+    start_time : float = None
+    cached : bool = False
+    spans : list = field(default_factory = list)
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Record the time spent in a part of the step, like pulling the image or running the container
+
+        Args:
+            name : the name of the span
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append((name, start, time.time()))
+
+    @property
+    def wall_time(self):
+        return self.end - self.start
+
+
+class ContainerStatsCollector:
+    """
+    Poll the docker stats of a running container in a background thread and keep track of the
+    CPU time used and the peak memory usage
+
+    """
+    def __init__(self, container):
+        self.cpu_time = None
+        self.peak_memory = None
+        self._container = container
+        self._thread = threading.Thread(target = self._run, daemon = True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for stats in self._container.stats(stream = True, decode = True):
+                cpu_usage = stats.get("cpu_stats", {}).get("cpu_usage", {}).get("total_usage")
+                if cpu_usage:
+                    self.cpu_time = cpu_usage / 1e9
+                memory_stats = stats.get("memory_stats", {})
+                memory = memory_stats.get("max_usage") or memory_stats.get("usage")
+                if memory:
+                    self.peak_memory = max(self.peak_memory or 0, memory)
+        except Exception:
+            #
+            # The stats stream ends with an error once the container is gone
+            #
+            pass
+
+    def stop(self):
+        self._thread.join(timeout = 2)
+
+
+class StepTracer:
+    """
+    Collect the resource profiles of all steps of a run. At the end of a run, the profiles can be written as
+    a trace in the Chrome trace event format, which can be loaded into chrome://tracing or https://ui.perfetto.dev,
+    and printed as a summary table.
+
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._origin = time.time()
+
+    def add(self, profile):
+        """
+        Add the profile of a completed step
+
+        Args:
+            profile : a StepProfile
+        """
+        with self._lock:
+            self._profiles.append(profile)
+
+    def get_profile(self, step_name):
+        """
+        Return the most recent profile for a step or None if there is none
+
+        Args:
+            step_name : the step name
+        """
+        with self._lock:
+            profiles = [p for p in self._profiles if p.step_name == step_name]
+        return profiles[-1] if len(profiles) > 0 else None
+
+    def write_chrome_trace(self, path):
+        """
+        Write all profiles as Chrome trace events. Each step is shown on its own track with nested
+        events for the spans recorded for this step
+
+        Args:
+            path : the file to write to
+        """
+        events = []
+        to_us = lambda t: int((t - self._origin) * 1e6)
+        with self._lock:
+            profiles = sorted(self._profiles, key = lambda p: p.start)
+        for tid, profile in enumerate(profiles):
+            events.append({
+                "name" : "thread_name", "ph" : "M", "pid" : 1, "tid" : tid,
+                "args" : { "name" : profile.step_name }
+            })
+            events.append({
+                "name" : profile.step_name,
+                "ph" : "X",
+                "pid" : 1,
+                "tid" : tid,
+                "ts" : to_us(profile.start),
+                "dur" : to_us(profile.end) - to_us(profile.start),
+                "args" : {
+                    "cpu_time" : profile.cpu_time,
+                    "peak_rss" : profile.peak_rss,
+                    "bytes_read" : profile.bytes_read,
+                    "bytes_written" : profile.bytes_written,
+                    "pull_time" : profile.pull_time,
+                    "create_time" : profile.create_time,
+                    "start_time" : profile.start_time,
+                    "cached" : profile.cached
+                }
+            })
+            for name, start, end in profile.spans:
+                events.append({
+                    "name" : name,
+                    "ph" : "X",
+                    "pid" : 1,
+                    "tid" : tid,
+                    "ts" : to_us(start),
+                    "dur" : to_us(end) - to_us(start)
+                })
+        with open(path, "w") as file:
+            json.dump({ "traceEvents" : events, "displayTimeUnit" : "ms" }, file)
+
+    def summary(self):
+        """
+        Return a table with one line per step
+        """
+        fmt = lambda value, scale = 1.0: "-" if value is None else f"{value / scale:.2f}"
+        header = f"{'Step':<20} {'Wall s':>8} {'CPU s':>8} {'RSS MB':>8} {'Read MB':>8} {'Write MB':>8} {'Pull s':>8} {'Create s':>8} {'Start s':>8} {'Cached':>6}"
+        lines = [header, "-" * len(header)]
+        with self._lock:
+            profiles = sorted(self._profiles, key = lambda p: p.start)
+        for p in profiles:
+            lines.append(f"{p.step_name[:20]:<20} {fmt(p.wall_time):>8} {fmt(p.cpu_time):>8} {fmt(p.peak_rss, 1024**2):>8} "
+                         f"{fmt(p.bytes_read, 1024**2):>8} {fmt(p.bytes_written, 1024**2):>8} {fmt(p.pull_time):>8} "
+                         f"{fmt(p.create_time):>8} {fmt(p.start_time):>8} {'yes' if p.cached else 'no':>6}")
+        return "\n".join(lines)
@@ -1,6 +1,7 @@
 import google.cloud.aiplatform as aip 
 import os
 import argparse
+import sweep
 
 # 
 # Get arguments
@@ -11,6 +12,26 @@ def get_args():
                     type = str, 
                     default = None,
                     help = "Experiment to use")
+    parser.add_argument("--sweep_lrs", 
+                    type = str, 
+                    default = None,
+                    help = "Comma separated learning rates, submit the sweep pipeline for all combinations with --sweep_epochs")
+    parser.add_argument("--sweep_epochs", 
+                    type = str, 
+                    default = "5000",
+                    help = "Comma separated numbers of epochs for the sweep")
+    parser.add_argument("--random_trials", 
+                    type = int, 
+                    default = None,
+                    help = "Submit the sweep pipeline with this number of random configurations")
+    parser.add_argument("--ensemble", 
+                    action = "store_true",
+                    default = False,
+                    help = "Train the configurations of a sweep in one vectorised task")
+    parser.add_argument("--shards", 
+                    type = int, 
+                    default = None,
+                    help = "Submit the sharded pipeline which generates and evaluates the data in this number of shards")
     args=parser.parse_args()
     return args
 
@@ -32,19 +53,53 @@ aip.init(project = google_project_id,
 
 
 #
-# Create a pipeline job from the 
-# pipeline definition
+# Select the pipeline and its parameters. A sweep trains
+# all configurations in parallel branches of one job. Early
+# stopping is disabled by default, for these jobs we enable it
+# so that we do not pay for epochs once the loss has flattened out
 #
-pipeline_job = aip.PipelineJob(
-    display_name = "my-pipeline",
-    template_path = "my-pipeline.yaml",
-    pipeline_root = f"gs://vertex-ai-{google_project_id}/pipeline_root",
+display_name = "my-pipeline"
+parameter_values = {
+    "epochs" : 5000,
+    "lr" : 0.05,
+    "size" : 1000,
+    "experiment_name" : args.experiment,
+    "patience" : 100
+}
+configs = None
+if args.sweep_lrs is not None:
+    configs = sweep.grid(lrs = sweep.parse_list(args.sweep_lrs),
+                         epochs = sweep.parse_list(args.sweep_epochs, type = int))
+elif args.random_trials is not None:
+    configs = sweep.random_search(trials = args.random_trials)
+if configs is not None:
+    display_name = "my-ensemble" if args.ensemble else "my-sweep"
+    parameter_values = {
+        "configs" : configs,
+        "size" : 1000
+    }
+    if not args.ensemble:
+        parameter_values['patience'] = 100
+    print(f"Submitting sweep with {len(configs)} configurations")
+elif args.shards is not None:
+    display_name = "my-sharded-pipeline"
     parameter_values = {
         "epochs" : 5000,
         "lr" : 0.05,
         "size" : 1000,
-        "experiment_name" : args.experiment
-    },
+        "shards" : args.shards,
+        "patience" : 100
+    }
+
+#
+# Create a pipeline job from the 
+# pipeline definition
+#
+pipeline_job = aip.PipelineJob(
+    display_name = display_name,
+    template_path = f"{display_name}.yaml",
+    pipeline_root = f"gs://vertex-ai-{google_project_id}/pipeline_root",
+    parameter_values = parameter_values,
     project = google_project_id,
     location = google_region
 )
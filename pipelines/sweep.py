@@ -0,0 +1,47 @@
+#
+# Create the list of configurations for the hyperparameter sweep pipeline
+#
+import itertools
+import math
+import random
+
+
+def grid(lrs, epochs):
+    """
+    Return all combinations of learning rates and epochs
+
+    Args:
+        lrs : a list of learning rates
+        epochs : a list of epochs
+    """
+    return [{ "lr" : lr, "epochs" : e } for lr, e in itertools.product(lrs, epochs)]
+
+
+def random_search(trials, lr_range = (1e-3, 1.0), epochs_range = (100, 5000), seed = None):
+    """
+    Return random configurations. Learning rates are drawn uniformly on a log scale,
+    epochs uniformly from the range
+
+    Args:
+        trials : the number of configurations
+        lr_range : the smallest and largest learning rate
+        epochs_range : the smallest and largest number of epochs
+        seed : optional - the seed of the random number generator
+    """
+    rng = random.Random(seed)
+    low, high = math.log(lr_range[0]), math.log(lr_range[1])
+    return [{
+        "lr" : math.exp(rng.uniform(low, high)),
+        "epochs" : rng.randint(epochs_range[0], epochs_range[1])
+    } for _ in range(trials)]
+
+
+def parse_list(value, type = float):
+    """
+    Parse a comma separated list of values as used in command line arguments
+
+    Args:
+        value : the string
+        type : the type of the values
+    """
+    return [type(v) for v in value.split(",")]
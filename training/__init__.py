@@ -0,0 +1,9 @@
+#
+# Model, data generation, training and evaluation shared by the training scripts in jobs, metadata and
+# models and by the pipeline components. The base and pipeline images ship this package
+#
+from .model import Model, export_torchscript, load_model
+from .datagen import create_data
+from .evaluation import BinaryClassificationMetrics, accuracy, evaluate_model
+from .loop import OPTIMIZERS, train_model
+from .hooks import TrainingHook, PrintHook, ExperimentHook, UploadHook
@@ -0,0 +1,110 @@
+#
+# Generate the artificial dataset used by the pipeline. The data consists of two blobs
+# below and above the diagonal, each point has two float features and a label 0 or 1
+#
+import numpy as np
+
+#
+# The rows are generated in blocks of this size. Each block has its own random number stream, selected
+# by the counter of a Philox generator, so the content of a row only depends on the seed and its index
+# and any range of rows can be generated independently. 2**16 rows take 768 KB
+#
+BLOCK_SIZE = 2**16
+
+
+def get_seed():
+    """
+    Return a fresh random seed, used if the caller does not specify one. We keep it small
+    enough to be represented exactly when it is stored as a float in artifact metadata
+    """
+    return np.random.SeedSequence().entropy % 2**32
+
+
+def get_block_generator(seed, block):
+    """
+    Return the random number generator for a block of rows. Philox is a counter-based generator, so
+    we can jump to the stream of any block by setting the counter, the key is the seed
+
+    Args:
+        seed : the seed
+        block : the index of the block
+    """
+    return np.random.Generator(np.random.Philox(key = seed, counter = [0, block, 0, 0]))
+
+
+def generate_chunk(rng, rows):
+    """
+    Generate a chunk of data and return features of shape (rows, 2) and labels of shape (rows),
+    both float32. The label decides the cluster, the cluster center is (0.5, 0.25) for label 0
+    and (0.5, 0.75) for label 1, and we add uniform noise in [0, 0.05) to both features
+
+    Args:
+        rng : a numpy Generator
+        rows : the number of rows
+    """
+    Y = rng.integers(0, 2, size = rows).astype(np.float32)
+    X = rng.random((rows, 2), dtype = np.float32)
+    X *= 0.05
+    X[:, 0] += 0.5
+    X[:, 1] += 0.25 + 0.5 * Y
+    return X, Y
+
+
+def generate_rows(start, stop, seed):
+    """
+    Generate the rows start, ..., stop - 1 of a dataset block by block, so that the memory used does not depend
+    on the number of rows. The result is the same no matter how a dataset is split into ranges, i.e. generating
+    0 to n and n to m gives the same rows as generating 0 to m
+
+    Args:
+        start : the first row
+        stop : the row after the last row
+        seed : the seed of the dataset
+
+    Yields:
+        features and labels for each chunk
+    """
+    for block in range(start // BLOCK_SIZE, (stop + BLOCK_SIZE - 1) // BLOCK_SIZE):
+        #
+        # Always draw a full block, otherwise the number of random
+        # numbers consumed for the labels would shift the features
+        #
+        X, Y = generate_chunk(get_block_generator(seed, block), BLOCK_SIZE)
+        first = max(start - block * BLOCK_SIZE, 0)
+        last = min(stop - block * BLOCK_SIZE, BLOCK_SIZE)
+        yield X[first:last], Y[first:last]
+
+
+def get_shard(rows, shard, shards):
+    """
+    Return the range of rows that a shard covers if rows are split as evenly as possible into shards
+
+    Args:
+        rows : the overall number of rows
+        shard : the index of the shard
+        shards : the number of shards
+    """
+    return rows * shard // shards, rows * (shard + 1) // shards
+
+
+def create_data(size, seed = None):
+    """
+    Generate a dataset and return features of shape (size, 2) and labels of shape (size) as float32
+    tensors. The arrays are allocated once and filled block by block, so that we do not need
+    more memory than the result itself
+
+    Args:
+        size : the number of rows
+        seed : optional - the seed of the random number generator
+    """
+    import torch
+    if seed is None:
+        seed = get_seed()
+    X = np.empty((size, 2), dtype = np.float32)
+    Y = np.empty((size, ), dtype = np.float32)
+    start = 0
+    for _X, _Y in generate_rows(0, size, seed):
+        X[start:start + len(_Y)] = _X
+        Y[start:start + len(_Y)] = _Y
+        start = start + len(_Y)
+    return torch.from_numpy(X), torch.from_numpy(Y)
@@ -0,0 +1,244 @@
+#
+# Batched evaluation of a binary classifier
+#
+import json
+import torch
+
+#
+# Number of bins of the score histograms from which we calculate the ROC-AUC
+#
+ROC_BINS = 10000
+
+
+class BinaryClassificationMetrics:
+    """
+    Accumulate the metrics of a binary classifier batch by batch. For each batch, we update the
+    confusion matrix, the sum of the log loss and histograms of the predicted probabilities of the positive
+    and the negative samples, all with vectorised tensor operations. The ROC-AUC is calculated from these
+    histograms, so the state has a fixed size independent of the number of samples and two accumulators
+    for different parts of a dataset can be merged.
+
+    """
+    def __init__(self, threshold = 0.5, bins = ROC_BINS):
+        """
+        Initialize an empty accumulator
+
+        Args:
+            threshold : a sample is predicted as positive if its probability is at least this value
+            bins : the number of bins of the score histograms
+        """
+        self.threshold = threshold
+        self.bins = bins
+        self.confusion_matrix = torch.zeros((2, 2), dtype = torch.int64)
+        self.log_loss_sum = 0.0
+        self.positive_scores = torch.zeros(bins, dtype = torch.int64)
+        self.negative_scores = torch.zeros(bins, dtype = torch.int64)
+
+    @property
+    def count(self):
+        return int(self.confusion_matrix.sum())
+
+    def update(self, logits, labels):
+        """
+        Add a batch
+
+        Args:
+            logits : the output of the model, shape (batch size)
+            labels : the true labels (0 or 1) as floats, shape (batch size)
+        """
+        logits = logits.float()
+        labels = labels.float()
+        probabilities = torch.sigmoid(logits)
+        predictions = (probabilities >= self.threshold).long()
+        targets = labels.long()
+        #
+        # The index 2 * target + prediction enumerates the cells of the
+        # confusion matrix, rows are true labels, columns are predictions
+        #
+        self.confusion_matrix += torch.bincount(2 * targets + predictions, minlength = 4).reshape(2, 2)
+        self.log_loss_sum += torch.nn.functional.binary_cross_entropy_with_logits(logits, labels, reduction = "sum").item()
+        buckets = torch.clamp((probabilities * self.bins).long(), 0, self.bins - 1)
+        self.positive_scores += torch.bincount(buckets[targets == 1], minlength = self.bins)
+        self.negative_scores += torch.bincount(buckets[targets == 0], minlength = self.bins)
+
+    def merge(self, other):
+        """
+        Add the state of another accumulator to this one
+
+        Args:
+            other : a BinaryClassificationMetrics instance with the same number of bins
+        """
+        assert self.bins == other.bins, "Can only merge metrics with the same number of bins"
+        self.confusion_matrix += other.confusion_matrix
+        self.log_loss_sum += other.log_loss_sum
+        self.positive_scores += other.positive_scores
+        self.negative_scores += other.negative_scores
+        return self
+
+    def state_dict(self):
+        """
+        Return the state of the accumulator as a dictionary of plain Python values which can be stored as JSON
+        """
+        return {
+            "threshold" : self.threshold,
+            "bins" : self.bins,
+            "confusion_matrix" : self.confusion_matrix.tolist(),
+            "log_loss_sum" : self.log_loss_sum,
+            "positive_scores" : self.positive_scores.tolist(),
+            "negative_scores" : self.negative_scores.tolist()
+        }
+
+    def load_state_dict(self, state):
+        """
+        Restore the state from a dictionary returned by state_dict
+
+        Args:
+            state : the dictionary
+        """
+        self.threshold = state['threshold']
+        self.bins = state['bins']
+        self.confusion_matrix = torch.tensor(state['confusion_matrix'], dtype = torch.int64)
+        self.log_loss_sum = state['log_loss_sum']
+        self.positive_scores = torch.tensor(state['positive_scores'], dtype = torch.int64)
+        self.negative_scores = torch.tensor(state['negative_scores'], dtype = torch.int64)
+        return self
+
+    def roc_auc(self):
+        """
+        Return the area under the ROC curve, i.e. the probability that a random positive sample has a higher
+        score than a random negative sample. Pairs that fall into the same bin count as ties
+        """
+        positives = self.positive_scores.double()
+        negatives = self.negative_scores.double()
+        if positives.sum() == 0 or negatives.sum() == 0:
+            return None
+        negatives_below = torch.cumsum(negatives, dim = 0) - negatives
+        auc = (positives * (negatives_below + 0.5 * negatives)).sum() / (positives.sum() * negatives.sum())
+        return auc.item()
+
+    def result(self):
+        """
+        Return a dictionary with accuracy (in percent), log loss, ROC-AUC and the confusion matrix
+        """
+        count = self.count
+        assert count > 0, "No samples evaluated"
+        (tn, fp), (fn, tp) = self.confusion_matrix.tolist()
+        return {
+            "accuracy" : 100.0 * (tp + tn) / count,
+            "log_loss" : self.log_loss_sum / count,
+            "roc_auc" : self.roc_auc(),
+            "true_positives" : tp,
+            "false_positives" : fp,
+            "true_negatives" : tn,
+            "false_negatives" : fn,
+            "samples" : count
+        }
+
+
+def iterate_batches(X, Y, batch_size = 65536):
+    """
+    Split features and labels into batches. Slicing does not copy, so this works
+    for memory mapped tensors without reading more than one batch at a time
+
+    Args:
+        X : the features
+        Y : the labels
+        batch_size : the number of rows per batch
+    """
+    for start in range(0, len(Y), batch_size):
+        yield X[start:start + batch_size], Y[start:start + batch_size]
+
+
+def evaluate_model(model, batches, metrics = None, dtype = torch.float32):
+    """
+    Run the model over batches of data and accumulate the metrics
+
+    Args:
+        model : the model, which needs to return one logit per sample
+        batches : an iterable of features and labels
+        metrics : optional - a BinaryClassificationMetrics instance to update, a new one is created if not provided
+        dtype : the data type of the model weights, to which we convert the features
+
+    Returns:
+        the BinaryClassificationMetrics instance
+    """
+    if metrics is None:
+        metrics = BinaryClassificationMetrics()
+    #
+    # A frozen TorchScript module is always in evaluation mode
+    #
+    if not isinstance(model, torch.jit.ScriptModule):
+        model.eval()
+    with torch.inference_mode():
+        for X, Y in batches:
+            metrics.update(model(X.to(dtype)).reshape(-1), Y)
+    return metrics
+
+
+def accuracy(model, X, Y, batch_size = 65536):
+    """
+    Return the fraction of samples that a model classifies correctly, evaluated batch by batch
+
+    Args:
+        model : the model
+        X : the features
+        Y : the labels
+        batch_size : the number of rows that we evaluate at a time
+    """
+    return evaluate_model(model, iterate_batches(X, Y, batch_size = batch_size)).result()['accuracy'] / 100
+
+
+def save_partial(metrics, path):
+    """
+    Save the state of an accumulator, for instance the result of evaluating one shard, so that another
+    step can merge it with the state of other shards
+
+    Args:
+        metrics : a BinaryClassificationMetrics instance
+        path : the file
+    """
+    with open(path, "w") as file:
+        json.dump(metrics.state_dict(), file)
+
+
+def load_partial(path):
+    """
+    Load an accumulator saved with save_partial
+
+    Args:
+        path : the file
+    """
+    with open(path, "r") as file:
+        return BinaryClassificationMetrics().load_state_dict(json.load(file))
+
+
+def log_results(metrics, results):
+    """
+    Log the result of an evaluation to a Metrics artifact
+
+    Args:
+        metrics : the Metrics artifact
+        results : the dictionary returned by BinaryClassificationMetrics.result
+    """
+    for name, value in results.items():
+        if value is not None:
+            metrics.log_metric(name, value)
+
+
+def write_model_card(path, results):
+    """
+    Write a model card in Markdown format - of course this is just a toy example, for real
+    use cases you might want to consider a toolkit like Googles Model Card Toolkit
+
+    Args:
+        path : the file
+        results : the dictionary returned by BinaryClassificationMetrics.result
+    """
+    with open(path, "w") as model_card:
+        model_card.write("# Model card\n\n")
+        model_card.write("| Item | Value |\n")
+        model_card.write("| --- | --- |\n")
+        model_card.write(f"| Accuracy | {results['accuracy']} |\n")
+        model_card.write(f"| Log loss | {results['log_loss']} |\n")
+        model_card.write(f"| ROC-AUC | {results['roc_auc']} |\n")
+        model_card.write(f"| PyTorch version | {torch.__version__} |\n")
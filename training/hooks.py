@@ -0,0 +1,101 @@
+#
+# Hooks that the training loop calls, so that entry points can plug in logging and upload
+#
+import os
+
+
+class TrainingHook:
+    """
+    Base class for hooks. A hook overrides the methods for the events that it is interested in
+
+    """
+    def on_epoch_end(self, epoch, loss):
+        """
+        Called after each epoch of a first-order optimizer
+
+        Args:
+            epoch : the epoch that has just completed
+            loss : the loss of the last step of the epoch as a float
+        """
+        pass
+
+    def on_train_end(self, model, loss):
+        """
+        Called once training has completed
+
+        Args:
+            model : the trained model
+            loss : the final loss as a float
+        """
+        pass
+
+
+class PrintHook(TrainingHook):
+    """
+    Print the loss every interval epochs and the final loss
+
+    """
+    def __init__(self, interval = 0):
+        """
+        Args:
+            interval : print the loss every that many epochs, 0 to only print the final loss
+        """
+        self._interval = interval
+
+    def on_epoch_end(self, epoch, loss):
+        if self._interval > 0 and 0 == (epoch % self._interval):
+            print(f"Epoch {epoch}: loss {loss}")
+
+    def on_train_end(self, model, loss):
+        print(f"Final loss: {loss}")
+
+
+class ExperimentHook(TrainingHook):
+    """
+    Log the loss as time series metric to the current Vertex AI experiment run
+
+    """
+    def __init__(self, interval = 1):
+        """
+        Args:
+            interval : log the loss every that many epochs
+        """
+        self._interval = interval
+
+    def on_epoch_end(self, epoch, loss):
+        import google.cloud.aiplatform as aip
+        if 0 == (epoch % self._interval):
+            aip.log_time_series_metrics({
+                "loss" : loss,
+            }, step = epoch)
+
+
+class UploadHook(TrainingHook):
+    """
+    Save the state dict of the trained model and upload it to Google Cloud storage, by default to the location
+    pointed to by AIP_MODEL_DIR. After training, the URI of the uploaded model is available as attribute uri
+
+    """
+    def __init__(self, model_dir = None, file_name = "model.bin"):
+        """
+        Args:
+            model_dir : the GCS location, defaults to the environment variable AIP_MODEL_DIR
+            file_name : the name of the local file and of the blob in the model directory
+        """
+        self.model_dir = model_dir or os.environ.get("AIP_MODEL_DIR")
+        self.file_name = file_name
+        self.uri = None
+
+    def on_train_end(self, model, loss):
+        import torch
+        import google.cloud.storage as gcs
+        torch.save(model.state_dict(), self.file_name)
+        uri = f"{self.model_dir}/{self.file_name}"
+        path_components = uri.replace("gs://", "").split("/")
+        bucket_name = path_components[0]
+        blob_name = "/".join(path_components[1:])
+        print(f"Doing upload to model directory {self.model_dir} (bucket {bucket_name}, blob {blob_name})")
+        gcs_client = gcs.Client()
+        bucket = gcs_client.get_bucket(bucket_name)
+        bucket.blob(blob_name).upload_from_filename(self.file_name)
+        self.uri = uri
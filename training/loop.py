@@ -0,0 +1,63 @@
+#
+# Full-batch training of the model with a pluggable optimizer
+#
+import torch
+
+from . import solvers
+
+#
+# First-order optimizers that can be selected by name. Any other callable which accepts
+# the parameters and the learning rate and returns a torch optimizer works as well
+#
+OPTIMIZERS = {
+    "sgd" : torch.optim.SGD,
+    "adam" : torch.optim.Adam
+}
+
+
+def train_model(model, X, Y, epochs = 5000, lr = 0.1, optimizer = "sgd", hooks = (), tolerance = 1e-6):
+    """
+    Train the model on the full batch. Our data is small, so we do not use shuffling or mini-batches
+
+    Args:
+        model : the model
+        X : the features
+        Y : the labels as floats
+        epochs : the number of epochs, or the maximum number of iterations for lbfgs and newton
+        lr : the learning rate of a first-order optimizer
+        optimizer : sgd, adam, lbfgs, newton or a callable that creates a torch optimizer from parameters and learning rate
+        hooks : TrainingHook instances that are called after each epoch and at the end
+        tolerance : the convergence tolerance of lbfgs and newton
+
+    Returns:
+        the final loss as a float
+    """
+    if optimizer in solvers.SOLVERS:
+        report = solvers.fit(optimizer, model, X, Y, max_iter = epochs, tolerance = tolerance)
+        print(f"Solver {optimizer} used {report['iterations']} iterations, converged: {report['converged']}")
+        loss = report['final_loss']
+    else:
+        factory = OPTIMIZERS[optimizer] if isinstance(optimizer, str) else optimizer
+        _optimizer = factory(model.parameters(), lr = lr)
+        loss_fn = torch.nn.functional.binary_cross_entropy_with_logits
+        model.train()
+        for e in range(epochs):
+            logits = model(X).squeeze(dim = 1)
+            #
+            # Yes, the targets are expected to be floats
+            #
+            _loss = loss_fn(input = logits, target = Y)
+            _optimizer.zero_grad()
+            _loss.backward()
+            _optimizer.step()
+            #
+            # Only synchronize on the loss if someone is interested in it
+            #
+            if len(hooks) > 0:
+                value = _loss.item()
+                for hook in hooks:
+                    hook.on_epoch_end(e, value)
+        loss = _loss.item()
+    for hook in hooks:
+        hook.on_train_end(model, loss)
+    return loss
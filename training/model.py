@@ -0,0 +1,114 @@
+#
+# Our model - one layer only, activation function left out
+#
+
+import os
+import torch
+
+class Model(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.layers = torch.nn.Sequential(
+            torch.nn.Linear(in_features = 2, out_features = 1)
+        )
+        self.activation = torch.nn.Sigmoid()
+
+    def forward(self, X):
+        return self.layers(X)
+
+    #
+    # Make a prediction for a single input
+    # Input: a torch tensor of shape (2)
+    # Output: an integer (0 or 1)
+    #
+    def predict(self, x):
+        with torch.no_grad():
+            logit = self.forward(x)
+            out = self.activation(logit)
+        return 0 if out < 0.5 else 1
+
+
+#
+# Precisions in which we can train and run the model. Parameters are always stored in float32,
+# training in bfloat16 uses autocast and inference converts weights and inputs
+#
+PRECISIONS = {
+    "float32" : torch.float32,
+    "bfloat16" : torch.bfloat16
+}
+
+#
+# Suffix of the file with the TorchScript version of a model, which we store
+# next to the file with the state dict
+#
+TORCHSCRIPT_SUFFIX = ".torchscript.pt"
+
+
+def get_torchscript_path(path):
+    """
+    Return the path of the TorchScript version of the model whose state dict is stored at path
+
+    Args:
+        path : the path of the state dict
+    """
+    return f"{path}{TORCHSCRIPT_SUFFIX}"
+
+
+def export_torchscript(model, path):
+    """
+    Compile the forward method of a model to TorchScript and save it. The module is frozen, i.e. parameters
+    are inlined as constants, so that calling it does not go through the Python dispatch of nn.Module, which
+    dominates the time per call for a model as small as ours. Only forward is compiled, so predict is not
+    available on the result
+
+    Args:
+        model : the model
+        path : the file to which we save the compiled model
+    """
+    model.eval()
+    scripted = torch.jit.freeze(torch.jit.script(model))
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def load_torchscript(path):
+    """
+    Load a model saved by export_torchscript
+
+    Args:
+        path : the file
+    """
+    return torch.jit.load(path, map_location = "cpu")
+
+
+def get_dtype(precision):
+    """
+    Return the torch data type for a precision as stored in the model metadata
+
+    Args:
+        precision : float32 or bfloat16
+    """
+    assert precision in PRECISIONS, f"Unknown precision {precision}"
+    return PRECISIONS[precision]
+
+
+def load_model(path, precision = "float32"):
+    """
+    Load a model for inference from the file with its state dict, using the TorchScript version
+    instead if one has been exported next to it. The TorchScript version has its float32 weights
+    folded into the code, so for any other precision we load the state dict and convert the weights
+
+    Args:
+        path : the path of the state dict
+        precision : float32 or bfloat16, the inputs need to be converted to the same data type
+    """
+    dtype = get_dtype(precision)
+    torchscript_path = get_torchscript_path(path)
+    if dtype == torch.float32 and os.path.exists(torchscript_path):
+        print(f"Using TorchScript model {torchscript_path}")
+        return load_torchscript(torchscript_path)
+    model = Model()
+    with open(path, "rb") as file:
+        model.load_state_dict(torch.load(file))
+    return model.to(dtype)
@@ -0,0 +1,142 @@
+#
+# Second-order solvers for our model. As the model is a single linear layer followed by a sigmoid, i.e. a logistic
+# regression, the loss is convex and a quasi-Newton or Newton method reaches the optimum in tens of iterations
+#
+import torch
+
+#
+# The second-order solvers, the first-order optimizers are in loop.OPTIMIZERS
+#
+SOLVERS = ("lbfgs", "newton")
+
+#
+# Strength of the L2 penalty on the weights. Our two blobs are linearly separable, so without a penalty the
+# loss has no minimum and the weights would grow without bound
+#
+L2 = 1e-4
+
+#
+# Number of rows per chunk when the Newton solver accumulates gradient and Hessian
+#
+CHUNK_SIZE = 2**20
+
+
+def fit_lbfgs(model, X, Y, max_iter = 100, tolerance = 1e-6, l2 = L2):
+    """
+    Fit the model with L-BFGS and a strong Wolfe line search on the full batch
+
+    Args:
+        model : the model
+        X : the features
+        Y : the labels
+        max_iter : the maximum number of iterations
+        tolerance : stop once the largest component of the gradient is below this value
+        l2 : the strength of the L2 penalty on the weights
+
+    Returns:
+        a dictionary with the number of iterations, whether the solver converged, the final loss and the norm of the gradient
+    """
+    weight = model.layers[0].weight
+    optimizer = torch.optim.LBFGS(model.parameters(),
+                                  lr = 1,
+                                  max_iter = max_iter,
+                                  tolerance_grad = tolerance,
+                                  tolerance_change = tolerance * 1e-3,
+                                  history_size = 10,
+                                  line_search_fn = "strong_wolfe")
+
+    def closure():
+        optimizer.zero_grad()
+        logits = model(X).squeeze(dim = 1)
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(input = logits, target = Y) + 0.5 * l2 * (weight ** 2).sum()
+        loss.backward()
+        return loss
+
+    model.train()
+    optimizer.step(closure)
+    loss = closure()
+    gradient_norm = torch.cat([p.grad.reshape(-1) for p in model.parameters()]).norm().item()
+    iterations = optimizer.state[weight]['n_iter']
+    return {
+        "iterations" : iterations,
+        "converged" : iterations < max_iter,
+        "final_loss" : loss.item(),
+        "gradient_norm" : gradient_norm
+    }
+
+
+def fit_newton(model, X, Y, max_iter = 50, tolerance = 1e-6, l2 = L2):
+    """
+    Fit the model with Newton's method, also known as iteratively reweighted least squares for a logistic
+    regression. Gradient and Hessian are accumulated in double precision chunk by chunk, so that the memory used
+    does not depend on the number of rows, and each iteration solves a 3 x 3 linear system
+
+    Args:
+        model : the model
+        X : the features
+        Y : the labels
+        max_iter : the maximum number of iterations
+        tolerance : stop once the largest component of the Newton step is below this value
+        l2 : the strength of the L2 penalty on the weights
+
+    Returns:
+        a dictionary with the number of iterations, whether the solver converged, the final loss and the norm of the gradient
+    """
+    linear = model.layers[0]
+    features = linear.in_features
+    #
+    # We append a column of ones to the features so that the bias
+    # is the last component of the parameter vector
+    #
+    theta = torch.cat([linear.weight.detach().reshape(-1), linear.bias.detach()]).double()
+    penalty = l2 * torch.diag(torch.tensor([1.0] * features + [0.0], dtype = torch.float64))
+    rows = len(Y)
+    converged = False
+    for iteration in range(1, max_iter + 1):
+        gradient = torch.zeros(features + 1, dtype = torch.float64)
+        hessian = torch.zeros((features + 1, features + 1), dtype = torch.float64)
+        loss = 0.0
+        for start in range(0, rows, CHUNK_SIZE):
+            x = X[start:start + CHUNK_SIZE].double()
+            y = Y[start:start + CHUNK_SIZE].double()
+            x = torch.cat([x, torch.ones((len(x), 1), dtype = torch.float64)], dim = 1)
+            logits = x @ theta
+            p = torch.sigmoid(logits)
+            gradient += x.T @ (p - y)
+            hessian += (x * (p * (1 - p)).unsqueeze(dim = 1)).T @ x
+            loss += torch.nn.functional.binary_cross_entropy_with_logits(logits, y, reduction = "sum").item()
+        gradient = gradient / rows + penalty @ theta
+        hessian = hessian / rows + penalty
+        loss = loss / rows + 0.5 * (theta @ penalty @ theta).item()
+        step = torch.linalg.solve(hessian, gradient)
+        theta = theta - step
+        if step.abs().max().item() < tolerance:
+            converged = True
+            break
+    with torch.no_grad():
+        linear.weight.copy_(theta[:features].reshape(linear.weight.shape))
+        linear.bias.copy_(theta[features:])
+    return {
+        "iterations" : iteration,
+        "converged" : converged,
+        "final_loss" : loss,
+        "gradient_norm" : gradient.norm().item()
+    }
+
+
+def fit(solver, model, X, Y, max_iter, tolerance = 1e-6):
+    """
+    Fit the model with one of the second-order solvers
+
+    Args:
+        solver : lbfgs or newton
+        model : the model
+        X : the features
+        Y : the labels
+        max_iter : the maximum number of iterations
+        tolerance : the convergence tolerance of the solver
+    """
+    assert solver in SOLVERS, f"Unknown solver {solver}"
+    if solver == "lbfgs":
+        return fit_lbfgs(model, X, Y, max_iter = max_iter, tolerance = tolerance)
+    return fit_newton(model, X, Y, max_iter = max_iter, tolerance = tolerance)